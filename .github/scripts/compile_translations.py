@@ -0,0 +1,51 @@
+"""Precompile translations of functions to JSON, so the functions read them without parsing YAML.
+
+Run at deployment for the `locale` directory of the deployed function, e.g.
+
+    python3 .github/scripts/compile_translations.py matches-process-timeout/locale
+
+Next to every `<locale>.yml`, `<locale>.json` is written with its translations by dotted key, as read by
+`load_translations` of the functions.
+"""
+import json
+import os
+import sys
+
+import yaml
+
+
+# Code of the functions reading the translations, so locale files are flattened the same way here
+SHARED_TRANSLATIONS_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "_build", "shared", "translations.py"
+)
+
+
+def load_shared_translations():
+    """Return the names defined by _build/shared/translations.py, which relies on the imports of main.py."""
+    namespace = dict(os=os, json=json)
+    with open(SHARED_TRANSLATIONS_PATH, encoding="utf-8") as shared_file:
+        exec(shared_file.read(), namespace)
+
+    return namespace
+
+
+flatten_translations = load_shared_translations()["flatten_translations"]
+
+
+def compile_translations(translations_dir):
+    for file_name in sorted(os.listdir(translations_dir)):
+        locale, extension = os.path.splitext(file_name)
+        if extension != ".yml":
+            continue
+
+        with open(os.path.join(translations_dir, file_name), encoding="utf-8") as yaml_file:
+            translations = flatten_translations(yaml.safe_load(yaml_file))
+        with open(os.path.join(translations_dir, f"{locale}.json"), "w", encoding="utf-8") as json_file:
+            json.dump(translations, json_file, ensure_ascii=False, separators=(",", ":"))
+
+        print(f"Compiled {len(translations)} translations of locale={locale}")
+
+
+if __name__ == "__main__":
+    for translations_dir in sys.argv[1:]:
+        compile_translations(translations_dir)
@@ -0,0 +1,79 @@
+# Messages are batched by the client, up to PUBSUB_MAX_IN_FLIGHT_MESSAGES are published without waiting
+PUBSUB_MAX_BATCH_MESSAGES = int(os.getenv("PUBSUB_MAX_BATCH_MESSAGES", 100))
+PUBSUB_MAX_BATCH_LATENCY_SECONDS = float(os.getenv("PUBSUB_MAX_BATCH_LATENCY_SECONDS", 0.05))
+PUBSUB_MAX_IN_FLIGHT_MESSAGES = int(os.getenv("PUBSUB_MAX_IN_FLIGHT_MESSAGES", 1000))
+
+# Instantiates a Pub/Sub client
+publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(
+        max_messages=PUBSUB_MAX_BATCH_MESSAGES,
+        max_latency=PUBSUB_MAX_BATCH_LATENCY_SECONDS,
+    )
+)
+
+# (future, topic name, message) of messages published and not confirmed yet
+in_flight_messages = []
+
+# Messages are written to the outbox table in the transaction changing the statuses they notify about,
+# instead of being published from within the transaction.  Only for functions calling `flush_messages`.
+NOTIFICATIONS_OUTBOX = os.getenv("NOTIFICATIONS_OUTBOX", "false").lower() == "true"
+OUTBOX_INSERT_CHUNK_SIZE = 1000
+# Messages of the current transaction to be written to the outbox table, see `flush_messages`
+outbox_messages = []
+
+
+def publish_message(topic_name, message):
+    """Publish `message` to `topic_name` without waiting for it, or keep it for the outbox.  See `flush_messages`."""
+    message_json = json.dumps(message)
+    if NOTIFICATIONS_OUTBOX:
+        outbox_messages.append(dict(topic=topic_name, message=message_json))
+        return "Message stored."
+
+    if len(in_flight_messages) >= PUBSUB_MAX_IN_FLIGHT_MESSAGES:
+        wait_for_published_messages()
+
+    topic_path = publisher.topic_path(os.environ["PROJECT_ID"], topic_name)
+    message_bytes = message_json.encode("utf-8")
+
+    try:
+        publish_future = publisher.publish(topic_path, data=message_bytes)
+        in_flight_messages.append((publish_future, topic_name, message_json))
+        return "Message published."
+    except Exception as e:
+        print(f"Publishing to {topic_name} failed: {e}, message={message_json}")
+        return (e, 500)
+
+
+def wait_for_published_messages():
+    """Wait until all messages in flight are published.  Return the number of messages which failed."""
+    failed = 0
+    for publish_future, topic_name, message_json in in_flight_messages:
+        try:
+            publish_future.result()  # Verify the publish succeeded
+        except Exception as e:
+            print(f"Publishing to {topic_name} failed: {e}, message={message_json}")
+            failed += 1
+
+    print(f"Published {len(in_flight_messages) - failed} messages, {failed} failed")
+    in_flight_messages.clear()
+    return failed
+
+
+def flush_messages(db_connection):
+    """Send messages of the current transaction of `db_connection`, before it commits.
+
+    Messages kept for the outbox are written to the outbox table in that transaction and published
+    later by the outbox-relay function.  Otherwise, messages published directly are waited for.
+    """
+    if len(outbox_messages) > 0:
+        tbl_outbox = sqlalchemy.table(
+            os.environ["OUTBOX_TABLE_NAME"], sqlalchemy.column("topic"), sqlalchemy.column("message")
+        )
+        for chunk_start in range(0, len(outbox_messages), OUTBOX_INSERT_CHUNK_SIZE):
+            db_connection.execute(
+                tbl_outbox.insert().values(outbox_messages[chunk_start:chunk_start + OUTBOX_INSERT_CHUNK_SIZE])
+            )
+        print(f"Stored {len(outbox_messages)} messages in {os.environ['OUTBOX_TABLE_NAME']}")
+        outbox_messages.clear()
+
+    wait_for_published_messages()
@@ -0,0 +1,53 @@
+# Translations of TRANSLATION_KEYS by locale, see `query_translations`
+translation_tables = {}
+
+
+def flatten_translations(translations, key_prefix=""):
+    """Return nested `translations` of a locale file by dotted key, e.g. "sendgrid.MatchTimeout"."""
+    flat_translations = {}
+    for key, value in translations.items():
+        if isinstance(value, dict):
+            flat_translations |= flatten_translations(value, f"{key_prefix}{key}.")
+        else:
+            flat_translations[f"{key_prefix}{key}"] = value
+
+    return flat_translations
+
+
+def load_translations(locale):
+    """Return all translations of `locale` by dotted key, or nothing if there is no file of the locale.
+
+    `<locale>.json` precompiled at deployment is read if present, `<locale>.yml` is parsed otherwise.
+    """
+    file_names = os.listdir(TRANSLATIONS_FILE_PATH)
+    if f"{locale}.json" in file_names:
+        with open(os.path.join(TRANSLATIONS_FILE_PATH, f"{locale}.json"), encoding="utf-8") as translations_file:
+            return json.load(translations_file)
+    elif f"{locale}.yml" in file_names:
+        import yaml
+
+        with open(os.path.join(TRANSLATIONS_FILE_PATH, f"{locale}.yml"), encoding="utf-8") as translations_file:
+            return flatten_translations(yaml.safe_load(translations_file))
+    else:
+        return {}
+
+
+def query_translations(locale):
+    """Return translations of `TRANSLATION_KEYS` to `locale` by key.
+
+    A locale is loaded on its first use, only its translations of `TRANSLATION_KEYS` are kept for the process.
+    Keys missing in the locale are translated to TRANSLATIONS_FALLBACK_LOCALE, or left as they are.
+    """
+    if locale not in translation_tables:
+        if locale != TRANSLATIONS_FALLBACK_LOCALE:
+            fallback_translations = query_translations(TRANSLATIONS_FALLBACK_LOCALE)
+        else:
+            fallback_translations = {}
+
+        translations = load_translations(locale)
+        translation_tables[locale] = {
+            key: translations.get(key, fallback_translations.get(key, key)) for key in TRANSLATION_KEYS
+        }
+        print(f"Translations of locale={locale} loaded")
+
+    return translation_tables[locale]
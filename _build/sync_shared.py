@@ -0,0 +1,69 @@
+"""Copy the shared code of `_build/shared` into main.py of the functions.
+
+Every function is deployed from its own directory, so its main.py cannot import code from outside of it, and a
+function is deployed only when its main.py changes.  Code used by several functions is kept in `_build/shared` and
+copied into main.py between the lines
+
+    # shared: _build/shared/<file name>, edit it there and run `python _build/sync_shared.py`
+    # endshared
+
+Edit the file in `_build/shared`, then run from the repository root
+
+    python _build/sync_shared.py
+
+With `--check` nothing is written, main.py files out of sync are listed and the exit code is 1.  The shared files
+rely on the imports and the configuration context of main.py.
+"""
+import argparse
+import glob
+import os
+import re
+import sys
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHARED_BLOCK_PATTERN = re.compile(
+    r"^(# shared: (?P<path>\S+), edit it there and run `python _build/sync_shared.py`\n)(?P<code>.*?)^(# endshared\n)",
+    re.MULTILINE | re.DOTALL,
+)
+
+
+def read_file(path):
+    with open(path) as file:
+        return file.read()
+
+
+def synced_source(source):
+    """Return `source` of a main.py with its shared blocks replaced by the current shared files."""
+    return SHARED_BLOCK_PATTERN.sub(
+        lambda match: match.group(1) + read_file(os.path.join(REPOSITORY_PATH, match.group("path"))) + match.group(4),
+        source,
+    )
+
+
+def main_files():
+    return sorted(glob.glob(os.path.join(REPOSITORY_PATH, "*", "main.py")))
+
+
+def out_of_sync_files():
+    return [path for path in main_files() if synced_source(read_file(path)) != read_file(path)]
+
+
+def sync():
+    for path in out_of_sync_files():
+        source = synced_source(read_file(path))
+        with open(path, "w") as file:
+            file.write(source)
+        print(f"Synced {os.path.relpath(path, REPOSITORY_PATH)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--check", action="store_true", help="only list main.py files out of sync")
+    args = parser.parse_args()
+
+    if args.check:
+        paths = out_of_sync_files()
+        for path in paths:
+            print(f"Out of sync: {os.path.relpath(path, REPOSITORY_PATH)}")
+        sys.exit(1 if paths else 0)
+    sync()
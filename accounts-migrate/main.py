@@ -2,6 +2,7 @@ import os
 import sqlalchemy
 import base64
 import json
+import threading
 import time
 from enum import Enum
 from sqlalchemy import create_engine, Table, MetaData, Column, or_, exists, and_
@@ -36,16 +37,104 @@ else:
 
 
 # region database connectivity
+# shared: _build/shared/database_connectivity.py, edit it there and run `python _build/sync_shared.py`
+# Database driver: pg8000 (pure Python) or psycopg2 (libpq, faster with large results)
+DB_DRIVER = os.getenv("DB_DRIVER", "pg8000")
+
+# Connection pool of the function instance, kept between invocations of a warm instance.
+# An instance handles one request at a time, which checks out at most 2 connections at once (nested `db.connect()`),
+# the overflow covers deeper nesting.  Pools are small on purpose: every instance of every function keeps its own
+# pool against the connection limit of the Cloud SQL instance, SQLAlchemy defaults would allow 15 per instance.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 2))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 2))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# Disabled with 0
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 0))
+# Checkouts waiting for a connection longer than that are logged
+DB_SLOW_CHECKOUT_MS = float(os.getenv("DB_SLOW_CHECKOUT_MS", 100))
+
+# Connection checkouts of the instance: count, total and longest wait for a connection
+db_pool_metrics = dict(checkouts=0, wait_seconds=0.0, max_wait_seconds=0.0)
+
+
+class TimedQueuePool(sqlalchemy.pool.QueuePool):
+    """Queue pool measuring how long checkouts wait for a free connection, see `db_pool_metrics`.
+
+    Only the wait for the pool is measured: opening a new connection and the pre-ping are not part of it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._checkout_timing = threading.local()
+
+    def _do_get(self):
+        timing = self._checkout_timing
+        if getattr(timing, "started", None) is not None:
+            # QueuePool retries a checkout by calling `_do_get` again, which is part of the same wait
+            return super()._do_get()
+
+        timing.started = time.perf_counter()
+        timing.connect_seconds = 0.0
+        try:
+            connection_record = super()._do_get()
+            wait_seconds = time.perf_counter() - timing.started - timing.connect_seconds
+        finally:
+            timing.started = None
+
+        db_pool_metrics["checkouts"] += 1
+        db_pool_metrics["wait_seconds"] += wait_seconds
+        db_pool_metrics["max_wait_seconds"] = max(db_pool_metrics["max_wait_seconds"], wait_seconds)
+        if wait_seconds * 1000 >= DB_SLOW_CHECKOUT_MS:
+            print(f"Slow DB connection checkout: {wait_seconds * 1000:.0f} ms, {self.status()}, {db_pool_metrics}")
+
+        return connection_record
+
+    def _create_connection(self):
+        started = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            if getattr(self._checkout_timing, "started", None) is not None:
+                self._checkout_timing.connect_seconds += time.perf_counter() - started
+
+
+def set_statement_timeout(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"SET statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+    cursor.close()
+    # Keep the setting when the pool rolls the connection back
+    dbapi_connection.commit()
+
+
+def register_enum_adapters(*enum_classes):
+    """Make psycopg2 send members of `enum_classes` as their values, like pg8000 does.
+
+    Called once on import, with the status enums of the function.
+    """
+    if DB_DRIVER != "psycopg2":
+        return
+
+    import psycopg2.extensions
+
+    for enum_class in enum_classes:
+        psycopg2.extensions.register_adapter(enum_class, lambda member: psycopg2.extensions.adapt(member.value))
+
+
 def create_db_engine():
     db_config = {
-        "drivername": "postgresql+pg8000",
+        "drivername": f"postgresql+{DB_DRIVER}",
     }
     if not running_locally:
         db_connection_name = os.environ["DB_CONNECTION_NAME"]
+        if DB_DRIVER == "psycopg2":
+            # libpq expects the directory of the socket
+            socket_query = {"host": f"/cloudsql/{db_connection_name}"}
+        else:
+            socket_query = {"unix_sock": f"/cloudsql/{db_connection_name}/.s.PGSQL.5432"}
         db_config |= {
-            "query": dict(
-                {"unix_sock": f"/cloudsql/{db_connection_name}/.s.PGSQL.5432"}
-            ),
+            "query": dict(socket_query),
             "database": configuration_context["DB_NAME"],
             "username": configuration_context["DB_USER"],
             "password": configuration_context["DB_PASS"],
@@ -60,11 +149,34 @@ def create_db_engine():
         }
     pool = create_engine(
         sqlalchemy.engine.url.URL.create(**db_config),
+        poolclass=TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
     )
     pool.dialect.description_encoding = None
+    if DB_STATEMENT_TIMEOUT_MS > 0:
+        sqlalchemy.event.listen(pool, "connect", set_statement_timeout)
     return pool
 
 
+# Rows fetched from a server-side cursor per round trip, see `stream_rows`
+DB_FETCH_SIZE = int(os.getenv("DB_FETCH_SIZE", 1000))
+
+
+def stream_rows(db_connection, stmt, params=None, fetch_size=DB_FETCH_SIZE):
+    """Execute `stmt` on a server-side cursor and iterate its rows, fetching `fetch_size` rows at a time.
+
+    The result set is never materialized as a whole, so memory is bounded by `fetch_size`.
+    Must be called within a transaction; other statements may be executed on `db_connection` meanwhile.
+    """
+    result = db_connection.execution_options(stream_results=True).execute(stmt, params or {})
+    return result.yield_per(fetch_size)
+# endshared
+
+
 db = create_db_engine()
 # endregion
 
@@ -81,6 +193,9 @@ class AccountsStatus(Enum):
     MOD_REJECTED = "045"
     DEFAULT = "055"
     MOD_ACCEPTED = "065"
+
+
+register_enum_adapters(AccountsStatus)
 # endregion
 
 
@@ -96,11 +211,18 @@ def fnc_target(event, context):
 
 
 # region Database data models
+# Tables reflected so far by (engine, table name), see `create_table_mapping`
+table_mappings = {}
+
+
 def create_table_mapping(db_pool, db_table_name):
-    meta = MetaData(db_pool)
-    tbl = Table(db_table_name, meta, autoload=True, autoload_with=db_pool)
+    """Return table `db_table_name` of `db_pool`.  A table is reflected once per process, then reused."""
+    key = (db_pool, db_table_name)
+    if key not in table_mappings:
+        meta = MetaData(db_pool)
+        table_mappings[key] = Table(db_table_name, meta, autoload=True, autoload_with=db_pool)
 
-    return tbl
+    return table_mappings[key]
 # endregion
 
 
@@ -122,7 +244,7 @@ def update_hosts_with_accounts(db_pool):
 
     with db.connect() as conn:
         with conn.begin():
-            accounts = conn.execute(sel_accounts)
+            accounts = stream_rows(conn, sel_accounts)
 
             for account in accounts:
                 # find hosts with fnc_accounts_id=NULL and with email and phone_num matching accounts.email and accounts.phone_num
@@ -176,7 +298,7 @@ def update_guests_with_accounts(db_pool):
 
     with db.connect() as conn:
         with conn.begin():
-            accounts = conn.execute(sel_accounts)
+            accounts = stream_rows(conn, sel_accounts)
 
             for account in accounts:
                 # find guests with fnc_accounts_id=NULL and with email and phone_num matching accounts.email and accounts.phone_num
@@ -60,8 +60,16 @@ CREATE TABLE IF NOT EXISTS guests (
     ,is_with_elderly VARCHAR
     ,is_ukrainian_nationality VARCHAR
     ,duration_category VARCHAR
+    ,sampling_key DOUBLE PRECISION DEFAULT random() NOT NULL
+    ,fnc_ts_claimed VARCHAR(13)
 );
 
+CREATE INDEX guests_fnc_status_sampling_key_index
+    on guests (fnc_status, sampling_key);
+
+CREATE INDEX guests_fnc_status_db_guests_id_index
+    on guests (fnc_status, db_guests_id);
+
 
 CREATE TABLE IF NOT EXISTS hosts (
      db_hosts_id VARCHAR DEFAULT uuid_generate_v1mc() NOT NULL PRIMARY KEY	
@@ -90,6 +98,7 @@ CREATE TABLE IF NOT EXISTS hosts (
     ,duration_category VARCHAR
     ,transport_included VARCHAR
     ,can_be_verified VARCHAR
+    ,fnc_ts_claimed VARCHAR(13)
 );
 
 
@@ -103,9 +112,22 @@ CREATE TABLE IF NOT EXISTS matches (
     ,fnc_guest_status VARCHAR
 );
 
+CREATE INDEX matches_db_ts_matched_index
+    on matches (db_ts_matched);
+
 -- ALTER TABLE matches ADD CONSTRAINT fk_matches_guests_id FOREIGN KEY (fnc_guests_id) REFERENCES guests (db_guests_id);
 -- ALTER TABLE matches ADD CONSTRAINT fk_matches_hosts_id FOREIGN KEY (fnc_hosts_id) REFERENCES hosts (db_hosts_id);
 
+CREATE TABLE IF NOT EXISTS outbox (
+     db_outbox_id VARCHAR DEFAULT uuid_generate_v1mc() NOT NULL PRIMARY KEY
+    ,db_ts_created VARCHAR(13) DEFAULT FLOOR(EXTRACT(epoch FROM NOW())*1000)
+    ,topic VARCHAR NOT NULL
+    ,message VARCHAR NOT NULL
+);
+
+CREATE INDEX outbox_db_ts_created_index
+    on outbox (db_ts_created);
+
 CREATE OR REPLACE VIEW offers AS
 SELECT
     a.uid AS account_uid
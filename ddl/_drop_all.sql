@@ -6,6 +6,7 @@ DROP VIEW IF EXISTS v_accounts;
 DROP VIEW IF EXISTS v_guests;
 DROP VIEW IF EXISTS v_hosts;
 DROP VIEW IF EXISTS v_matches;
+DROP TABLE IF EXISTS outbox;
 DROP TABLE IF EXISTS matches;
 DROP TABLE IF EXISTS guests;
 DROP TABLE IF EXISTS hosts;
@@ -40,7 +40,15 @@ CREATE TABLE IF NOT EXISTS guests (
     ,is_with_elderly VARCHAR
     ,is_ukrainian_nationality VARCHAR
     ,duration_category VARCHAR
+    ,sampling_key DOUBLE PRECISION DEFAULT random() NOT NULL
+    ,fnc_ts_claimed VARCHAR(13)
 );
+
+CREATE INDEX guests_fnc_status_sampling_key_index
+    on guests (fnc_status, sampling_key);
+
+CREATE INDEX guests_fnc_status_db_guests_id_index
+    on guests (fnc_status, db_guests_id);
 DROP TABLE IF EXISTS hosts;
 
 CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
@@ -71,6 +79,7 @@ CREATE TABLE IF NOT EXISTS hosts (
     ,duration_category VARCHAR
     ,transport_included VARCHAR
     ,can_be_verified VARCHAR
+    ,fnc_ts_claimed VARCHAR(13)
 );DROP TABLE IF EXISTS matches;
 
 CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
@@ -85,8 +94,24 @@ CREATE TABLE IF NOT EXISTS matches (
     ,fnc_guest_status VARCHAR
 );
 
+CREATE INDEX matches_db_ts_matched_index
+    on matches (db_ts_matched);
+
 -- ALTER TABLE matches ADD CONSTRAINT fk_matches_guests_id FOREIGN KEY (fnc_guests_id) REFERENCES guests (db_guests_id);
 -- ALTER TABLE matches ADD CONSTRAINT fk_matches_hosts_id FOREIGN KEY (fnc_hosts_id) REFERENCES hosts (db_hosts_id);
+DROP TABLE IF EXISTS outbox;
+
+CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
+
+CREATE TABLE IF NOT EXISTS outbox (
+     db_outbox_id VARCHAR DEFAULT uuid_generate_v1mc() NOT NULL PRIMARY KEY
+    ,db_ts_created VARCHAR(13) DEFAULT FLOOR(EXTRACT(epoch FROM NOW())*1000)
+    ,topic VARCHAR NOT NULL
+    ,message VARCHAR NOT NULL
+);
+
+CREATE INDEX outbox_db_ts_created_index
+    on outbox (db_ts_created);
 DROP VIEW IF EXISTS offers;
 
 CREATE OR REPLACE VIEW offers AS
@@ -0,0 +1,7 @@
+-- Add guests_fnc_status_db_guests_id_index to an existing guests table, see EXPIRED_GUESTS_PAGE_QUERY of
+-- guests-inactivity-timeout.
+-- CONCURRENTLY builds the index without blocking writes to guests.  It cannot run inside a transaction block,
+-- so run this file on its own, e.g. with psql.  If the build fails, drop the invalid index and run the file again.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS guests_fnc_status_db_guests_id_index
+    on guests (fnc_status, db_guests_id);
@@ -0,0 +1,8 @@
+-- Add sampling_key to an existing guests table, see claim_sampled_listings of matches-create.
+-- random() is volatile, so adding the column rewrites the table and gives every existing guest a key of its own.
+-- Both statements lock the guests table, run them while matches-create is stopped.
+
+ALTER TABLE guests ADD COLUMN IF NOT EXISTS sampling_key DOUBLE PRECISION DEFAULT random() NOT NULL;
+
+CREATE INDEX IF NOT EXISTS guests_fnc_status_sampling_key_index
+    on guests (fnc_status, sampling_key);
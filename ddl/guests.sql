@@ -21,4 +21,12 @@ CREATE TABLE IF NOT EXISTS guests (
     ,is_with_elderly VARCHAR
     ,is_ukrainian_nationality VARCHAR
     ,duration_category VARCHAR
+    ,sampling_key DOUBLE PRECISION DEFAULT random() NOT NULL
+    ,fnc_ts_claimed VARCHAR(13)
 );
+
+CREATE INDEX guests_fnc_status_sampling_key_index
+    on guests (fnc_status, sampling_key);
+
+CREATE INDEX guests_fnc_status_db_guests_id_index
+    on guests (fnc_status, db_guests_id);
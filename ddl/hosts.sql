@@ -29,4 +29,5 @@ CREATE TABLE IF NOT EXISTS hosts (
     ,duration_category VARCHAR
     ,transport_included VARCHAR
     ,can_be_verified VARCHAR
+    ,fnc_ts_claimed VARCHAR(13)
 );
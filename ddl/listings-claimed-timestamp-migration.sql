@@ -0,0 +1,6 @@
+-- Add fnc_ts_claimed to existing hosts and guests tables, see release_stale_claims of matches-create.
+-- The columns are nullable without a default, so adding them does not rewrite the tables.
+
+ALTER TABLE hosts ADD COLUMN IF NOT EXISTS fnc_ts_claimed VARCHAR(13);
+
+ALTER TABLE guests ADD COLUMN IF NOT EXISTS fnc_ts_claimed VARCHAR(13);
@@ -0,0 +1,6 @@
+-- Add matches_db_ts_matched_index to an existing matches table, see RECENT_ACTIVITY_QUERY of matches-create.
+-- CONCURRENTLY builds the index without blocking writes to matches.  It cannot run inside a transaction block,
+-- so run this file on its own, e.g. with psql.  If the build fails, drop the invalid index and run the file again.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS matches_db_ts_matched_index
+    on matches (db_ts_matched);
@@ -12,5 +12,8 @@ CREATE TABLE IF NOT EXISTS matches (
     ,fnc_guest_status VARCHAR
 );
 
+CREATE INDEX matches_db_ts_matched_index
+    on matches (db_ts_matched);
+
 -- ALTER TABLE matches ADD CONSTRAINT fk_matches_guests_id FOREIGN KEY (fnc_guests_id) REFERENCES guests (db_guests_id);
 -- ALTER TABLE matches ADD CONSTRAINT fk_matches_hosts_id FOREIGN KEY (fnc_hosts_id) REFERENCES hosts (db_hosts_id);
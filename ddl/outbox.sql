@@ -0,0 +1,13 @@
+DROP TABLE IF EXISTS outbox;
+
+CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
+
+CREATE TABLE IF NOT EXISTS outbox (
+     db_outbox_id VARCHAR DEFAULT uuid_generate_v1mc() NOT NULL PRIMARY KEY
+    ,db_ts_created VARCHAR(13) DEFAULT FLOOR(EXTRACT(epoch FROM NOW())*1000)
+    ,topic VARCHAR NOT NULL
+    ,message VARCHAR NOT NULL
+);
+
+CREATE INDEX outbox_db_ts_created_index
+    on outbox (db_ts_created);
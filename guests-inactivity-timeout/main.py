@@ -2,12 +2,11 @@ import os
 import sqlalchemy
 import base64
 import json
+import threading
 import time
 
 from enum import Enum
 
-import i18n
-
 from sqlalchemy import create_engine
 from sqlalchemy import Table
 from sqlalchemy import MetaData
@@ -45,16 +44,104 @@ else:
 
 
 # region database connectivity
+# shared: _build/shared/database_connectivity.py, edit it there and run `python _build/sync_shared.py`
+# Database driver: pg8000 (pure Python) or psycopg2 (libpq, faster with large results)
+DB_DRIVER = os.getenv("DB_DRIVER", "pg8000")
+
+# Connection pool of the function instance, kept between invocations of a warm instance.
+# An instance handles one request at a time, which checks out at most 2 connections at once (nested `db.connect()`),
+# the overflow covers deeper nesting.  Pools are small on purpose: every instance of every function keeps its own
+# pool against the connection limit of the Cloud SQL instance, SQLAlchemy defaults would allow 15 per instance.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 2))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 2))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# Disabled with 0
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 0))
+# Checkouts waiting for a connection longer than that are logged
+DB_SLOW_CHECKOUT_MS = float(os.getenv("DB_SLOW_CHECKOUT_MS", 100))
+
+# Connection checkouts of the instance: count, total and longest wait for a connection
+db_pool_metrics = dict(checkouts=0, wait_seconds=0.0, max_wait_seconds=0.0)
+
+
+class TimedQueuePool(sqlalchemy.pool.QueuePool):
+    """Queue pool measuring how long checkouts wait for a free connection, see `db_pool_metrics`.
+
+    Only the wait for the pool is measured: opening a new connection and the pre-ping are not part of it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._checkout_timing = threading.local()
+
+    def _do_get(self):
+        timing = self._checkout_timing
+        if getattr(timing, "started", None) is not None:
+            # QueuePool retries a checkout by calling `_do_get` again, which is part of the same wait
+            return super()._do_get()
+
+        timing.started = time.perf_counter()
+        timing.connect_seconds = 0.0
+        try:
+            connection_record = super()._do_get()
+            wait_seconds = time.perf_counter() - timing.started - timing.connect_seconds
+        finally:
+            timing.started = None
+
+        db_pool_metrics["checkouts"] += 1
+        db_pool_metrics["wait_seconds"] += wait_seconds
+        db_pool_metrics["max_wait_seconds"] = max(db_pool_metrics["max_wait_seconds"], wait_seconds)
+        if wait_seconds * 1000 >= DB_SLOW_CHECKOUT_MS:
+            print(f"Slow DB connection checkout: {wait_seconds * 1000:.0f} ms, {self.status()}, {db_pool_metrics}")
+
+        return connection_record
+
+    def _create_connection(self):
+        started = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            if getattr(self._checkout_timing, "started", None) is not None:
+                self._checkout_timing.connect_seconds += time.perf_counter() - started
+
+
+def set_statement_timeout(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"SET statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+    cursor.close()
+    # Keep the setting when the pool rolls the connection back
+    dbapi_connection.commit()
+
+
+def register_enum_adapters(*enum_classes):
+    """Make psycopg2 send members of `enum_classes` as their values, like pg8000 does.
+
+    Called once on import, with the status enums of the function.
+    """
+    if DB_DRIVER != "psycopg2":
+        return
+
+    import psycopg2.extensions
+
+    for enum_class in enum_classes:
+        psycopg2.extensions.register_adapter(enum_class, lambda member: psycopg2.extensions.adapt(member.value))
+
+
 def create_db_engine():
     db_config = {
-        "drivername": "postgresql+pg8000",
+        "drivername": f"postgresql+{DB_DRIVER}",
     }
     if not running_locally:
         db_connection_name = os.environ["DB_CONNECTION_NAME"]
+        if DB_DRIVER == "psycopg2":
+            # libpq expects the directory of the socket
+            socket_query = {"host": f"/cloudsql/{db_connection_name}"}
+        else:
+            socket_query = {"unix_sock": f"/cloudsql/{db_connection_name}/.s.PGSQL.5432"}
         db_config |= {
-            "query": dict(
-                {"unix_sock": f"/cloudsql/{db_connection_name}/.s.PGSQL.5432"}
-            ),
+            "query": dict(socket_query),
             "database": configuration_context["DB_NAME"],
             "username": configuration_context["DB_USER"],
             "password": configuration_context["DB_PASS"],
@@ -69,24 +156,103 @@ def create_db_engine():
         }
     pool = create_engine(
         sqlalchemy.engine.url.URL.create(**db_config),
+        poolclass=TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
     )
     pool.dialect.description_encoding = None
+    if DB_STATEMENT_TIMEOUT_MS > 0:
+        sqlalchemy.event.listen(pool, "connect", set_statement_timeout)
     return pool
 
 
+# Rows fetched from a server-side cursor per round trip, see `stream_rows`
+DB_FETCH_SIZE = int(os.getenv("DB_FETCH_SIZE", 1000))
+
+
+def stream_rows(db_connection, stmt, params=None, fetch_size=DB_FETCH_SIZE):
+    """Execute `stmt` on a server-side cursor and iterate its rows, fetching `fetch_size` rows at a time.
+
+    The result set is never materialized as a whole, so memory is bounded by `fetch_size`.
+    Must be called within a transaction; other statements may be executed on `db_connection` meanwhile.
+    """
+    result = db_connection.execution_options(stream_results=True).execute(stmt, params or {})
+    return result.yield_per(fetch_size)
+# endshared
+
+
 db = create_db_engine()
+
 # endregion
 
 
 # region i18n initialisation
 TRANSLATIONS_FILE_PATH = './locale'
+TRANSLATIONS_FALLBACK_LOCALE = 'en'
+
+# Keys of all translations of the notifications: SendGrid template ids
+TRANSLATION_KEYS = [
+    "sendgrid.MatchTimeout",
+]
+
+# shared: _build/shared/translations.py, edit it there and run `python _build/sync_shared.py`
+# Translations of TRANSLATION_KEYS by locale, see `query_translations`
+translation_tables = {}
+
+
+def flatten_translations(translations, key_prefix=""):
+    """Return nested `translations` of a locale file by dotted key, e.g. "sendgrid.MatchTimeout"."""
+    flat_translations = {}
+    for key, value in translations.items():
+        if isinstance(value, dict):
+            flat_translations |= flatten_translations(value, f"{key_prefix}{key}.")
+        else:
+            flat_translations[f"{key_prefix}{key}"] = value
+
+    return flat_translations
+
+
+def load_translations(locale):
+    """Return all translations of `locale` by dotted key, or nothing if there is no file of the locale.
 
-i18n.set('fallback', 'en')
-i18n.set('filename_format', '{locale}.{format}')
-i18n.set('skip_locale_root_data', True)
-i18n.load_path.append(TRANSLATIONS_FILE_PATH)
+    `<locale>.json` precompiled at deployment is read if present, `<locale>.yml` is parsed otherwise.
+    """
+    file_names = os.listdir(TRANSLATIONS_FILE_PATH)
+    if f"{locale}.json" in file_names:
+        with open(os.path.join(TRANSLATIONS_FILE_PATH, f"{locale}.json"), encoding="utf-8") as translations_file:
+            return json.load(translations_file)
+    elif f"{locale}.yml" in file_names:
+        import yaml
 
-print(f'i18n initialised - configuration={i18n.load_path}')
+        with open(os.path.join(TRANSLATIONS_FILE_PATH, f"{locale}.yml"), encoding="utf-8") as translations_file:
+            return flatten_translations(yaml.safe_load(translations_file))
+    else:
+        return {}
+
+
+def query_translations(locale):
+    """Return translations of `TRANSLATION_KEYS` to `locale` by key.
+
+    A locale is loaded on its first use, only its translations of `TRANSLATION_KEYS` are kept for the process.
+    Keys missing in the locale are translated to TRANSLATIONS_FALLBACK_LOCALE, or left as they are.
+    """
+    if locale not in translation_tables:
+        if locale != TRANSLATIONS_FALLBACK_LOCALE:
+            fallback_translations = query_translations(TRANSLATIONS_FALLBACK_LOCALE)
+        else:
+            fallback_translations = {}
+
+        translations = load_translations(locale)
+        translation_tables[locale] = {
+            key: translations.get(key, fallback_translations.get(key, key)) for key in TRANSLATION_KEYS
+        }
+        print(f"Translations of locale={locale} loaded")
+
+    return translation_tables[locale]
+# endshared
 # endregion
 
 
@@ -101,15 +267,23 @@ class HostsGuestsStatus(Enum):
     MATCH_ACCEPTED = "095"
 
 
+register_enum_adapters(HostsGuestsStatus)
 # endregion
 
 
 # region Database data models
+# Tables reflected so far by (engine, table name), see `create_table_mapping`
+table_mappings = {}
+
+
 def create_table_mapping(db_pool, db_table_name):
-    meta = MetaData(db_pool)
-    tbl = Table(db_table_name, meta, autoload=True, autoload_with=db_pool)
+    """Return table `db_table_name` of `db_pool`.  A table is reflected once per process, then reused."""
+    key = (db_pool, db_table_name)
+    if key not in table_mappings:
+        meta = MetaData(db_pool)
+        table_mappings[key] = Table(db_table_name, meta, autoload=True, autoload_with=db_pool)
 
-    return tbl
+    return table_mappings[key]
 # endregion
 
 
@@ -135,7 +309,7 @@ def create_payload_for_match_timeout_template(
         f"preparing payload with context for 'MatchTimeout' SendGrid template, preferred_lang={preferred_lang}"
     )
 
-    template_id = i18n.t("sendgrid.MatchTimeout", locale=preferred_lang)
+    template_id = query_translations(preferred_lang)["sendgrid.MatchTimeout"]
 
     context = {
         "name": row["name"],
@@ -150,24 +324,18 @@ def create_payload_for_match_timeout_template(
 
 
 # region utility functions
-def check_expired_in_hours(str_epoch, timeout_hours):
-    now = int(time.time() * 1000)
+def query_expiry_epoch(timeout_hours):
+    """Return epoch (in milliseconds, as in `db_ts_registered`) of the newest guest expired after `timeout_hours`.
 
-    int_epoch = int(str_epoch)
-
-    delta = now - int_epoch
-    delta_in_hours = int(delta / 1000 / 3600)
+    A guest is expired once `timeout_hours` full hours have passed since its registration.
+    """
+    now = int(time.time() * 1000)
 
-    return delta_in_hours > int(timeout_hours)
+    return str(now - (int(timeout_hours) + 1) * 3600 * 1000)
 # endregion
 
 
 # region integration utilities
-
-# Instantiates a Pub/Sub client
-publisher = pubsub_v1.PublisherClient()
-
-
 def fnc_target(event, context):
     if not running_locally:
         pubsub_msg = json.loads(base64.b64decode(event["data"]).decode("utf-8"))
@@ -183,61 +351,150 @@ def fnc_target(event, context):
 
 
 # region integration utilities
-def fnc_publish_message(message):
-    topic_name = os.environ["SEND_EMAIL_TOPIC"]
-    topic_path = publisher.topic_path(os.environ["PROJECT_ID"], topic_name)
+# shared: _build/shared/pubsub_publishing.py, edit it there and run `python _build/sync_shared.py`
+# Messages are batched by the client, up to PUBSUB_MAX_IN_FLIGHT_MESSAGES are published without waiting
+PUBSUB_MAX_BATCH_MESSAGES = int(os.getenv("PUBSUB_MAX_BATCH_MESSAGES", 100))
+PUBSUB_MAX_BATCH_LATENCY_SECONDS = float(os.getenv("PUBSUB_MAX_BATCH_LATENCY_SECONDS", 0.05))
+PUBSUB_MAX_IN_FLIGHT_MESSAGES = int(os.getenv("PUBSUB_MAX_IN_FLIGHT_MESSAGES", 1000))
+
+# Instantiates a Pub/Sub client
+publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(
+        max_messages=PUBSUB_MAX_BATCH_MESSAGES,
+        max_latency=PUBSUB_MAX_BATCH_LATENCY_SECONDS,
+    )
+)
+
+# (future, topic name, message) of messages published and not confirmed yet
+in_flight_messages = []
+
+# Messages are written to the outbox table in the transaction changing the statuses they notify about,
+# instead of being published from within the transaction.  Only for functions calling `flush_messages`.
+NOTIFICATIONS_OUTBOX = os.getenv("NOTIFICATIONS_OUTBOX", "false").lower() == "true"
+OUTBOX_INSERT_CHUNK_SIZE = 1000
+# Messages of the current transaction to be written to the outbox table, see `flush_messages`
+outbox_messages = []
 
+
+def publish_message(topic_name, message):
+    """Publish `message` to `topic_name` without waiting for it, or keep it for the outbox.  See `flush_messages`."""
     message_json = json.dumps(message)
+    if NOTIFICATIONS_OUTBOX:
+        outbox_messages.append(dict(topic=topic_name, message=message_json))
+        return "Message stored."
+
+    if len(in_flight_messages) >= PUBSUB_MAX_IN_FLIGHT_MESSAGES:
+        wait_for_published_messages()
+
+    topic_path = publisher.topic_path(os.environ["PROJECT_ID"], topic_name)
     message_bytes = message_json.encode("utf-8")
 
     try:
         publish_future = publisher.publish(topic_path, data=message_bytes)
-        publish_future.result()  # Verify the publish succeeded
+        in_flight_messages.append((publish_future, topic_name, message_json))
         return "Message published."
     except Exception as e:
-        print(e)
+        print(f"Publishing to {topic_name} failed: {e}, message={message_json}")
         return (e, 500)
+
+
+def wait_for_published_messages():
+    """Wait until all messages in flight are published.  Return the number of messages which failed."""
+    failed = 0
+    for publish_future, topic_name, message_json in in_flight_messages:
+        try:
+            publish_future.result()  # Verify the publish succeeded
+        except Exception as e:
+            print(f"Publishing to {topic_name} failed: {e}, message={message_json}")
+            failed += 1
+
+    print(f"Published {len(in_flight_messages) - failed} messages, {failed} failed")
+    in_flight_messages.clear()
+    return failed
+
+
+def flush_messages(db_connection):
+    """Send messages of the current transaction of `db_connection`, before it commits.
+
+    Messages kept for the outbox are written to the outbox table in that transaction and published
+    later by the outbox-relay function.  Otherwise, messages published directly are waited for.
+    """
+    if len(outbox_messages) > 0:
+        tbl_outbox = sqlalchemy.table(
+            os.environ["OUTBOX_TABLE_NAME"], sqlalchemy.column("topic"), sqlalchemy.column("message")
+        )
+        for chunk_start in range(0, len(outbox_messages), OUTBOX_INSERT_CHUNK_SIZE):
+            db_connection.execute(
+                tbl_outbox.insert().values(outbox_messages[chunk_start:chunk_start + OUTBOX_INSERT_CHUNK_SIZE])
+            )
+        print(f"Stored {len(outbox_messages)} messages in {os.environ['OUTBOX_TABLE_NAME']}")
+        outbox_messages.clear()
+
+    wait_for_published_messages()
+# endshared
+
+
+def fnc_publish_message(message):
+    return publish_message(os.environ["SEND_EMAIL_TOPIC"], message)
 # endregion
 
 
 # region data mutation services
-def change_guests_status(db_guests_id, target_status, db_conn):
-    tbl_guests_name = os.environ["GUESTS_TABLE_NAME"]
-    # tbl_guests_name = "guests"
-    tbl_guests = create_table_mapping(db_pool=db, db_table_name=tbl_guests_name)
-
-    change_guests_status = (
-        tbl_guests.update()
-            .where(tbl_guests.c.db_guests_id == db_guests_id)
-            .values(fnc_status=target_status)
-    )
+# Ids of a page of expired guests.  Guests are paged by id (keyset pagination, see
+# guests_fnc_status_db_guests_id_index); epochs in db_ts_registered have 13 digits, so they compare as strings
+EXPIRED_GUESTS_PAGE_QUERY = sqlalchemy.text(
+    f"SELECT db_guests_id FROM guests WHERE fnc_status = '{HostsGuestsStatus.MOD_ACCEPTED.value}' AND db_ts_registered <= :expired_before AND db_guests_id > :after_id ORDER BY db_guests_id LIMIT :page_size;"
+)
 
-    result = db_conn.execute(change_guests_status)
 
-    print(f"changed status of db_guests_id={db_guests_id} to fnc_status={target_status} with result={result}")
+# Makes guests of a page inactive, except those locked by other transactions, returning data for the notifications
+INACTIVATE_GUESTS_PAGE_QUERY = sqlalchemy.text(
+    f"WITH page AS (SELECT db_guests_id FROM guests WHERE db_guests_id = ANY(CAST(:page_ids AS VARCHAR[])) AND fnc_status = '{HostsGuestsStatus.MOD_ACCEPTED.value}' FOR UPDATE SKIP LOCKED), "
+    f"inactive_guests AS (UPDATE guests SET fnc_status = '{HostsGuestsStatus.FNC_INACTIVE.value}' FROM page WHERE guests.db_guests_id = page.db_guests_id RETURNING guests.*) "
+    f"SELECT gue.db_guests_id, gue.db_ts_registered, gue.fnc_accounts_id, gue.fnc_status, gue.country, gue.city, gue.acceptable_shelter_types, gue.beds, gue.group_relation, gue.is_pregnant, gue.is_with_disability, gue.is_with_animal, gue.is_with_elderly, gue.is_ukrainian_nationality, gue.duration_category, coalesce(acc.phone_num, gue.phone_num) as phone_num, coalesce(acc.email, gue.email) as email, coalesce(acc.name, gue.name) as name, coalesce(acc.preferred_lang, 'uk') as preferred_lang, coalesce(acc.sms_notification, 'FALSE') as sms_notification FROM inactive_guests gue LEFT JOIN accounts acc ON gue.fnc_accounts_id = acc.db_accounts_id ORDER BY gue.db_guests_id;"
+)
 
 
-def postgres_process_timeout():
-    print("postgres_process_timeout: tbl_guests")
-    tbl_guests = create_table_mapping(db_pool=db, db_table_name=os.environ["GUESTS_TABLE_NAME"])
+def inactivate_guests_page(expired_before, after_id, page_size, db_conn):
+    """Make up to `page_size` guests registered before `expired_before` inactive, starting after id `after_id`.
 
-    print("postgres_process_timeout: sel_guests")
+    Guests locked by other transactions are skipped.  Return rows of the guests made inactive, ordered by id,
+    and the last id of the page, None if no expired guests are left after `after_id`.
+    """
+    page_ids = db_conn.execute(
+        EXPIRED_GUESTS_PAGE_QUERY,
+        dict(expired_before=expired_before, after_id=after_id, page_size=page_size),
+    ).scalars().all()
+    if len(page_ids) == 0:
+        return [], None
 
-    sel_guests = sqlalchemy.text(
-        f"SELECT gue.db_guests_id, gue.db_ts_registered, gue.fnc_accounts_id, gue.fnc_status, gue.country, gue.city, gue.acceptable_shelter_types, gue.beds, gue.group_relation, gue.is_pregnant, gue.is_with_disability, gue.is_with_animal, gue.is_with_elderly, gue.is_ukrainian_nationality, duration_category, coalesce(acc.phone_num, gue.phone_num) as phone_num, coalesce(acc.email, gue.email) as email, coalesce(acc.name, gue.name) as name, coalesce(acc.preferred_lang, 'uk') as preferred_lang, coalesce(acc.sms_notification, 'FALSE') as sms_notification FROM guests gue LEFT JOIN accounts acc ON gue.fnc_accounts_id = acc.db_accounts_id WHERE gue.fnc_status = '065' LIMIT 4000;"
-    ) #TODO refactor to use sqlalchemy-specific syntax
+    result = db_conn.execute(INACTIVATE_GUESTS_PAGE_QUERY, dict(page_ids=page_ids))
+    inactive_rows = result.fetchall()
+
+    print(f"changed status of {len(inactive_rows)} guests to fnc_status={HostsGuestsStatus.FNC_INACTIVE}")
+    return inactive_rows, page_ids[-1]
 
-    print("Timeout value: ", int(configuration_context["GUESTS_TIMEOUT_HOURS"]))
-    with db.connect() as conn:
-        with conn.begin():
-            result = conn.execute(sel_guests)
 
-            for guest_row in result:
-                print(f"processing GUEST {guest_row}")
+def postgres_process_timeout():
+    GUESTS_INACTIVITY_PAGE_SIZE = int(configuration_context.get("GUESTS_INACTIVITY_PAGE_SIZE", 1000))
+
+    print("Timeout value: ", int(configuration_context["GUESTS_TIMEOUT_HOURS"]))
+    expired_before = query_expiry_epoch(configuration_context["GUESTS_TIMEOUT_HOURS"])
+
+    # Every page is committed on its own, so locks are held briefly and a failed sweep keeps its progress
+    after_id = ""
+    while True:
+        with db.connect() as conn:
+            with conn.begin():
+                # Messages left by a transaction which failed in a previous invocation were never sent
+                outbox_messages.clear()
+                inactive_rows, page_end_id = inactivate_guests_page(
+                    expired_before, after_id, GUESTS_INACTIVITY_PAGE_SIZE, conn
+                )
+
+                for guest_row in inactive_rows:
+                    print(f"processing GUEST {guest_row}")
 
-                if check_expired_in_hours(
-                    guest_row["db_ts_registered"], configuration_context["GUESTS_TIMEOUT_HOURS"]
-                ):
                     message_for_guest = (
                         create_payload_for_match_timeout_template(
                             row=guest_row,
@@ -250,9 +507,12 @@ def postgres_process_timeout():
 
                     print(message_for_guest)
                     fnc_publish_message(message_for_guest)
-                    change_guests_status(db_guests_id=guest_row["db_guests_id"],
-                                        target_status=HostsGuestsStatus.FNC_INACTIVE,
-                                        db_conn=conn)
+
+                flush_messages(conn)
+
+        # Pages may be short or empty because of locked guests, the sweep ends when no expired guests are left
+        if page_end_id is None:
+            break
+        after_id = page_end_id
 
 # endregion
-  
\ No newline at end of file
@@ -1,4 +1,6 @@
 import os
+import threading
+import time
 import sqlalchemy
 import base64
 import json
@@ -33,16 +35,104 @@ else:
     load_dotenv()
 
 
+# shared: _build/shared/database_connectivity.py, edit it there and run `python _build/sync_shared.py`
+# Database driver: pg8000 (pure Python) or psycopg2 (libpq, faster with large results)
+DB_DRIVER = os.getenv("DB_DRIVER", "pg8000")
+
+# Connection pool of the function instance, kept between invocations of a warm instance.
+# An instance handles one request at a time, which checks out at most 2 connections at once (nested `db.connect()`),
+# the overflow covers deeper nesting.  Pools are small on purpose: every instance of every function keeps its own
+# pool against the connection limit of the Cloud SQL instance, SQLAlchemy defaults would allow 15 per instance.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 2))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 2))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# Disabled with 0
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 0))
+# Checkouts waiting for a connection longer than that are logged
+DB_SLOW_CHECKOUT_MS = float(os.getenv("DB_SLOW_CHECKOUT_MS", 100))
+
+# Connection checkouts of the instance: count, total and longest wait for a connection
+db_pool_metrics = dict(checkouts=0, wait_seconds=0.0, max_wait_seconds=0.0)
+
+
+class TimedQueuePool(sqlalchemy.pool.QueuePool):
+    """Queue pool measuring how long checkouts wait for a free connection, see `db_pool_metrics`.
+
+    Only the wait for the pool is measured: opening a new connection and the pre-ping are not part of it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._checkout_timing = threading.local()
+
+    def _do_get(self):
+        timing = self._checkout_timing
+        if getattr(timing, "started", None) is not None:
+            # QueuePool retries a checkout by calling `_do_get` again, which is part of the same wait
+            return super()._do_get()
+
+        timing.started = time.perf_counter()
+        timing.connect_seconds = 0.0
+        try:
+            connection_record = super()._do_get()
+            wait_seconds = time.perf_counter() - timing.started - timing.connect_seconds
+        finally:
+            timing.started = None
+
+        db_pool_metrics["checkouts"] += 1
+        db_pool_metrics["wait_seconds"] += wait_seconds
+        db_pool_metrics["max_wait_seconds"] = max(db_pool_metrics["max_wait_seconds"], wait_seconds)
+        if wait_seconds * 1000 >= DB_SLOW_CHECKOUT_MS:
+            print(f"Slow DB connection checkout: {wait_seconds * 1000:.0f} ms, {self.status()}, {db_pool_metrics}")
+
+        return connection_record
+
+    def _create_connection(self):
+        started = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            if getattr(self._checkout_timing, "started", None) is not None:
+                self._checkout_timing.connect_seconds += time.perf_counter() - started
+
+
+def set_statement_timeout(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"SET statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+    cursor.close()
+    # Keep the setting when the pool rolls the connection back
+    dbapi_connection.commit()
+
+
+def register_enum_adapters(*enum_classes):
+    """Make psycopg2 send members of `enum_classes` as their values, like pg8000 does.
+
+    Called once on import, with the status enums of the function.
+    """
+    if DB_DRIVER != "psycopg2":
+        return
+
+    import psycopg2.extensions
+
+    for enum_class in enum_classes:
+        psycopg2.extensions.register_adapter(enum_class, lambda member: psycopg2.extensions.adapt(member.value))
+
+
 def create_db_engine():
     db_config = {
-        "drivername": "postgresql+pg8000",
+        "drivername": f"postgresql+{DB_DRIVER}",
     }
     if not running_locally:
         db_connection_name = os.environ["DB_CONNECTION_NAME"]
+        if DB_DRIVER == "psycopg2":
+            # libpq expects the directory of the socket
+            socket_query = {"host": f"/cloudsql/{db_connection_name}"}
+        else:
+            socket_query = {"unix_sock": f"/cloudsql/{db_connection_name}/.s.PGSQL.5432"}
         db_config |= {
-            "query": dict(
-                {"unix_sock": f"/cloudsql/{db_connection_name}/.s.PGSQL.5432"}
-            ),
+            "query": dict(socket_query),
             "database": configuration_context["DB_NAME"],
             "username": configuration_context["DB_USER"],
             "password": configuration_context["DB_PASS"],
@@ -57,11 +147,34 @@ def create_db_engine():
         }
     pool = create_engine(
         sqlalchemy.engine.url.URL.create(**db_config),
+        poolclass=TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
     )
     pool.dialect.description_encoding = None
+    if DB_STATEMENT_TIMEOUT_MS > 0:
+        sqlalchemy.event.listen(pool, "connect", set_statement_timeout)
     return pool
 
 
+# Rows fetched from a server-side cursor per round trip, see `stream_rows`
+DB_FETCH_SIZE = int(os.getenv("DB_FETCH_SIZE", 1000))
+
+
+def stream_rows(db_connection, stmt, params=None, fetch_size=DB_FETCH_SIZE):
+    """Execute `stmt` on a server-side cursor and iterate its rows, fetching `fetch_size` rows at a time.
+
+    The result set is never materialized as a whole, so memory is bounded by `fetch_size`.
+    Must be called within a transaction; other statements may be executed on `db_connection` meanwhile.
+    """
+    result = db_connection.execution_options(stream_results=True).execute(stmt, params or {})
+    return result.yield_per(fetch_size)
+# endshared
+
+
 db = create_db_engine()
 
 
@@ -137,27 +250,94 @@ class ListingType(Enum):
 
 
 # region integration utilities
-def fnc_publish_message(message):
-    topic_name = os.environ["LISTING_DELETE_TOPIC"]
-    topic_path = publisher.topic_path(os.environ["PROJECT_ID"], topic_name)
+# shared: _build/shared/pubsub_publishing.py, edit it there and run `python _build/sync_shared.py`
+# Messages are batched by the client, up to PUBSUB_MAX_IN_FLIGHT_MESSAGES are published without waiting
+PUBSUB_MAX_BATCH_MESSAGES = int(os.getenv("PUBSUB_MAX_BATCH_MESSAGES", 100))
+PUBSUB_MAX_BATCH_LATENCY_SECONDS = float(os.getenv("PUBSUB_MAX_BATCH_LATENCY_SECONDS", 0.05))
+PUBSUB_MAX_IN_FLIGHT_MESSAGES = int(os.getenv("PUBSUB_MAX_IN_FLIGHT_MESSAGES", 1000))
+
+# Instantiates a Pub/Sub client
+publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(
+        max_messages=PUBSUB_MAX_BATCH_MESSAGES,
+        max_latency=PUBSUB_MAX_BATCH_LATENCY_SECONDS,
+    )
+)
+
+# (future, topic name, message) of messages published and not confirmed yet
+in_flight_messages = []
+
+# Messages are written to the outbox table in the transaction changing the statuses they notify about,
+# instead of being published from within the transaction.  Only for functions calling `flush_messages`.
+NOTIFICATIONS_OUTBOX = os.getenv("NOTIFICATIONS_OUTBOX", "false").lower() == "true"
+OUTBOX_INSERT_CHUNK_SIZE = 1000
+# Messages of the current transaction to be written to the outbox table, see `flush_messages`
+outbox_messages = []
+
 
+def publish_message(topic_name, message):
+    """Publish `message` to `topic_name` without waiting for it, or keep it for the outbox.  See `flush_messages`."""
     message_json = json.dumps(message)
+    if NOTIFICATIONS_OUTBOX:
+        outbox_messages.append(dict(topic=topic_name, message=message_json))
+        return "Message stored."
+
+    if len(in_flight_messages) >= PUBSUB_MAX_IN_FLIGHT_MESSAGES:
+        wait_for_published_messages()
+
+    topic_path = publisher.topic_path(os.environ["PROJECT_ID"], topic_name)
     message_bytes = message_json.encode("utf-8")
 
     try:
         publish_future = publisher.publish(topic_path, data=message_bytes)
-        publish_future.result()  # Verify the publish succeeded
+        in_flight_messages.append((publish_future, topic_name, message_json))
         return "Message published."
     except Exception as e:
-        print(e)
+        print(f"Publishing to {topic_name} failed: {e}, message={message_json}")
         return (e, 500)
 
 
-# endregion
+def wait_for_published_messages():
+    """Wait until all messages in flight are published.  Return the number of messages which failed."""
+    failed = 0
+    for publish_future, topic_name, message_json in in_flight_messages:
+        try:
+            publish_future.result()  # Verify the publish succeeded
+        except Exception as e:
+            print(f"Publishing to {topic_name} failed: {e}, message={message_json}")
+            failed += 1
+
+    print(f"Published {len(in_flight_messages) - failed} messages, {failed} failed")
+    in_flight_messages.clear()
+    return failed
+
+
+def flush_messages(db_connection):
+    """Send messages of the current transaction of `db_connection`, before it commits.
+
+    Messages kept for the outbox are written to the outbox table in that transaction and published
+    later by the outbox-relay function.  Otherwise, messages published directly are waited for.
+    """
+    if len(outbox_messages) > 0:
+        tbl_outbox = sqlalchemy.table(
+            os.environ["OUTBOX_TABLE_NAME"], sqlalchemy.column("topic"), sqlalchemy.column("message")
+        )
+        for chunk_start in range(0, len(outbox_messages), OUTBOX_INSERT_CHUNK_SIZE):
+            db_connection.execute(
+                tbl_outbox.insert().values(outbox_messages[chunk_start:chunk_start + OUTBOX_INSERT_CHUNK_SIZE])
+            )
+        print(f"Stored {len(outbox_messages)} messages in {os.environ['OUTBOX_TABLE_NAME']}")
+        outbox_messages.clear()
 
+    wait_for_published_messages()
+# endshared
 
-# Instantiates a Pub/Sub client
-publisher = pubsub_v1.PublisherClient()
+
+def fnc_publish_message(message):
+    return publish_message(os.environ["LISTING_DELETE_TOPIC"], message)
+
+
+# endregion
 
 
 def fnc_target(event, context):
@@ -168,6 +348,7 @@ def fnc_target(event, context):
 
     if listing_exists(pubsub_msg):
         fnc_publish_message({"user_id": pubsub_msg["listing_id"], "is_host": is_host})
+        wait_for_published_messages()
     else:
         raise ValueError(f'Provided listing "{pubsub_msg}" does not exist')
 
@@ -2,6 +2,7 @@ import os
 import sqlalchemy
 import base64
 import json
+import threading
 import time
 
 from enum import Enum
@@ -15,8 +16,6 @@ from sqlalchemy.dialects.postgresql import *
 from sqlalchemy import join
 from sqlalchemy import select
 
-import i18n
-
 from google.cloud import pubsub_v1
 from google.cloud import secretmanager
 from dotenv import load_dotenv
@@ -47,16 +46,104 @@ else:
 
 
 # region Database connectivity initialisation
+# shared: _build/shared/database_connectivity.py, edit it there and run `python _build/sync_shared.py`
+# Database driver: pg8000 (pure Python) or psycopg2 (libpq, faster with large results)
+DB_DRIVER = os.getenv("DB_DRIVER", "pg8000")
+
+# Connection pool of the function instance, kept between invocations of a warm instance.
+# An instance handles one request at a time, which checks out at most 2 connections at once (nested `db.connect()`),
+# the overflow covers deeper nesting.  Pools are small on purpose: every instance of every function keeps its own
+# pool against the connection limit of the Cloud SQL instance, SQLAlchemy defaults would allow 15 per instance.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 2))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 2))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# Disabled with 0
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 0))
+# Checkouts waiting for a connection longer than that are logged
+DB_SLOW_CHECKOUT_MS = float(os.getenv("DB_SLOW_CHECKOUT_MS", 100))
+
+# Connection checkouts of the instance: count, total and longest wait for a connection
+db_pool_metrics = dict(checkouts=0, wait_seconds=0.0, max_wait_seconds=0.0)
+
+
+class TimedQueuePool(sqlalchemy.pool.QueuePool):
+    """Queue pool measuring how long checkouts wait for a free connection, see `db_pool_metrics`.
+
+    Only the wait for the pool is measured: opening a new connection and the pre-ping are not part of it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._checkout_timing = threading.local()
+
+    def _do_get(self):
+        timing = self._checkout_timing
+        if getattr(timing, "started", None) is not None:
+            # QueuePool retries a checkout by calling `_do_get` again, which is part of the same wait
+            return super()._do_get()
+
+        timing.started = time.perf_counter()
+        timing.connect_seconds = 0.0
+        try:
+            connection_record = super()._do_get()
+            wait_seconds = time.perf_counter() - timing.started - timing.connect_seconds
+        finally:
+            timing.started = None
+
+        db_pool_metrics["checkouts"] += 1
+        db_pool_metrics["wait_seconds"] += wait_seconds
+        db_pool_metrics["max_wait_seconds"] = max(db_pool_metrics["max_wait_seconds"], wait_seconds)
+        if wait_seconds * 1000 >= DB_SLOW_CHECKOUT_MS:
+            print(f"Slow DB connection checkout: {wait_seconds * 1000:.0f} ms, {self.status()}, {db_pool_metrics}")
+
+        return connection_record
+
+    def _create_connection(self):
+        started = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            if getattr(self._checkout_timing, "started", None) is not None:
+                self._checkout_timing.connect_seconds += time.perf_counter() - started
+
+
+def set_statement_timeout(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"SET statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+    cursor.close()
+    # Keep the setting when the pool rolls the connection back
+    dbapi_connection.commit()
+
+
+def register_enum_adapters(*enum_classes):
+    """Make psycopg2 send members of `enum_classes` as their values, like pg8000 does.
+
+    Called once on import, with the status enums of the function.
+    """
+    if DB_DRIVER != "psycopg2":
+        return
+
+    import psycopg2.extensions
+
+    for enum_class in enum_classes:
+        psycopg2.extensions.register_adapter(enum_class, lambda member: psycopg2.extensions.adapt(member.value))
+
+
 def create_db_engine():
     db_config = {
-        "drivername": "postgresql+pg8000",
+        "drivername": f"postgresql+{DB_DRIVER}",
     }
     if not running_locally:
         db_connection_name = os.environ["DB_CONNECTION_NAME"]
+        if DB_DRIVER == "psycopg2":
+            # libpq expects the directory of the socket
+            socket_query = {"host": f"/cloudsql/{db_connection_name}"}
+        else:
+            socket_query = {"unix_sock": f"/cloudsql/{db_connection_name}/.s.PGSQL.5432"}
         db_config |= {
-            "query": dict(
-                {"unix_sock": f"/cloudsql/{db_connection_name}/.s.PGSQL.5432"}
-            ),
+            "query": dict(socket_query),
             "database": configuration_context["DB_NAME"],
             "username": configuration_context["DB_USER"],
             "password": configuration_context["DB_PASS"],
@@ -71,33 +158,119 @@ def create_db_engine():
         }
     pool = create_engine(
         sqlalchemy.engine.url.URL.create(**db_config),
+        poolclass=TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
     )
     pool.dialect.description_encoding = None
+    if DB_STATEMENT_TIMEOUT_MS > 0:
+        sqlalchemy.event.listen(pool, "connect", set_statement_timeout)
     return pool
 
 
+# Rows fetched from a server-side cursor per round trip, see `stream_rows`
+DB_FETCH_SIZE = int(os.getenv("DB_FETCH_SIZE", 1000))
+
+
+def stream_rows(db_connection, stmt, params=None, fetch_size=DB_FETCH_SIZE):
+    """Execute `stmt` on a server-side cursor and iterate its rows, fetching `fetch_size` rows at a time.
+
+    The result set is never materialized as a whole, so memory is bounded by `fetch_size`.
+    Must be called within a transaction; other statements may be executed on `db_connection` meanwhile.
+    """
+    result = db_connection.execution_options(stream_results=True).execute(stmt, params or {})
+    return result.yield_per(fetch_size)
+# endshared
+
+
 db = create_db_engine()
 # endregion
 
 
 # region i18n initialisation
 TRANSLATIONS_FILE_PATH = './locale'
+TRANSLATIONS_FALLBACK_LOCALE = 'en'
+
+# Keys of all translations of the notifications: SendGrid template ids and SMS bodies
+TRANSLATION_KEYS = [
+    "sendgrid.GUESTANDHOSTMATCHCONFIRM",
+    "messaging.sms.sealedNotification",
+]
+
+# shared: _build/shared/translations.py, edit it there and run `python _build/sync_shared.py`
+# Translations of TRANSLATION_KEYS by locale, see `query_translations`
+translation_tables = {}
+
+
+def flatten_translations(translations, key_prefix=""):
+    """Return nested `translations` of a locale file by dotted key, e.g. "sendgrid.MatchTimeout"."""
+    flat_translations = {}
+    for key, value in translations.items():
+        if isinstance(value, dict):
+            flat_translations |= flatten_translations(value, f"{key_prefix}{key}.")
+        else:
+            flat_translations[f"{key_prefix}{key}"] = value
+
+    return flat_translations
+
+
+def load_translations(locale):
+    """Return all translations of `locale` by dotted key, or nothing if there is no file of the locale.
 
-i18n.set('fallback', 'en')
-i18n.set('filename_format', '{locale}.{format}')
-i18n.set('skip_locale_root_data', True)
-i18n.load_path.append(TRANSLATIONS_FILE_PATH)
+    `<locale>.json` precompiled at deployment is read if present, `<locale>.yml` is parsed otherwise.
+    """
+    file_names = os.listdir(TRANSLATIONS_FILE_PATH)
+    if f"{locale}.json" in file_names:
+        with open(os.path.join(TRANSLATIONS_FILE_PATH, f"{locale}.json"), encoding="utf-8") as translations_file:
+            return json.load(translations_file)
+    elif f"{locale}.yml" in file_names:
+        import yaml
 
-print(f'i18n initialised - configuration={i18n.load_path}')
+        with open(os.path.join(TRANSLATIONS_FILE_PATH, f"{locale}.yml"), encoding="utf-8") as translations_file:
+            return flatten_translations(yaml.safe_load(translations_file))
+    else:
+        return {}
+
+
+def query_translations(locale):
+    """Return translations of `TRANSLATION_KEYS` to `locale` by key.
+
+    A locale is loaded on its first use, only its translations of `TRANSLATION_KEYS` are kept for the process.
+    Keys missing in the locale are translated to TRANSLATIONS_FALLBACK_LOCALE, or left as they are.
+    """
+    if locale not in translation_tables:
+        if locale != TRANSLATIONS_FALLBACK_LOCALE:
+            fallback_translations = query_translations(TRANSLATIONS_FALLBACK_LOCALE)
+        else:
+            fallback_translations = {}
+
+        translations = load_translations(locale)
+        translation_tables[locale] = {
+            key: translations.get(key, fallback_translations.get(key, key)) for key in TRANSLATION_KEYS
+        }
+        print(f"Translations of locale={locale} loaded")
+
+    return translation_tables[locale]
+# endshared
 # endregion
 
 
 # region Database data models
+# Tables reflected so far by (engine, table name), see `create_table_mapping`
+table_mappings = {}
+
+
 def create_table_mapping(db_pool, db_table_name):
-    meta = MetaData(db_pool)
-    tbl = Table(db_table_name, meta, autoload=True, autoload_with=db_pool)
+    """Return table `db_table_name` of `db_pool`.  A table is reflected once per process, then reused."""
+    key = (db_pool, db_table_name)
+    if key not in table_mappings:
+        meta = MetaData(db_pool)
+        table_mappings[key] = Table(db_table_name, meta, autoload=True, autoload_with=db_pool)
 
-    return tbl
+    return table_mappings[key]
 # endregion
 
 
@@ -127,42 +300,104 @@ class MatchAcceptanceDecision(Enum):
 class MatchAcceptanceSide(Enum):
     GUEST = "guest"
     HOST = "host"
+
+
+register_enum_adapters(MatchesStatus, HostsGuestsStatus)
 # endregion
 
 
 # region integration utilities
-def fnc_publish_message(message):
-    topic_name = os.environ["SEND_EMAIL_TOPIC"]
-    topic_path = publisher.topic_path(os.environ["PROJECT_ID"], topic_name)
+# shared: _build/shared/pubsub_publishing.py, edit it there and run `python _build/sync_shared.py`
+# Messages are batched by the client, up to PUBSUB_MAX_IN_FLIGHT_MESSAGES are published without waiting
+PUBSUB_MAX_BATCH_MESSAGES = int(os.getenv("PUBSUB_MAX_BATCH_MESSAGES", 100))
+PUBSUB_MAX_BATCH_LATENCY_SECONDS = float(os.getenv("PUBSUB_MAX_BATCH_LATENCY_SECONDS", 0.05))
+PUBSUB_MAX_IN_FLIGHT_MESSAGES = int(os.getenv("PUBSUB_MAX_IN_FLIGHT_MESSAGES", 1000))
 
-    message_json = json.dumps(message)
-    message_bytes = message_json.encode("utf-8")
+# Instantiates a Pub/Sub client
+publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(
+        max_messages=PUBSUB_MAX_BATCH_MESSAGES,
+        max_latency=PUBSUB_MAX_BATCH_LATENCY_SECONDS,
+    )
+)
 
-    try:
-        publish_future = publisher.publish(topic_path, data=message_bytes)
-        publish_future.result()  # Verify the publish succeeded
-        return "Message published."
-    except Exception as e:
-        print(e)
-        return (e, 500)
+# (future, topic name, message) of messages published and not confirmed yet
+in_flight_messages = []
 
+# Messages are written to the outbox table in the transaction changing the statuses they notify about,
+# instead of being published from within the transaction.  Only for functions calling `flush_messages`.
+NOTIFICATIONS_OUTBOX = os.getenv("NOTIFICATIONS_OUTBOX", "false").lower() == "true"
+OUTBOX_INSERT_CHUNK_SIZE = 1000
+# Messages of the current transaction to be written to the outbox table, see `flush_messages`
+outbox_messages = []
 
-def fnc_publish_sms(message):
-    topic_name = os.environ["SEND_SMS_TOPIC"]
-    topic_path = publisher.topic_path(os.environ["PROJECT_ID"], topic_name)
 
+def publish_message(topic_name, message):
+    """Publish `message` to `topic_name` without waiting for it, or keep it for the outbox.  See `flush_messages`."""
     message_json = json.dumps(message)
+    if NOTIFICATIONS_OUTBOX:
+        outbox_messages.append(dict(topic=topic_name, message=message_json))
+        return "Message stored."
+
+    if len(in_flight_messages) >= PUBSUB_MAX_IN_FLIGHT_MESSAGES:
+        wait_for_published_messages()
+
+    topic_path = publisher.topic_path(os.environ["PROJECT_ID"], topic_name)
     message_bytes = message_json.encode("utf-8")
 
     try:
         publish_future = publisher.publish(topic_path, data=message_bytes)
-        publish_future.result()  # Verify the publish succeeded
+        in_flight_messages.append((publish_future, topic_name, message_json))
         return "Message published."
     except Exception as e:
-        print(e)
+        print(f"Publishing to {topic_name} failed: {e}, message={message_json}")
         return (e, 500)
 
 
+def wait_for_published_messages():
+    """Wait until all messages in flight are published.  Return the number of messages which failed."""
+    failed = 0
+    for publish_future, topic_name, message_json in in_flight_messages:
+        try:
+            publish_future.result()  # Verify the publish succeeded
+        except Exception as e:
+            print(f"Publishing to {topic_name} failed: {e}, message={message_json}")
+            failed += 1
+
+    print(f"Published {len(in_flight_messages) - failed} messages, {failed} failed")
+    in_flight_messages.clear()
+    return failed
+
+
+def flush_messages(db_connection):
+    """Send messages of the current transaction of `db_connection`, before it commits.
+
+    Messages kept for the outbox are written to the outbox table in that transaction and published
+    later by the outbox-relay function.  Otherwise, messages published directly are waited for.
+    """
+    if len(outbox_messages) > 0:
+        tbl_outbox = sqlalchemy.table(
+            os.environ["OUTBOX_TABLE_NAME"], sqlalchemy.column("topic"), sqlalchemy.column("message")
+        )
+        for chunk_start in range(0, len(outbox_messages), OUTBOX_INSERT_CHUNK_SIZE):
+            db_connection.execute(
+                tbl_outbox.insert().values(outbox_messages[chunk_start:chunk_start + OUTBOX_INSERT_CHUNK_SIZE])
+            )
+        print(f"Stored {len(outbox_messages)} messages in {os.environ['OUTBOX_TABLE_NAME']}")
+        outbox_messages.clear()
+
+    wait_for_published_messages()
+# endshared
+
+
+def fnc_publish_message(message):
+    return publish_message(os.environ["SEND_EMAIL_TOPIC"], message)
+
+
+def fnc_publish_sms(message):
+    return publish_message(os.environ["SEND_SMS_TOPIC"], message)
+
+
 def create_sms_payload(phone_num, body):
     return {
         "phone_num": phone_num,
@@ -202,7 +437,7 @@ def create_payload_for_guest_and_host_match_confirm_template(
     )
 
     # template_id = "d-4b189c34ff584451a1dc1f83421a7d21"
-    template_id = i18n.t("sendgrid.GUESTANDHOSTMATCHCONFIRM", locale=preferred_lang)
+    template_id = query_translations(preferred_lang)["sendgrid.GUESTANDHOSTMATCHCONFIRM"]
 
     context = {
         "host_name": host_row["name"],
@@ -220,10 +455,6 @@ def create_payload_for_guest_and_host_match_confirm_template(
 
 # endregion
 
-# Instantiates a Pub/Sub client
-publisher = pubsub_v1.PublisherClient()
-
-
 def fnc_target(event, context):
     create_offering_notifications()
 
@@ -246,6 +477,8 @@ def create_offering_notifications():
 
     with db.connect() as conn:
         with conn.begin():
+            # Messages left by a transaction which failed in a previous invocation were never sent
+            outbox_messages.clear()
             result = conn.execute(sel_matches)
 
             for match in result:
@@ -299,7 +532,7 @@ def create_offering_notifications():
                             print(f"host={host_row['db_hosts_id']} has enabled SMS notifications")
                             fnc_publish_sms(
                                 create_sms_payload(phone_num=host_row["phone_num"],
-                                                   body=i18n.t("messaging.sms.sealedNotification", locale=host_row['preferred_lang'])
+                                                   body=query_translations(host_row['preferred_lang'])["messaging.sms.sealedNotification"]
                                                    )
                             )
 
@@ -308,7 +541,7 @@ def create_offering_notifications():
                             print(f"guest={guest_row['db_guests_id']} has enabled SMS notifications")
                             fnc_publish_sms(
                                 create_sms_payload(phone_num=guest_row["phone_num"],
-                                                   body=i18n.t("messaging.sms.sealedNotification", locale=guest_row['preferred_lang'])
+                                                   body=query_translations(guest_row['preferred_lang'])["messaging.sms.sealedNotification"]
                                                    )
                             )
 
@@ -324,5 +557,7 @@ def create_offering_notifications():
 
                 conn.execute(upd_matches_status)
 
+            flush_messages(conn)
+
 
 # endregion
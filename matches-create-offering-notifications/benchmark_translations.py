@@ -0,0 +1,201 @@
+"""Benchmark of translations of the offering notifications: python-i18n lookups against translation tables.
+
+Run from this directory in the local development environment, e.g.
+
+    LOCAL_DEVELOPMENT=1 python benchmark_translations.py --notifications 10000 --output benchmark_translations.json
+
+Both paths translate the same synthetic hosts and guests with the `translate_*` functions and template
+ids of the notifications: `i18n` calls `i18n.t` of python-i18n on every lookup, as the function used
+to, and `table` uses `query_translations`.  Loading the locale files into the tables is timed
+separately as `build`.  python-i18n is not a dependency of the function anymore: without it
+installed, only `build` and `table` are timed.  Results are written as JSON, so runs can be compared.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import time
+
+import main
+
+try:
+    import i18n
+except ImportError:
+    # Baseline of the benchmark only, see `run_benchmark`
+    i18n = None
+
+
+SHELTER_TYPES = ["bed", "room", "flat", "house", "public_shared_space"]
+GROUP_RELATIONS = ["single_man", "single_woman", "spouses", "mother_with_children", "family_with_children", "unrelated_group"]
+
+
+def init_i18n():
+    """Configure python-i18n as the function did."""
+    i18n.set("fallback", main.TRANSLATIONS_FALLBACK_LOCALE)
+    i18n.set("filename_format", "{locale}.{format}")
+    i18n.set("skip_locale_root_data", True)
+    i18n.load_path.append(main.TRANSLATIONS_FILE_PATH)
+
+
+class I18nTranslations:
+    """Translations of `locale` looked up with `i18n.t` on every access, like `query_translations` did before."""
+
+    def __init__(self, locale):
+        self.locale = locale
+
+    def __getitem__(self, key):
+        return i18n.t(key, locale=self.locale)
+
+    def get(self, key, default=None):
+        return i18n.t(key, locale=self.locale) if key in main.TRANSLATION_KEYS else default
+
+
+# region Synthetic data generators
+def random_flag(rng):
+    return rng.choice(["TRUE", "FALSE"])
+
+
+def generate_listings(count, rng, locales):
+    """Generate (host row, guest row) pairs with the columns translated in the notifications."""
+    return [
+        (
+            dict(
+                preferred_lang=rng.choice(locales),
+                shelter_type="{" + rng.choice(SHELTER_TYPES) + "}",
+                transport_included=random_flag(rng),
+                ok_for_pregnant=random_flag(rng),
+                ok_for_elderly=random_flag(rng),
+                ok_for_disabilities=random_flag(rng),
+                ok_for_animals=random_flag(rng),
+            ),
+            dict(
+                preferred_lang=rng.choice(locales),
+                group_relation="{" + rng.choice(GROUP_RELATIONS) + "}",
+                is_ukrainian_nationality=random_flag(rng),
+                is_pregnant=random_flag(rng),
+                is_with_disability=random_flag(rng),
+                is_with_elderly=random_flag(rng),
+                is_with_animal=random_flag(rng),
+            ),
+        )
+        for i in range(count)
+    ]
+# endregion
+
+
+# region Benchmarked translations
+def translate_notifications(host_row, guest_row):
+    """Translate everything the offering notifications of a match translate, in the same way."""
+    host_lang = host_row["preferred_lang"]
+    guest_lang = guest_row["preferred_lang"]
+    return [
+        main.query_translations(guest_lang)["sendgrid.GuestGetsMatch"],
+        main.translate_shelter_type(host_row["shelter_type"], guest_lang),
+        main.translate_shelter_type(host_row["shelter_type"], guest_lang),
+        main.translate_complication(host_row["transport_included"], guest_lang),
+        main.translate_complication(host_row["ok_for_pregnant"], guest_lang),
+        main.translate_complication(host_row["ok_for_elderly"], guest_lang),
+        main.translate_complication(host_row["ok_for_disabilities"], guest_lang),
+        main.translate_complication(host_row["ok_for_animals"], guest_lang),
+        main.query_translations(host_lang)["sendgrid.HostGetsMatch"],
+        main.translate_group_relation(guest_row["group_relation"], host_lang),
+        main.translate_nationality(guest_row["is_ukrainian_nationality"], host_lang),
+        main.translate_complication(guest_row["is_pregnant"], host_lang),
+        main.translate_complication(guest_row["is_with_disability"], host_lang),
+        main.translate_complication(guest_row["is_with_elderly"], host_lang),
+        main.translate_complication(guest_row["is_with_animal"], host_lang),
+        main.query_translations(host_lang)["messaging.sms.offeringNotification"],
+        main.query_translations(guest_lang)["messaging.sms.offeringNotification"],
+    ]
+
+
+def run_translations(listings):
+    started = time.perf_counter()
+    translations = [translate_notifications(host_row, guest_row) for host_row, guest_row in listings]
+    return translations, time.perf_counter() - started
+# endregion
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--locales",
+        nargs="+",
+        default=sorted(
+            os.path.splitext(name)[0] for name in os.listdir(main.TRANSLATIONS_FILE_PATH) if name.endswith(".yml")
+        ),
+    )
+    parser.add_argument("--notifications", type=int, default=10000, help="matches to translate notifications of")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_translations.json")
+    return parser.parse_args()
+
+
+def run_benchmark(args):
+    listings = generate_listings(args.notifications, random.Random(args.seed), args.locales)
+    query_translations = main.query_translations
+    paths = [("table", query_translations)]
+
+    if i18n is not None:
+        # python-i18n loads files of a locale on its first lookups, so load them beforehand
+        init_i18n()
+        for locale in args.locales:
+            for key in main.TRANSLATION_KEYS:
+                i18n.t(key, locale=locale)
+        paths.insert(0, ("i18n", I18nTranslations))
+    else:
+        print("python-i18n is not installed, the i18n baseline is skipped; run `pip install python-i18n` to compare")
+
+    main.translation_tables.clear()
+    started = time.perf_counter()
+    for locale in args.locales:
+        query_translations(locale)
+    build_seconds = time.perf_counter() - started
+
+    results = [dict(path="build", locales=len(args.locales), seconds=build_seconds)]
+    translations = {}
+    for path, translations_of_locale in paths:
+        main.query_translations = translations_of_locale
+        timings = []
+        for i in range(args.repeat):
+            translations[path], seconds = run_translations(listings)
+            timings.append(seconds)
+
+        seconds = min(timings)
+        results.append(
+            dict(
+                path=path,
+                notifications=len(listings),
+                seconds=seconds,
+                microseconds_per_notification=seconds / len(listings) * 1e6 if len(listings) > 0 else None,
+            )
+        )
+
+    main.query_translations = query_translations
+    if "i18n" in translations and translations["i18n"] != translations["table"]:
+        raise AssertionError("Translation tables differ from python-i18n lookups")
+
+    for result in results:
+        print(json.dumps(result))
+
+    return results
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = run_benchmark(args)
+
+    with open(args.output, "w") as output_file:
+        json.dump(
+            dict(
+                created=datetime.datetime.now().isoformat(),
+                environment=dict(python=platform.python_version()),
+                parameters=vars(args),
+                results=results,
+            ),
+            output_file,
+            indent=2,
+        )
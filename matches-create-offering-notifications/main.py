@@ -4,6 +4,7 @@ from tokenize import group
 import sqlalchemy
 import base64
 import json
+import threading
 import time
 
 from enum import Enum
@@ -17,8 +18,6 @@ from sqlalchemy.dialects.postgresql import *
 from sqlalchemy import join
 from sqlalchemy import select
 
-import i18n
-
 from google.cloud import pubsub_v1
 from google.cloud import secretmanager
 from dotenv import load_dotenv
@@ -49,16 +48,104 @@ else:
 
 
 # region Database connectivity initialisation
+# shared: _build/shared/database_connectivity.py, edit it there and run `python _build/sync_shared.py`
+# Database driver: pg8000 (pure Python) or psycopg2 (libpq, faster with large results)
+DB_DRIVER = os.getenv("DB_DRIVER", "pg8000")
+
+# Connection pool of the function instance, kept between invocations of a warm instance.
+# An instance handles one request at a time, which checks out at most 2 connections at once (nested `db.connect()`),
+# the overflow covers deeper nesting.  Pools are small on purpose: every instance of every function keeps its own
+# pool against the connection limit of the Cloud SQL instance, SQLAlchemy defaults would allow 15 per instance.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 2))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 2))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# Disabled with 0
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 0))
+# Checkouts waiting for a connection longer than that are logged
+DB_SLOW_CHECKOUT_MS = float(os.getenv("DB_SLOW_CHECKOUT_MS", 100))
+
+# Connection checkouts of the instance: count, total and longest wait for a connection
+db_pool_metrics = dict(checkouts=0, wait_seconds=0.0, max_wait_seconds=0.0)
+
+
+class TimedQueuePool(sqlalchemy.pool.QueuePool):
+    """Queue pool measuring how long checkouts wait for a free connection, see `db_pool_metrics`.
+
+    Only the wait for the pool is measured: opening a new connection and the pre-ping are not part of it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._checkout_timing = threading.local()
+
+    def _do_get(self):
+        timing = self._checkout_timing
+        if getattr(timing, "started", None) is not None:
+            # QueuePool retries a checkout by calling `_do_get` again, which is part of the same wait
+            return super()._do_get()
+
+        timing.started = time.perf_counter()
+        timing.connect_seconds = 0.0
+        try:
+            connection_record = super()._do_get()
+            wait_seconds = time.perf_counter() - timing.started - timing.connect_seconds
+        finally:
+            timing.started = None
+
+        db_pool_metrics["checkouts"] += 1
+        db_pool_metrics["wait_seconds"] += wait_seconds
+        db_pool_metrics["max_wait_seconds"] = max(db_pool_metrics["max_wait_seconds"], wait_seconds)
+        if wait_seconds * 1000 >= DB_SLOW_CHECKOUT_MS:
+            print(f"Slow DB connection checkout: {wait_seconds * 1000:.0f} ms, {self.status()}, {db_pool_metrics}")
+
+        return connection_record
+
+    def _create_connection(self):
+        started = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            if getattr(self._checkout_timing, "started", None) is not None:
+                self._checkout_timing.connect_seconds += time.perf_counter() - started
+
+
+def set_statement_timeout(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"SET statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+    cursor.close()
+    # Keep the setting when the pool rolls the connection back
+    dbapi_connection.commit()
+
+
+def register_enum_adapters(*enum_classes):
+    """Make psycopg2 send members of `enum_classes` as their values, like pg8000 does.
+
+    Called once on import, with the status enums of the function.
+    """
+    if DB_DRIVER != "psycopg2":
+        return
+
+    import psycopg2.extensions
+
+    for enum_class in enum_classes:
+        psycopg2.extensions.register_adapter(enum_class, lambda member: psycopg2.extensions.adapt(member.value))
+
+
 def create_db_engine():
     db_config = {
-        "drivername": "postgresql+pg8000",
+        "drivername": f"postgresql+{DB_DRIVER}",
     }
     if not running_locally:
         db_connection_name = os.environ["DB_CONNECTION_NAME"]
+        if DB_DRIVER == "psycopg2":
+            # libpq expects the directory of the socket
+            socket_query = {"host": f"/cloudsql/{db_connection_name}"}
+        else:
+            socket_query = {"unix_sock": f"/cloudsql/{db_connection_name}/.s.PGSQL.5432"}
         db_config |= {
-            "query": dict(
-                {"unix_sock": f"/cloudsql/{db_connection_name}/.s.PGSQL.5432"}
-            ),
+            "query": dict(socket_query),
             "database": configuration_context["DB_NAME"],
             "username": configuration_context["DB_USER"],
             "password": configuration_context["DB_PASS"],
@@ -73,33 +160,135 @@ def create_db_engine():
         }
     pool = create_engine(
         sqlalchemy.engine.url.URL.create(**db_config),
+        poolclass=TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
     )
     pool.dialect.description_encoding = None
+    if DB_STATEMENT_TIMEOUT_MS > 0:
+        sqlalchemy.event.listen(pool, "connect", set_statement_timeout)
     return pool
 
 
+# Rows fetched from a server-side cursor per round trip, see `stream_rows`
+DB_FETCH_SIZE = int(os.getenv("DB_FETCH_SIZE", 1000))
+
+
+def stream_rows(db_connection, stmt, params=None, fetch_size=DB_FETCH_SIZE):
+    """Execute `stmt` on a server-side cursor and iterate its rows, fetching `fetch_size` rows at a time.
+
+    The result set is never materialized as a whole, so memory is bounded by `fetch_size`.
+    Must be called within a transaction; other statements may be executed on `db_connection` meanwhile.
+    """
+    result = db_connection.execution_options(stream_results=True).execute(stmt, params or {})
+    return result.yield_per(fetch_size)
+# endshared
+
+
 db = create_db_engine()
 # endregion
 
 
 # region i18n initialisation
 TRANSLATIONS_FILE_PATH = './locale'
+TRANSLATIONS_FALLBACK_LOCALE = 'en'
+
+# Keys of all translations of the notifications: SendGrid template ids, SMS bodies and static values
+TRANSLATION_KEYS = [
+    "sendgrid.GuestGetsMatch",
+    "sendgrid.HostGetsMatch",
+    "messaging.sms.offeringNotification",
+    "staticValues.accommodationTypes.bed",
+    "staticValues.accommodationTypes.room",
+    "staticValues.accommodationTypes.flat",
+    "staticValues.accommodationTypes.house",
+    "staticValues.accommodationTypes.public_shared_space",
+    "staticValues.groupRelations.single_man",
+    "staticValues.groupRelations.single_woman",
+    "staticValues.groupRelations.spouses",
+    "staticValues.groupRelations.mother_with_children",
+    "staticValues.groupRelations.family_with_children",
+    "staticValues.groupRelations.unrelated_group",
+    "common.nationalities.ukrainian",
+    "common.nationalities.nonUkarainian",
+    "staticValues.boolean.yes",
+    "staticValues.boolean.no",
+]
+
+# shared: _build/shared/translations.py, edit it there and run `python _build/sync_shared.py`
+# Translations of TRANSLATION_KEYS by locale, see `query_translations`
+translation_tables = {}
+
+
+def flatten_translations(translations, key_prefix=""):
+    """Return nested `translations` of a locale file by dotted key, e.g. "sendgrid.MatchTimeout"."""
+    flat_translations = {}
+    for key, value in translations.items():
+        if isinstance(value, dict):
+            flat_translations |= flatten_translations(value, f"{key_prefix}{key}.")
+        else:
+            flat_translations[f"{key_prefix}{key}"] = value
+
+    return flat_translations
+
+
+def load_translations(locale):
+    """Return all translations of `locale` by dotted key, or nothing if there is no file of the locale.
+
+    `<locale>.json` precompiled at deployment is read if present, `<locale>.yml` is parsed otherwise.
+    """
+    file_names = os.listdir(TRANSLATIONS_FILE_PATH)
+    if f"{locale}.json" in file_names:
+        with open(os.path.join(TRANSLATIONS_FILE_PATH, f"{locale}.json"), encoding="utf-8") as translations_file:
+            return json.load(translations_file)
+    elif f"{locale}.yml" in file_names:
+        import yaml
+
+        with open(os.path.join(TRANSLATIONS_FILE_PATH, f"{locale}.yml"), encoding="utf-8") as translations_file:
+            return flatten_translations(yaml.safe_load(translations_file))
+    else:
+        return {}
+
 
-i18n.set('fallback', 'en')
-i18n.set('filename_format', '{locale}.{format}')
-i18n.set('skip_locale_root_data', True)
-i18n.load_path.append(TRANSLATIONS_FILE_PATH)
+def query_translations(locale):
+    """Return translations of `TRANSLATION_KEYS` to `locale` by key.
 
-print(f'i18n initialised - configuration={i18n.load_path}')
+    A locale is loaded on its first use, only its translations of `TRANSLATION_KEYS` are kept for the process.
+    Keys missing in the locale are translated to TRANSLATIONS_FALLBACK_LOCALE, or left as they are.
+    """
+    if locale not in translation_tables:
+        if locale != TRANSLATIONS_FALLBACK_LOCALE:
+            fallback_translations = query_translations(TRANSLATIONS_FALLBACK_LOCALE)
+        else:
+            fallback_translations = {}
+
+        translations = load_translations(locale)
+        translation_tables[locale] = {
+            key: translations.get(key, fallback_translations.get(key, key)) for key in TRANSLATION_KEYS
+        }
+        print(f"Translations of locale={locale} loaded")
+
+    return translation_tables[locale]
+# endshared
 # endregion
 
 
 # region Database data models
+# Tables reflected so far by (engine, table name), see `create_table_mapping`
+table_mappings = {}
+
+
 def create_table_mapping(db_pool, db_table_name):
-    meta = MetaData(db_pool)
-    tbl = Table(db_table_name, meta, autoload=True, autoload_with=db_pool)
+    """Return table `db_table_name` of `db_pool`.  A table is reflected once per process, then reused."""
+    key = (db_pool, db_table_name)
+    if key not in table_mappings:
+        meta = MetaData(db_pool)
+        table_mappings[key] = Table(db_table_name, meta, autoload=True, autoload_with=db_pool)
 
-    return tbl
+    return table_mappings[key]
 # endregion
 
 
@@ -129,6 +318,9 @@ class MatchAcceptanceDecision(Enum):
 class MatchAcceptanceSide(Enum):
     GUEST = "guest"
     HOST = "host"
+
+
+register_enum_adapters(MatchesStatus, HostsGuestsStatus)
 # endregion
 
 
@@ -147,38 +339,97 @@ def change_match_status(db_connection, db_matches_id, target_status):
 
 
 # region integration functions
-def fnc_publish_message(message):
-    topic_name = os.environ["SEND_EMAIL_TOPIC"]
-    topic_path = publisher.topic_path(os.environ["PROJECT_ID"], topic_name)
+# shared: _build/shared/pubsub_publishing.py, edit it there and run `python _build/sync_shared.py`
+# Messages are batched by the client, up to PUBSUB_MAX_IN_FLIGHT_MESSAGES are published without waiting
+PUBSUB_MAX_BATCH_MESSAGES = int(os.getenv("PUBSUB_MAX_BATCH_MESSAGES", 100))
+PUBSUB_MAX_BATCH_LATENCY_SECONDS = float(os.getenv("PUBSUB_MAX_BATCH_LATENCY_SECONDS", 0.05))
+PUBSUB_MAX_IN_FLIGHT_MESSAGES = int(os.getenv("PUBSUB_MAX_IN_FLIGHT_MESSAGES", 1000))
 
-    message_json = json.dumps(message)
-    message_bytes = message_json.encode("utf-8")
+# Instantiates a Pub/Sub client
+publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(
+        max_messages=PUBSUB_MAX_BATCH_MESSAGES,
+        max_latency=PUBSUB_MAX_BATCH_LATENCY_SECONDS,
+    )
+)
 
-    try:
-        publish_future = publisher.publish(topic_path, data=message_bytes)
-        publish_future.result()  # Verify the publish succeeded
-        return "Message published."
-    except Exception as e:
-        print(e)
-        return (e, 500)
+# (future, topic name, message) of messages published and not confirmed yet
+in_flight_messages = []
 
+# Messages are written to the outbox table in the transaction changing the statuses they notify about,
+# instead of being published from within the transaction.  Only for functions calling `flush_messages`.
+NOTIFICATIONS_OUTBOX = os.getenv("NOTIFICATIONS_OUTBOX", "false").lower() == "true"
+OUTBOX_INSERT_CHUNK_SIZE = 1000
+# Messages of the current transaction to be written to the outbox table, see `flush_messages`
+outbox_messages = []
 
-def fnc_publish_sms(message):
-    topic_name = os.environ["SEND_SMS_TOPIC"]
-    topic_path = publisher.topic_path(os.environ["PROJECT_ID"], topic_name)
 
+def publish_message(topic_name, message):
+    """Publish `message` to `topic_name` without waiting for it, or keep it for the outbox.  See `flush_messages`."""
     message_json = json.dumps(message)
+    if NOTIFICATIONS_OUTBOX:
+        outbox_messages.append(dict(topic=topic_name, message=message_json))
+        return "Message stored."
+
+    if len(in_flight_messages) >= PUBSUB_MAX_IN_FLIGHT_MESSAGES:
+        wait_for_published_messages()
+
+    topic_path = publisher.topic_path(os.environ["PROJECT_ID"], topic_name)
     message_bytes = message_json.encode("utf-8")
 
     try:
         publish_future = publisher.publish(topic_path, data=message_bytes)
-        publish_future.result()  # Verify the publish succeeded
+        in_flight_messages.append((publish_future, topic_name, message_json))
         return "Message published."
     except Exception as e:
-        print(e)
+        print(f"Publishing to {topic_name} failed: {e}, message={message_json}")
         return (e, 500)
 
 
+def wait_for_published_messages():
+    """Wait until all messages in flight are published.  Return the number of messages which failed."""
+    failed = 0
+    for publish_future, topic_name, message_json in in_flight_messages:
+        try:
+            publish_future.result()  # Verify the publish succeeded
+        except Exception as e:
+            print(f"Publishing to {topic_name} failed: {e}, message={message_json}")
+            failed += 1
+
+    print(f"Published {len(in_flight_messages) - failed} messages, {failed} failed")
+    in_flight_messages.clear()
+    return failed
+
+
+def flush_messages(db_connection):
+    """Send messages of the current transaction of `db_connection`, before it commits.
+
+    Messages kept for the outbox are written to the outbox table in that transaction and published
+    later by the outbox-relay function.  Otherwise, messages published directly are waited for.
+    """
+    if len(outbox_messages) > 0:
+        tbl_outbox = sqlalchemy.table(
+            os.environ["OUTBOX_TABLE_NAME"], sqlalchemy.column("topic"), sqlalchemy.column("message")
+        )
+        for chunk_start in range(0, len(outbox_messages), OUTBOX_INSERT_CHUNK_SIZE):
+            db_connection.execute(
+                tbl_outbox.insert().values(outbox_messages[chunk_start:chunk_start + OUTBOX_INSERT_CHUNK_SIZE])
+            )
+        print(f"Stored {len(outbox_messages)} messages in {os.environ['OUTBOX_TABLE_NAME']}")
+        outbox_messages.clear()
+
+    wait_for_published_messages()
+# endshared
+
+
+def fnc_publish_message(message):
+    return publish_message(os.environ["SEND_EMAIL_TOPIC"], message)
+
+
+def fnc_publish_sms(message):
+    return publish_message(os.environ["SEND_SMS_TOPIC"], message)
+
+
 # endregion
 
 
@@ -222,7 +473,7 @@ def create_payload_for_guest_get_match_template(matches_id, host_row, guest_row)
     # template_id = "d-d1db97e9b1e34a15ac13bc253f26c049" # without url_listing_delete FIXME clean up
     # template_id = "d-fc675a4d49384ea297223df70dfbc872" # with url_listing_delete
     preferred_lang = guest_row['preferred_lang']
-    template_id = i18n.t("sendgrid.GuestGetsMatch", locale=preferred_lang)
+    template_id = query_translations(preferred_lang)["sendgrid.GuestGetsMatch"]
 
     context = {
         "host_name": host_row["name"],
@@ -259,7 +510,7 @@ def create_payload_for_host_get_match_template(matches_id, guest_row, host_row):
     # template_id = "d-d6e35cda42e343089dd03d2b03b84ffe"  # with url_listing_delete
 
     preferred_lang = host_row['preferred_lang']
-    template_id = i18n.t("sendgrid.HostGetsMatch", locale=preferred_lang)
+    template_id = query_translations(preferred_lang)["sendgrid.HostGetsMatch"]
 
     context = {
         "guest_name": guest_row["name"],
@@ -293,10 +544,6 @@ def create_payload_for_host_get_match_template(matches_id, guest_row, host_row):
 
 # endregion
 
-# Instantiates a Pub/Sub client
-publisher = pubsub_v1.PublisherClient()
-
-
 def fnc_target(event, context):
     create_offering_notifications()
 
@@ -305,51 +552,31 @@ def fnc_target(event, context):
 
 # SHELTER_TYPES = ["bed", "room", "flat", "house", "public_shared_space"]
 def translate_shelter_type(shelter_type, preferred_lang):
-    shelter_type = shelter_type[1:-1]
-    if shelter_type == "bed":
-        return i18n.t("staticValues.accommodationTypes.bed", locale=preferred_lang)
-    elif shelter_type == "room":
-        return i18n.t("staticValues.accommodationTypes.room", locale=preferred_lang)
-    elif shelter_type == "flat":
-        return i18n.t("staticValues.accommodationTypes.flat", locale=preferred_lang)
-    elif shelter_type == "house":
-        return i18n.t("staticValues.accommodationTypes.house", locale=preferred_lang)
-    elif shelter_type == "public_shared_space":
-        return i18n.t("staticValues.accommodationTypes.public_shared_space", locale=preferred_lang)
-    else:
-        return ""
+    translations = query_translations(preferred_lang)
+    return translations.get(f"staticValues.accommodationTypes.{shelter_type[1:-1]}", "")
 
 
 # GROUP_RELATIONS = ["single_man", "single_woman", "spouses", "mother_with_children", "family_with_children", "unrelated_group"]
 def translate_group_relation(group_relation, preferred_lang):
-    group_relation = group_relation[1:-1]
-    if group_relation == "single_man":
-        return i18n.t("staticValues.groupRelations.single_man", locale=preferred_lang)
-    elif group_relation == "single_woman":
-        return i18n.t("staticValues.groupRelations.single_woman", locale=preferred_lang)
-    elif group_relation == "spouses":
-        return i18n.t("staticValues.groupRelations.spouses", locale=preferred_lang)
-    elif group_relation == "mother_with_children":
-        return i18n.t("staticValues.groupRelations.mother_with_children", locale=preferred_lang)
-    elif group_relation == "family_with_children":
-        return i18n.t("staticValues.groupRelations.family_with_children", locale=preferred_lang)
-    elif group_relation == "unrelated_group":
-        return i18n.t("staticValues.groupRelations.unrelated_group", locale=preferred_lang)
+    translations = query_translations(preferred_lang)
+    return translations.get(f"staticValues.groupRelations.{group_relation[1:-1]}")
 
 
 def translate_nationality(is_ukrainian_nationality, preferred_lang):
+    translations = query_translations(preferred_lang)
     return (
-        i18n.t("common.nationalities.ukrainian", locale=preferred_lang)
+        translations["common.nationalities.ukrainian"]
         if is_ukrainian_nationality == "TRUE"
-        else i18n.t("common.nationalities.nonUkarainian", locale=preferred_lang)
+        else translations["common.nationalities.nonUkarainian"]
     )
 
 
 def translate_complication(complication_flag, preferred_lang):
+    translations = query_translations(preferred_lang)
     return (
-        i18n.t("staticValues.boolean.yes", locale=preferred_lang)
+        translations["staticValues.boolean.yes"]
         if complication_flag == "TRUE"
-        else i18n.t("staticValues.boolean.no", locale=preferred_lang)
+        else translations["staticValues.boolean.no"]
     )
 
 
@@ -372,80 +599,117 @@ def translate_duration_category(duration):
 
 
 # region Main function
+# Pending matches together with their host and guest joined with accounts.  Columns of hosts and guests are
+# prefixed with `host_` and `guest_`, see `split_row`; a missing listing gives NULL columns
+PENDING_MATCHES_QUERY = f"""
+SELECT
+    ma.db_matches_id, ma.fnc_host_status, ma.fnc_guest_status,
+    hos.db_hosts_id AS host_db_hosts_id, hos.db_ts_registered AS host_db_ts_registered,
+    hos.fnc_accounts_id AS host_fnc_accounts_id, hos.fnc_status AS host_fnc_status, hos.country AS host_country,
+    hos.city AS host_city, hos.closest_city AS host_closest_city, hos.zipcode AS host_zipcode,
+    hos.street AS host_street, hos.building_no AS host_building_no, hos.appartment_no AS host_appartment_no,
+    hos.shelter_type AS host_shelter_type, hos.beds AS host_beds,
+    hos.acceptable_group_relations AS host_acceptable_group_relations, hos.ok_for_pregnant AS host_ok_for_pregnant,
+    hos.ok_for_disabilities AS host_ok_for_disabilities, hos.ok_for_animals AS host_ok_for_animals,
+    hos.ok_for_elderly AS host_ok_for_elderly, hos.ok_for_any_nationality AS host_ok_for_any_nationality,
+    hos.duration_category AS host_duration_category, hos.transport_included AS host_transport_included,
+    hos.can_be_verified AS host_can_be_verified,
+    coalesce(hacc.phone_num, hos.phone_num) AS host_phone_num, coalesce(hacc.email, hos.email) AS host_email,
+    coalesce(hacc.name, hos.name) AS host_name, coalesce(hacc.preferred_lang, 'pl') AS host_preferred_lang,
+    coalesce(hacc.sms_notification, 'FALSE') AS host_sms_notification,
+    gue.db_guests_id AS guest_db_guests_id, gue.db_ts_registered AS guest_db_ts_registered,
+    gue.fnc_accounts_id AS guest_fnc_accounts_id, gue.fnc_status AS guest_fnc_status, gue.country AS guest_country,
+    gue.city AS guest_city, gue.acceptable_shelter_types AS guest_acceptable_shelter_types, gue.beds AS guest_beds,
+    gue.group_relation AS guest_group_relation, gue.is_pregnant AS guest_is_pregnant,
+    gue.is_with_disability AS guest_is_with_disability, gue.is_with_animal AS guest_is_with_animal,
+    gue.is_with_elderly AS guest_is_with_elderly, gue.is_ukrainian_nationality AS guest_is_ukrainian_nationality,
+    gue.duration_category AS guest_duration_category,
+    coalesce(gacc.phone_num, gue.phone_num) AS guest_phone_num, coalesce(gacc.email, gue.email) AS guest_email,
+    coalesce(gacc.name, gue.name) AS guest_name, coalesce(gacc.preferred_lang, 'uk') AS guest_preferred_lang,
+    coalesce(gacc.sms_notification, 'FALSE') AS guest_sms_notification
+FROM {os.environ['MATCHES_TABLE_NAME']} ma
+LEFT JOIN {os.environ['HOSTS_TABLE_NAME']} hos ON ma.fnc_hosts_id = hos.db_hosts_id
+LEFT JOIN {os.environ['ACCOUNTS_TABLE_NAME']} hacc ON hos.fnc_accounts_id = hacc.db_accounts_id
+LEFT JOIN {os.environ['GUESTS_TABLE_NAME']} gue ON ma.fnc_guests_id = gue.db_guests_id
+LEFT JOIN {os.environ['ACCOUNTS_TABLE_NAME']} gacc ON gue.fnc_accounts_id = gacc.db_accounts_id
+WHERE ma.fnc_status = '{MatchesStatus.DEFAULT.value}';
+"""
+
+# Number of matches updated per statement
+MATCHES_UPDATE_CHUNK_SIZE = 1000
+
+
+def split_row(row, prefix):
+    """Return columns of `row` prefixed with `prefix`, without the prefix."""
+    return {key[len(prefix):]: value for key, value in row._mapping.items() if key.startswith(prefix)}
+
+
+def mark_matches_awaiting_response(db_connection, tbl_matches, matches_ids):
+    for chunk_start in range(0, len(matches_ids), MATCHES_UPDATE_CHUNK_SIZE):
+        upd_matches_status = (
+            tbl_matches.update()
+            .where(tbl_matches.c.db_matches_id.in_(matches_ids[chunk_start:chunk_start + MATCHES_UPDATE_CHUNK_SIZE]))
+            .values(
+                fnc_status=MatchesStatus.FNC_AWAITING_RESPONSE,
+                fnc_host_status=MatchesStatus.FNC_AWAITING_RESPONSE,
+                fnc_guest_status=MatchesStatus.FNC_AWAITING_RESPONSE,
+            )
+        )
+
+        db_connection.execute(upd_matches_status)
+
+
 def create_offering_notifications():
     tbl_matches = create_table_mapping(db_pool=db, db_table_name=os.environ["MATCHES_TABLE_NAME"])
-    tbl_guests = create_table_mapping(db_pool=db, db_table_name=os.environ["GUESTS_TABLE_NAME"])
-    tbl_hosts = create_table_mapping(db_pool=db, db_table_name=os.environ["HOSTS_TABLE_NAME"])
-    tbl_accounts = create_table_mapping(db_pool=db, db_table_name=os.environ["ACCOUNTS_TABLE_NAME"])
-
-    sel_matches = tbl_matches.select().where(
-        tbl_matches.c.fnc_status == MatchesStatus.DEFAULT
-    )
 
     with db.connect() as conn:
         with conn.begin():
-            result = conn.execute(sel_matches)
+            # Messages left by a transaction which failed in a previous invocation were never sent
+            outbox_messages.clear()
+            result = stream_rows(conn, sqlalchemy.text(PENDING_MATCHES_QUERY))
 
+            matches_ids = []
             for match in result:
-                # guests_join_accounts = join(tbl_guests, tbl_accounts, tbl_guests.c.fnc_accounts_id == tbl_accounts.c.db_accounts_id)
-                # sel_guests2 = select(tbl_guests, tbl_accounts).select_from(guests_join_accounts).where(
-                #     tbl_guests.c.db_guests_id == match["fnc_guests_id"]
-                # ) #FIXME
-                sel_guests = sqlalchemy.text(
-                    f"SELECT gue.db_guests_id, gue.db_ts_registered, gue.fnc_accounts_id, gue.fnc_status, gue.country, gue.city, gue.acceptable_shelter_types, gue.beds, gue.group_relation, gue.is_pregnant, gue.is_with_disability, gue.is_with_animal, gue.is_with_elderly, gue.is_ukrainian_nationality, duration_category, coalesce(acc.phone_num, gue.phone_num) as phone_num, coalesce(acc.email, gue.email) as email, coalesce(acc.name, gue.name) as name, coalesce(acc.preferred_lang, 'uk') as preferred_lang, coalesce(acc.sms_notification, 'FALSE') as sms_notification FROM guests gue LEFT JOIN accounts acc ON gue.fnc_accounts_id = acc.db_accounts_id WHERE gue.db_guests_id = '{match['fnc_guests_id']}';"
-                )
-                guest_rows = conn.execute(sel_guests) 
-
-                # hosts_join_accounts = join(tbl_hosts, tbl_accounts, tbl_hosts.c.fnc_accounts_id == tbl_accounts.c.db_accounts_id)
-                # sel_hosts = select(tbl_hosts, tbl_accounts).select_from(hosts_join_accounts).where(
-                #     tbl_guests.c.db_guests_id == match["fnc_hosts_id"]
-                # )
-                sel_hosts = sqlalchemy.text(
-                    f"SELECT hos.db_hosts_id, hos.db_ts_registered, hos.fnc_accounts_id, hos.fnc_status, hos.country, hos.city, hos.closest_city, hos.zipcode, hos.street, hos.building_no, hos.appartment_no, hos.shelter_type, hos.beds, hos.acceptable_group_relations, hos.ok_for_pregnant, hos.ok_for_disabilities, hos.ok_for_animals, hos.ok_for_elderly, hos.ok_for_any_nationality, hos.duration_category, hos.transport_included, can_be_verified, coalesce(acc.phone_num, hos.phone_num) as phone_num, coalesce(acc.email, hos.email) as email, coalesce(acc.name, hos.name) as name, coalesce(acc.preferred_lang, 'pl') as preferred_lang, coalesce(acc.sms_notification, 'FALSE') as sms_notification FROM hosts hos LEFT JOIN accounts acc ON hos.fnc_accounts_id = acc.db_accounts_id WHERE hos.db_hosts_id = '{match['fnc_hosts_id']}';"
-                )
-                host_rows = conn.execute(sel_hosts)
-
-                for host_row in host_rows:
-                    for guest_row in guest_rows:
-                        if match["fnc_host_status"] == MatchesStatus.DEFAULT.value:
-                            message_for_host = (
-                                create_payload_for_host_get_match_template(match["db_matches_id"], guest_row, host_row)
-                            )
-                            print(message_for_host)
-                            fnc_publish_message(message_for_host)
-
-                            if host_row['sms_notification'] == "TRUE":
-                                print(f"host={host_row['db_hosts_id']} has enabled SMS notifications")
-                                fnc_publish_sms(
-                                    create_sms_payload(host_row["phone_num"], i18n.t("messaging.sms.offeringNotification", locale=host_row['preferred_lang']))
-                                )
-
-                        if match["fnc_guest_status"] == MatchesStatus.DEFAULT.value:
-                            message_for_guest = (
-                                create_payload_for_guest_get_match_template(
-                                    match["db_matches_id"], host_row, guest_row
-                                )
-                            )
-                            print(message_for_guest)
-                            fnc_publish_message(message_for_guest)
-
-                            if guest_row['sms_notification'] == "TRUE":
-                                print(f"guest={guest_row['db_guests_id']} has enabled SMS notifications")
-                                fnc_publish_sms(
-                                    create_sms_payload(guest_row["phone_num"], i18n.t("messaging.sms.offeringNotification", locale=guest_row['preferred_lang']))
-                                )
-
-                upd_matches_status = (
-                    tbl_matches.update()
-                    .where(tbl_matches.c.db_matches_id == match["db_matches_id"])
-                    .values(
-                        fnc_status=MatchesStatus.FNC_AWAITING_RESPONSE,
-                        fnc_host_status=MatchesStatus.FNC_AWAITING_RESPONSE,
-                        fnc_guest_status=MatchesStatus.FNC_AWAITING_RESPONSE,
+                matches_ids.append(match["db_matches_id"])
+
+                # Notifications are sent only when both listings of the match exist
+                if match["host_db_hosts_id"] is None or match["guest_db_guests_id"] is None:
+                    continue
+                host_row = split_row(match, "host_")
+                guest_row = split_row(match, "guest_")
+
+                if match["fnc_host_status"] == MatchesStatus.DEFAULT.value:
+                    message_for_host = (
+                        create_payload_for_host_get_match_template(match["db_matches_id"], guest_row, host_row)
                     )
-                )
+                    print(message_for_host)
+                    fnc_publish_message(message_for_host)
+
+                    if host_row['sms_notification'] == "TRUE":
+                        print(f"host={host_row['db_hosts_id']} has enabled SMS notifications")
+                        fnc_publish_sms(
+                            create_sms_payload(host_row["phone_num"], query_translations(host_row['preferred_lang'])["messaging.sms.offeringNotification"])
+                        )
+
+                if match["fnc_guest_status"] == MatchesStatus.DEFAULT.value:
+                    message_for_guest = (
+                        create_payload_for_guest_get_match_template(
+                            match["db_matches_id"], host_row, guest_row
+                        )
+                    )
+                    print(message_for_guest)
+                    fnc_publish_message(message_for_guest)
+
+                    if guest_row['sms_notification'] == "TRUE":
+                        print(f"guest={guest_row['db_guests_id']} has enabled SMS notifications")
+                        fnc_publish_sms(
+                            create_sms_payload(guest_row["phone_num"], query_translations(guest_row['preferred_lang'])["messaging.sms.offeringNotification"])
+                        )
+
+            mark_matches_awaiting_response(conn, tbl_matches, matches_ids)
+            print(f"changed status of {len(matches_ids)} matches to fnc_status={MatchesStatus.FNC_AWAITING_RESPONSE}")
 
-                conn.execute(upd_matches_status)
+            flush_messages(conn)
 
 
 # endregion
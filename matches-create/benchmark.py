@@ -0,0 +1,251 @@
+"""Benchmark of the matching pipeline on synthetic populations of hosts and guests.
+
+Run from this directory in the local development environment, e.g.
+
+    LOCAL_DEVELOPMENT=1 python benchmark.py --sizes 100 1000 10000 50000 --output benchmark.json
+
+Phases are timed separately: `score` (cost matrix construction), `solve` (assignment)
+and `write` (inserting matches and updating statuses, only with --db-write; the
+transaction is rolled back).  Results are written as JSON, so runs can be compared.
+"""
+import argparse
+import datetime
+import json
+import platform
+import random
+import time
+
+import numpy as np
+import scipy
+
+import main
+
+
+GROUP_RELATIONS = ["single_man", "single_woman", "spouses", "mother_with_children", "family_with_children", "unrelated_group"]
+SHELTER_TYPES = ["bed", "room", "flat", "house", "public_shared_space"]
+
+
+# region Synthetic data generators
+def city_weights(cities_count, city_skew):
+    """Zipf-like popularity of cities - a few big cities and a long tail of small ones."""
+    return [1.0 / (rank + 1) ** city_skew for rank in range(cities_count)]
+
+
+def random_registration_date(rng, max_age_hours):
+    return datetime.datetime.now() - datetime.timedelta(hours=rng.uniform(0, max_age_hours))
+
+
+def generate_hosts(count, rng, cities, weights, acceptance, max_age_hours):
+    """Generate hosts, each of them accepting a special need of guests with `acceptance` probability."""
+    return [
+        main.HostListing(
+            rid=f"host-{i}",
+            registration_date=random_registration_date(rng, max_age_hours),
+            country="poland",
+            closest_city=city,
+            shelter_type=rng.choice(SHELTER_TYPES),
+            beds=rng.randint(1, 6),
+            acceptable_group_relations=rng.sample(GROUP_RELATIONS, rng.randint(1, len(GROUP_RELATIONS))),
+            ok_for_any_nationality=rng.random() < acceptance,
+            ok_for_elderly=rng.random() < acceptance,
+            ok_for_pregnant=rng.random() < acceptance,
+            ok_for_disabilities=rng.random() < acceptance,
+            ok_for_animals=rng.random() < acceptance,
+            duration_category=rng.randrange(len(main.DURATION_CATEGORIES)),
+            transport_included=False,
+        )
+        for i, city in enumerate(rng.choices(cities, weights, k=count))
+    ]
+
+
+def generate_guests(count, rng, cities, weights, needs, any_city_share, max_age_hours):
+    """Generate guests, each of them having a special need with `needs` probability."""
+    return [
+        main.GuestListing(
+            rid=f"guest-{i}",
+            registration_date=random_registration_date(rng, max_age_hours),
+            country="poland",
+            city=None if rng.random() < any_city_share else city,
+            beds=rng.randint(1, 4),
+            is_pregnant=rng.random() < needs,
+            is_with_disability=rng.random() < needs,
+            is_with_animal=rng.random() < needs,
+            is_with_elderly=rng.random() < needs,
+            group_relation=rng.choice(GROUP_RELATIONS),
+            acceptable_shelter_types=rng.sample(SHELTER_TYPES, rng.randint(1, len(SHELTER_TYPES))),
+            is_ukrainian_nationality=rng.random() > needs,
+            duration_category=rng.randrange(len(main.DURATION_CATEGORIES)),
+        )
+        for i, city in enumerate(rng.choices(cities, weights, k=count))
+    ]
+
+
+def generate_history(hosts, guests, count, rng):
+    """Generate `count` past matches.  Return activity boosters and past (host rid, guest rid) pairs."""
+    rid_pairs = {(rng.choice(hosts).rid, rng.choice(guests).rid) for i in range(count)}
+
+    recent_activity = []
+    for host_rid, guest_rid in rid_pairs:
+        timeouts, rejections = (1, 0) if rng.random() < 0.5 else (0, 1)
+        recent_activity.append(dict(listing_type="host", listing_id=host_rid, timeouts=timeouts, rejections=rejections))
+        recent_activity.append(dict(listing_type="guest", listing_id=guest_rid, timeouts=timeouts, rejections=rejections))
+
+    return main.index_activity_boosts(recent_activity), rid_pairs
+# endregion
+
+
+# region Benchmark phases
+def run_scoring_and_solving(hosts, guests, activity_boosts, rid_pairs, matching_mode, solvers):
+    """Score a matching problem and solve it with every solver of `solvers`, using the same scores.
+
+    Return matched (host index, guest index, score) and timings of the phases, both by solver.
+    """
+    if matching_mode == main.MatchingMode.BLOCKED:
+        blocks = [(host_indices, guest_indices) for key, host_indices, guest_indices in main.partition_into_blocks(hosts, guests)]
+    else:
+        blocks = [(list(range(len(hosts))), list(range(len(guests))))]
+
+    score_seconds = 0.0
+    solve_seconds = {solver: 0.0 for solver in solvers}
+    feasible_pairs = 0
+    matches = {solver: [] for solver in solvers}
+    for host_indices, guest_indices in blocks:
+        started = time.perf_counter()
+        score_matrix = main.create_score_matrix(
+            [hosts[hi] for hi in host_indices], [guests[gi] for gi in guest_indices], activity_boosts, rid_pairs
+        )
+        score_seconds += time.perf_counter() - started
+        feasible_pairs += int(np.count_nonzero(score_matrix))
+
+        for solver in solvers:
+            started = time.perf_counter()
+            assignment = main.solve_assignment(-score_matrix, solver)
+            solve_seconds[solver] += time.perf_counter() - started
+
+            matches[solver].extend(
+                (host_indices[hi], guest_indices[gi], score_matrix[hi, gi]) for hi, gi in assignment
+            )
+
+    timings = {
+        solver: dict(
+            blocks=len(blocks),
+            feasible_pairs=feasible_pairs,
+            matches=len(matches[solver]),
+            total_score=float(sum(score for hi, gi, score in matches[solver])),
+            score_seconds=score_seconds,
+            solve_seconds=solve_seconds[solver],
+        )
+        for solver in solvers
+    }
+
+    return matches, timings
+
+
+def run_db_write(hosts, guests, matches):
+    """Time the write phase of `create_matching` for `matches`, rolling the transaction back."""
+    tbl_matches = main.create_table_mapping(db_pool=main.db, db_table_name="matches")
+    tbl_hosts = main.create_table_mapping(db_pool=main.db, db_table_name="hosts")
+    tbl_guests = main.create_table_mapping(db_pool=main.db, db_table_name="guests")
+    matched_pairs = [(hosts[hi].rid, guests[gi].rid) for hi, gi, score in matches]
+
+    with main.db.connect() as conn:
+        transaction = conn.begin()
+        started = time.perf_counter()
+        main.insert_matches_bulk(db_connection=conn, tbl_matches=tbl_matches, matches=matched_pairs)
+        main.update_status_bulk(
+            db_connection=conn,
+            tbl=tbl_hosts,
+            id_col_name="db_hosts_id",
+            ids={host_rid for host_rid, guest_rid in matched_pairs},
+            target_status=main.HostsGuestsStatus.FNC_MATCHED,
+        )
+        main.update_status_bulk(
+            db_connection=conn,
+            tbl=tbl_guests,
+            id_col_name="db_guests_id",
+            ids={guest_rid for host_rid, guest_rid in matched_pairs},
+            target_status=main.HostsGuestsStatus.FNC_MATCHED,
+        )
+        write_seconds = time.perf_counter() - started
+        transaction.rollback()
+
+    return write_seconds
+# endregion
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000, 10000, 50000], help="numbers of hosts")
+    parser.add_argument("--guests-ratio", type=float, default=1.0, help="guests per host")
+    parser.add_argument("--modes", nargs="+", default=[mode.value for mode in (main.MatchingMode.DENSE, main.MatchingMode.BLOCKED)])
+    parser.add_argument("--solvers", nargs="+", default=[solver.value for solver in main.MatchingSolver])
+    parser.add_argument("--cities", type=int, default=50, help="number of cities")
+    parser.add_argument("--city-skew", type=float, default=1.0, help="Zipf exponent of city popularity")
+    parser.add_argument("--any-city-share", type=float, default=0.0, help="share of guests accepting any city")
+    parser.add_argument("--acceptance", type=float, default=0.5, help="probability a host accepts a special need")
+    parser.add_argument("--needs", type=float, default=0.1, help="probability a guest has a special need")
+    parser.add_argument("--history", type=float, default=1.0, help="past matches per host")
+    parser.add_argument("--match-timeout-hours", type=int, default=24)
+    parser.add_argument("--max-dense-gb", type=float, default=4.0, help="skip dense problems with larger cost matrices")
+    parser.add_argument("--db-write", action="store_true", help="time the DB write phase as well")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json")
+    return parser.parse_args()
+
+
+def run_benchmark(args):
+    main.MATCH_TIMEOUT_HOURS = args.match_timeout_hours
+    cities = [f"city-{i}" for i in range(args.cities)]
+    weights = city_weights(args.cities, args.city_skew)
+
+    results = []
+    for size in args.sizes:
+        rng = random.Random(args.seed)
+        max_age_hours = 3 * args.match_timeout_hours
+        hosts = generate_hosts(size, rng, cities, weights, args.acceptance, max_age_hours)
+        guests = generate_guests(
+            int(size * args.guests_ratio), rng, cities, weights, args.needs, args.any_city_share, max_age_hours
+        )
+        activity_boosts, rid_pairs = generate_history(hosts, guests, int(size * args.history), rng)
+
+        for mode in args.modes:
+            matching_mode = main.MatchingMode(mode)
+            solvers = [main.MatchingSolver(solver) for solver in args.solvers]
+
+            dense_gb = len(hosts) * len(guests) * 8 / 2 ** 30
+            if matching_mode == main.MatchingMode.DENSE and dense_gb > args.max_dense_gb:
+                matches = {}
+                timings = {solver: dict(skipped=f"cost matrix of {dense_gb:.1f} GB exceeds --max-dense-gb") for solver in solvers}
+            else:
+                matches, timings = run_scoring_and_solving(hosts, guests, activity_boosts, rid_pairs, matching_mode, solvers)
+
+            for solver in solvers:
+                result = dict(mode=mode, solver=solver.value, hosts=len(hosts), guests=len(guests)) | timings[solver]
+                if main.MatchingSolver.EXACT in matches and solver in matches:
+                    # Relative loss of the total score against the optimal assignment
+                    exact_score = timings[main.MatchingSolver.EXACT]["total_score"]
+                    result["score_gap"] = 1.0 - result["total_score"] / exact_score if exact_score > 0 else 0.0
+                if args.db_write and solver in matches:
+                    result["write_seconds"] = run_db_write(hosts, guests, matches[solver])
+
+                print(json.dumps(result))
+                results.append(result)
+
+    return results
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = run_benchmark(args)
+
+    with open(args.output, "w") as output_file:
+        json.dump(
+            dict(
+                created=datetime.datetime.now().isoformat(),
+                environment=dict(python=platform.python_version(), numpy=np.__version__, scipy=scipy.__version__),
+                parameters=vars(args),
+                results=results,
+            ),
+            output_file,
+            indent=2,
+        )
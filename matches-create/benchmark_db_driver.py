@@ -0,0 +1,154 @@
+"""Benchmark of row fetching throughput of database drivers on the queries of `create_matching`.
+
+Run from this directory in the local development environment against a populated database, e.g.
+
+    LOCAL_DEVELOPMENT=1 python benchmark_db_driver.py --drivers pg8000 psycopg2 --output benchmark_db_driver.json
+
+Every query is run `--repeat` times per driver and all columns of all its rows are fetched; the best run
+is reported.  Claims of hosts and guests are rolled back, so the database is left unchanged.  Results
+are written as JSON, so runs can be compared.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import time
+
+import sqlalchemy
+
+import main
+
+
+# region Benchmarked queries
+def fetch_all_columns(rows):
+    """Fetch and decode all columns of `rows`.  Return the number of rows."""
+    count = 0
+    for row in rows:
+        tuple(row)
+        count += 1
+    return count
+
+
+def fetch_rolled_back(conn, claim):
+    """Fetch rows returned by `claim(conn)`, rolling the claim back."""
+    transaction = conn.begin()
+    try:
+        return fetch_all_columns(claim(conn))
+    finally:
+        transaction.rollback()
+
+
+def fetch_streamed(conn, query, params=None):
+    with conn.begin():
+        return fetch_all_columns(main.stream_rows(conn, sqlalchemy.text(query), params))
+
+
+def fetch_candidate_pairs(hosts_rids_set, guests_rids_set):
+    return fetch_all_columns(main.query_candidate_pairs(hosts_rids_set, guests_rids_set))
+
+
+def benchmarked_queries(args, tbl_hosts, tbl_guests, hosts_rids_set, guests_rids_set):
+    """Return (name, function fetching the rows of the query from a connection) pairs.
+
+    The candidate pairs are fetched as in `match_candidate_pairs`, on a connection of their own.
+    """
+    return [
+        (
+            "claim_hosts",
+            lambda conn: fetch_rolled_back(
+                conn, lambda conn: main.claim_listings(conn, tbl_hosts, "db_hosts_id", args.hosts_batch_size, [])
+            ),
+        ),
+        (
+            "claim_guests",
+            lambda conn: fetch_rolled_back(
+                conn,
+                lambda conn: main.claim_guests(conn, tbl_guests, args.guests_batch_size, [], main.GuestsSampling.RANDOM),
+            ),
+        ),
+        ("existing_pairs", lambda conn: fetch_streamed(conn, main.EXISTING_PAIRS_QUERY)),
+        (
+            "recent_activity",
+            lambda conn: fetch_streamed(
+                conn, main.RECENT_ACTIVITY_QUERY, {"day_filter": main.recent_matches_threshold()}
+            ),
+        ),
+        ("candidate_pairs", lambda conn: fetch_candidate_pairs(hosts_rids_set, guests_rids_set)),
+    ]
+# endregion
+
+
+def query_listing_ids(tbl, id_col_name, batch_size):
+    """Ids of the listings a claim would return, for the candidate pairs query."""
+    with main.db.connect() as conn:
+        stmt = (
+            sqlalchemy.select(tbl.c[id_col_name])
+            .where(tbl.c.fnc_status == main.HostsGuestsStatus.MOD_ACCEPTED.value)
+            .limit(batch_size)
+        )
+        return {row[id_col_name] for row in conn.execute(stmt)}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--drivers", nargs="+", default=["pg8000", "psycopg2"])
+    parser.add_argument("--hosts-batch-size", type=int, default=10000)
+    parser.add_argument("--guests-batch-size", type=int, default=10000)
+    parser.add_argument("--match-timeout-hours", type=int, default=24)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default="benchmark_db_driver.json")
+    return parser.parse_args()
+
+
+def run_benchmark(args):
+    main.MATCH_TIMEOUT_HOURS = args.match_timeout_hours
+
+    results = []
+    for driver in args.drivers:
+        main.DB_DRIVER = driver
+        main.db = main.create_db_engine()
+        tbl_hosts = main.create_table_mapping(db_pool=main.db, db_table_name=os.environ["HOSTS_TABLE_NAME"])
+        tbl_guests = main.create_table_mapping(db_pool=main.db, db_table_name=os.environ["GUESTS_TABLE_NAME"])
+        hosts_rids_set = query_listing_ids(tbl_hosts, "db_hosts_id", args.hosts_batch_size)
+        guests_rids_set = query_listing_ids(tbl_guests, "db_guests_id", args.guests_batch_size)
+
+        for name, fetch_rows in benchmarked_queries(args, tbl_hosts, tbl_guests, hosts_rids_set, guests_rids_set):
+            timings = []
+            for i in range(args.repeat):
+                with main.db.connect() as conn:
+                    started = time.perf_counter()
+                    rows = fetch_rows(conn)
+                    timings.append(time.perf_counter() - started)
+
+            seconds = min(timings)
+            result = dict(
+                driver=driver,
+                query=name,
+                rows=rows,
+                seconds=seconds,
+                rows_per_second=rows / seconds if seconds > 0 else None,
+            )
+            print(json.dumps(result))
+            results.append(result)
+
+        main.db.dispose()
+
+    return results
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = run_benchmark(args)
+
+    with open(args.output, "w") as output_file:
+        json.dump(
+            dict(
+                created=datetime.datetime.now().isoformat(),
+                environment=dict(python=platform.python_version(), sqlalchemy=sqlalchemy.__version__),
+                parameters=vars(args),
+                results=results,
+            ),
+            output_file,
+            indent=2,
+        )
@@ -1,18 +1,27 @@
+import contextlib
 import dataclasses
+import math
+import multiprocessing
 import datetime
 import numpy as np
 import scipy.optimize
+import scipy.sparse
+import scipy.sparse.csgraph
 
+import hashlib
 import os
 import sqlalchemy
 import base64
 import json
+import random
+import threading
 import time
 from enum import Enum
 from sqlalchemy import create_engine
 from sqlalchemy import Table
 from sqlalchemy import MetaData
 from sqlalchemy import func
+from sqlalchemy import or_
 
 from google.cloud import secretmanager
 from dotenv import load_dotenv
@@ -23,6 +32,18 @@ current_iteration = datetime.datetime.now()
 # IMPORTANT Order of values must be ascending!!!!
 DURATION_CATEGORIES = ["less_than_1_week", "1_week", "2_3_weeks", "month", "longer"]
 MATCH_TIMEOUT_HOURS = None
+# Rows per multi-row INSERT, keeps statements well below the PostgreSQL limit of bind parameters
+MATCHES_INSERT_CHUNK_SIZE = 1000
+# Hard constraints evaluated by the previous run of this process, see `find_matches_incremental`
+feasibility_cache = None
+# Seconds of scoring and solving per cost matrix cell, assumed before the first block of a run is solved
+INITIAL_SECONDS_PER_CELL = 2e-7
+# Projected solving times are multiplied by this factor, as the Hungarian algorithm is superlinear
+DEADLINE_SAFETY_FACTOR = 2.0
+# The platform stops the function after 540 seconds (timeout of the deploy workflows), matching has to end before
+DEFAULT_MATCHING_TIME_BUDGET_SECONDS = 480
+# Claims older than the function timeout belong to runs stopped by the platform, see `release_stale_claims`
+DEFAULT_MATCHING_STALE_CLAIM_SECONDS = 600
 
 
 # region configuration context
@@ -51,16 +72,104 @@ else:
 
 
 # region database connectivity
+# shared: _build/shared/database_connectivity.py, edit it there and run `python _build/sync_shared.py`
+# Database driver: pg8000 (pure Python) or psycopg2 (libpq, faster with large results)
+DB_DRIVER = os.getenv("DB_DRIVER", "pg8000")
+
+# Connection pool of the function instance, kept between invocations of a warm instance.
+# An instance handles one request at a time, which checks out at most 2 connections at once (nested `db.connect()`),
+# the overflow covers deeper nesting.  Pools are small on purpose: every instance of every function keeps its own
+# pool against the connection limit of the Cloud SQL instance, SQLAlchemy defaults would allow 15 per instance.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 2))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 2))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# Disabled with 0
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 0))
+# Checkouts waiting for a connection longer than that are logged
+DB_SLOW_CHECKOUT_MS = float(os.getenv("DB_SLOW_CHECKOUT_MS", 100))
+
+# Connection checkouts of the instance: count, total and longest wait for a connection
+db_pool_metrics = dict(checkouts=0, wait_seconds=0.0, max_wait_seconds=0.0)
+
+
+class TimedQueuePool(sqlalchemy.pool.QueuePool):
+    """Queue pool measuring how long checkouts wait for a free connection, see `db_pool_metrics`.
+
+    Only the wait for the pool is measured: opening a new connection and the pre-ping are not part of it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._checkout_timing = threading.local()
+
+    def _do_get(self):
+        timing = self._checkout_timing
+        if getattr(timing, "started", None) is not None:
+            # QueuePool retries a checkout by calling `_do_get` again, which is part of the same wait
+            return super()._do_get()
+
+        timing.started = time.perf_counter()
+        timing.connect_seconds = 0.0
+        try:
+            connection_record = super()._do_get()
+            wait_seconds = time.perf_counter() - timing.started - timing.connect_seconds
+        finally:
+            timing.started = None
+
+        db_pool_metrics["checkouts"] += 1
+        db_pool_metrics["wait_seconds"] += wait_seconds
+        db_pool_metrics["max_wait_seconds"] = max(db_pool_metrics["max_wait_seconds"], wait_seconds)
+        if wait_seconds * 1000 >= DB_SLOW_CHECKOUT_MS:
+            print(f"Slow DB connection checkout: {wait_seconds * 1000:.0f} ms, {self.status()}, {db_pool_metrics}")
+
+        return connection_record
+
+    def _create_connection(self):
+        started = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            if getattr(self._checkout_timing, "started", None) is not None:
+                self._checkout_timing.connect_seconds += time.perf_counter() - started
+
+
+def set_statement_timeout(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"SET statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+    cursor.close()
+    # Keep the setting when the pool rolls the connection back
+    dbapi_connection.commit()
+
+
+def register_enum_adapters(*enum_classes):
+    """Make psycopg2 send members of `enum_classes` as their values, like pg8000 does.
+
+    Called once on import, with the status enums of the function.
+    """
+    if DB_DRIVER != "psycopg2":
+        return
+
+    import psycopg2.extensions
+
+    for enum_class in enum_classes:
+        psycopg2.extensions.register_adapter(enum_class, lambda member: psycopg2.extensions.adapt(member.value))
+
+
 def create_db_engine():
     db_config = {
-        "drivername": "postgresql+pg8000",
+        "drivername": f"postgresql+{DB_DRIVER}",
     }
     if not running_locally:
         db_connection_name = os.environ["DB_CONNECTION_NAME"]
+        if DB_DRIVER == "psycopg2":
+            # libpq expects the directory of the socket
+            socket_query = {"host": f"/cloudsql/{db_connection_name}"}
+        else:
+            socket_query = {"unix_sock": f"/cloudsql/{db_connection_name}/.s.PGSQL.5432"}
         db_config |= {
-            "query": dict(
-                {"unix_sock": f"/cloudsql/{db_connection_name}/.s.PGSQL.5432"}
-            ),
+            "query": dict(socket_query),
             "database": configuration_context["DB_NAME"],
             "username": configuration_context["DB_USER"],
             "password": configuration_context["DB_PASS"],
@@ -75,11 +184,34 @@ def create_db_engine():
         }
     pool = create_engine(
         sqlalchemy.engine.url.URL.create(**db_config),
+        poolclass=TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
     )
     pool.dialect.description_encoding = None
+    if DB_STATEMENT_TIMEOUT_MS > 0:
+        sqlalchemy.event.listen(pool, "connect", set_statement_timeout)
     return pool
 
 
+# Rows fetched from a server-side cursor per round trip, see `stream_rows`
+DB_FETCH_SIZE = int(os.getenv("DB_FETCH_SIZE", 1000))
+
+
+def stream_rows(db_connection, stmt, params=None, fetch_size=DB_FETCH_SIZE):
+    """Execute `stmt` on a server-side cursor and iterate its rows, fetching `fetch_size` rows at a time.
+
+    The result set is never materialized as a whole, so memory is bounded by `fetch_size`.
+    Must be called within a transaction; other statements may be executed on `db_connection` meanwhile.
+    """
+    result = db_connection.execution_options(stream_results=True).execute(stmt, params or {})
+    return result.yield_per(fetch_size)
+# endshared
+
+
 db = create_db_engine()
 # endregion
 
@@ -100,6 +232,30 @@ class HostsGuestsStatus(Enum):
     FNC_BEING_PROCESSED = "075"
     FNC_MATCHED = "085"
     MATCH_ACCEPTED = "095"
+
+
+class MatchingMode(Enum):
+    DENSE = "dense"
+    BLOCKED = "blocked"
+    INCREMENTAL = "incremental"
+
+
+class CandidatesSource(Enum):
+    PYTHON = "python"
+    SQL = "sql"
+
+
+class MatchingSolver(Enum):
+    EXACT = "exact"
+    GREEDY = "greedy"
+
+
+class GuestsSampling(Enum):
+    RANDOM = "random"
+    INDEXED = "indexed"
+
+
+register_enum_adapters(MatchesStatus, HostsGuestsStatus)
 # endregion
 
 
@@ -108,6 +264,23 @@ class HostsGuestsStatus(Enum):
 class HostListing:
     """Illustrative description of a Polish host and their housing offer."""
 
+    __slots__ = (
+        "rid",
+        "registration_date",
+        "country",
+        "closest_city",
+        "shelter_type",
+        "beds",
+        "acceptable_group_relations",
+        "ok_for_any_nationality",
+        "ok_for_elderly",
+        "ok_for_pregnant",
+        "ok_for_disabilities",
+        "ok_for_animals",
+        "duration_category",
+        "transport_included",
+    )
+
     rid: str
     registration_date: datetime.datetime
     country: str
@@ -128,6 +301,22 @@ class HostListing:
 class GuestListing:
     """Illustrative description of a Ukranian refugee and their housing need."""
 
+    __slots__ = (
+        "rid",
+        "registration_date",
+        "country",
+        "city",
+        "beds",
+        "is_pregnant",
+        "is_with_disability",
+        "is_with_animal",
+        "is_with_elderly",
+        "group_relation",
+        "acceptable_shelter_types",
+        "is_ukrainian_nationality",
+        "duration_category",
+    )
+
     rid: str
     registration_date: datetime.datetime
     country: str
@@ -143,11 +332,252 @@ class GuestListing:
     duration_category: int
 
 
+@dataclasses.dataclass
+class ActivityBoosts:
+    """Activity boosters of listings, indexed by rid. Listings without recent activity get no boost."""
+
+    hosts: dict
+    guests: dict
+
+    def for_host(self, rid):
+        return self.hosts.get(rid, 0.0)
+
+    def for_guest(self, rid):
+        return self.guests.get(rid, 0.0)
+
+
+@dataclasses.dataclass
+class CategoryVocabularies:
+    """Integer codes of categorical values, shared by hosts and guests of a single matching problem."""
+
+    countries: dict = dataclasses.field(default_factory=dict)
+    cities: dict = dataclasses.field(default_factory=dict)
+    group_relations: dict = dataclasses.field(default_factory=dict)
+    shelter_types: dict = dataclasses.field(default_factory=dict)
+
+    @classmethod
+    def from_listings(cls, hosts, guests):
+        vocabularies = cls()
+        for guest in guests:
+            vocabularies.countries.setdefault(guest.country, len(vocabularies.countries))
+            vocabularies.cities.setdefault(guest.city, len(vocabularies.cities))
+            vocabularies.group_relations.setdefault(guest.group_relation, len(vocabularies.group_relations))
+        for host in hosts:
+            vocabularies.countries.setdefault(host.country, len(vocabularies.countries))
+            vocabularies.cities.setdefault(host.closest_city, len(vocabularies.cities))
+            vocabularies.shelter_types.setdefault(host.shelter_type, len(vocabularies.shelter_types))
+
+        return vocabularies
+
+
+@dataclasses.dataclass
+class HostBatch:
+    """Columnar (struct of arrays) form of a list of `HostListing`s, consumed by `evaluate_pairs_matrix`."""
+
+    country: np.ndarray
+    closest_city: np.ndarray
+    shelter_type: np.ndarray
+    beds: np.ndarray
+    acceptable_group_relations: np.ndarray
+    ok_for_any_nationality: np.ndarray
+    ok_for_elderly: np.ndarray
+    ok_for_pregnant: np.ndarray
+    ok_for_disabilities: np.ndarray
+    ok_for_animals: np.ndarray
+    duration_category: np.ndarray
+    transport_included: np.ndarray
+    activity_boost: np.ndarray
+    recency_boost: np.ndarray
+
+    @classmethod
+    def from_listings(cls, hosts, activity_boosts, vocabularies):
+        return cls(
+            country=encode_categories([h.country for h in hosts], vocabularies.countries),
+            closest_city=encode_categories([h.closest_city for h in hosts], vocabularies.cities),
+            shelter_type=encode_categories([h.shelter_type for h in hosts], vocabularies.shelter_types),
+            beds=np.array([h.beds for h in hosts], dtype=np.int32),
+            acceptable_group_relations=encode_bitmasks(
+                [h.acceptable_group_relations for h in hosts], vocabularies.group_relations
+            ),
+            ok_for_any_nationality=np.array([h.ok_for_any_nationality for h in hosts], dtype=bool),
+            ok_for_elderly=np.array([h.ok_for_elderly for h in hosts], dtype=bool),
+            ok_for_pregnant=np.array([h.ok_for_pregnant for h in hosts], dtype=bool),
+            ok_for_disabilities=np.array([h.ok_for_disabilities for h in hosts], dtype=bool),
+            ok_for_animals=np.array([h.ok_for_animals for h in hosts], dtype=bool),
+            duration_category=np.array([h.duration_category for h in hosts], dtype=np.int8),
+            transport_included=np.array([h.transport_included for h in hosts], dtype=np.int8),
+            activity_boost=np.array([activity_boosts.for_host(h.rid) for h in hosts], dtype=np.float64),
+            recency_boost=np.array(
+                [registration_recency_boost(h.registration_date) for h in hosts], dtype=np.float64
+            ),
+        )
+
+
+@dataclasses.dataclass
+class GuestBatch:
+    """Columnar (struct of arrays) form of a list of `GuestListing`s, consumed by `evaluate_pairs_matrix`."""
+
+    country: np.ndarray
+    city: np.ndarray
+    any_city: np.ndarray
+    beds: np.ndarray
+    is_pregnant: np.ndarray
+    is_with_disability: np.ndarray
+    is_with_animal: np.ndarray
+    is_with_elderly: np.ndarray
+    group_relation: np.ndarray
+    acceptable_shelter_types: np.ndarray
+    is_ukrainian_nationality: np.ndarray
+    duration_category: np.ndarray
+    activity_boost: np.ndarray
+    recency_boost: np.ndarray
+
+    @classmethod
+    def from_listings(cls, guests, activity_boosts, vocabularies):
+        return cls(
+            country=encode_categories([g.country for g in guests], vocabularies.countries),
+            city=encode_categories([g.city for g in guests], vocabularies.cities),
+            any_city=np.array([g.city is None for g in guests], dtype=bool),
+            beds=np.array([g.beds for g in guests], dtype=np.int32),
+            is_pregnant=np.array([g.is_pregnant for g in guests], dtype=bool),
+            is_with_disability=np.array([g.is_with_disability for g in guests], dtype=bool),
+            is_with_animal=np.array([g.is_with_animal for g in guests], dtype=bool),
+            is_with_elderly=np.array([g.is_with_elderly for g in guests], dtype=bool),
+            group_relation=encode_categories([g.group_relation for g in guests], vocabularies.group_relations),
+            acceptable_shelter_types=encode_bitmasks(
+                [g.acceptable_shelter_types for g in guests], vocabularies.shelter_types
+            ),
+            is_ukrainian_nationality=np.array([g.is_ukrainian_nationality for g in guests], dtype=bool),
+            duration_category=np.array([g.duration_category for g in guests], dtype=np.int8),
+            activity_boost=np.array([activity_boosts.for_guest(g.rid) for g in guests], dtype=np.float64),
+            recency_boost=np.array(
+                [registration_recency_boost(g.registration_date) for g in guests], dtype=np.float64
+            ),
+        )
+
+
+@dataclasses.dataclass
+class MatchingDeadline:
+    """Time budget of a matching run.  Tracks elapsed time per phase (load, score, solve, write).
+
+    Solving times of blocks are projected from the seconds per cost matrix cell of the blocks solved so far.
+    Without `budget_seconds` there is no deadline, only phases are tracked.
+    """
+
+    budget_seconds: float = None
+    write_reserve_seconds: float = 0.0
+    started: float = dataclasses.field(default_factory=time.monotonic)
+    phases: dict = dataclasses.field(default_factory=dict)
+    current_phase: str = None
+    phase_started: float = None
+    solved_cells: int = 0
+    solved_seconds: float = 0.0
+
+    def enter_phase(self, name):
+        """Finish the current phase and start phase `name`.  Time of repeated phases is summed up."""
+        now = time.monotonic()
+        if self.current_phase is not None:
+            self.phases[self.current_phase] = self.phases.get(self.current_phase, 0.0) + now - self.phase_started
+        self.current_phase = name
+        self.phase_started = now
+
+    def remaining_seconds(self):
+        """Seconds left before the write phase has to start."""
+        if self.budget_seconds is None:
+            return math.inf
+        return self.budget_seconds - self.write_reserve_seconds - (time.monotonic() - self.started)
+
+    def record_block(self, cells, seconds):
+        self.solved_cells += cells
+        self.solved_seconds += seconds
+
+    def affordable_block(self, hosts_count, guests_count):
+        """Return (hosts count, guests count) of a block which can be solved in the remaining time.
+
+        A block projected to overrun the deadline is shrunk, keeping the ratio of hosts and guests.
+        """
+        remaining_seconds = self.remaining_seconds()
+        if remaining_seconds == math.inf:
+            return hosts_count, guests_count
+        if remaining_seconds <= 0.0:
+            return 0, 0
+
+        seconds_per_cell = (
+            self.solved_seconds / self.solved_cells if self.solved_cells > 0 else INITIAL_SECONDS_PER_CELL
+        )
+        affordable_cells = remaining_seconds / (DEADLINE_SAFETY_FACTOR * seconds_per_cell)
+        if hosts_count * guests_count <= affordable_cells:
+            return hosts_count, guests_count
+
+        scale = math.sqrt(affordable_cells / (hosts_count * guests_count))
+        return int(hosts_count * scale), int(guests_count * scale)
+
+    def report(self):
+        self.enter_phase(None)
+        print("Matching phases: " + ", ".join(f"{name}={seconds:.2f}s" for name, seconds in self.phases.items()))
+
+
+@dataclasses.dataclass
+class MatchingRun:
+    """Listings claimed and matches found by a `create_matching` run so far, committed even if the run fails."""
+
+    deadline: MatchingDeadline = dataclasses.field(default_factory=MatchingDeadline)
+    hosts_rids: set = dataclasses.field(default_factory=set)
+    guests_rids: set = dataclasses.field(default_factory=set)
+    matches: list = dataclasses.field(default_factory=list)
+
+
+@dataclasses.dataclass
+class FeasibilityCache:
+    """Hard constraints evaluated for the hosts (rows) and guests (columns) of the previous batch.
+
+    Rows and columns are indexed by `listing_cache_key`, a hash of the fields checked by the hard constraints.
+    Listings with equal fields share a row (column), and a listing updated since the previous batch is evaluated again.
+    """
+
+    host_keys: dict
+    guest_keys: dict
+    feasible: np.ndarray
+
+    @classmethod
+    def empty(cls):
+        return cls(host_keys={}, guest_keys={}, feasible=np.zeros((0, 0), dtype=bool))
+
+
 # endregion
 
 
 # region DataScience functions
-def evaluate_pair(host: HostListing, guest: GuestListing, recent_matches, rid_pairs):
+def activity_boost(activity_points):
+    """Scale activity points collected from recent matches to the 5% score booster."""
+    return 0.05 * float(min(6, activity_points) / 6.0)
+
+
+def activity_points(timeouts, rejections):
+    """Weigh recent matches of a listing - a timeout is worth 3 points, a rejection 1 point."""
+    return 3 * timeouts + rejections
+
+
+def index_activity_boosts(recent_activity):
+    """Collect activity boosters of hosts and guests from rows returned by `RECENT_ACTIVITY_QUERY`."""
+    host_boosts = {}
+    guest_boosts = {}
+
+    for row in recent_activity:
+        boosts = host_boosts if row["listing_type"] == "host" else guest_boosts
+        boosts[row["listing_id"]] = activity_boost(activity_points(row["timeouts"], row["rejections"]))
+
+    return ActivityBoosts(hosts=host_boosts, guests=guest_boosts)
+
+
+def registration_recency_boost(registration_date):
+    listing_age = age_in_hours(registration_date)
+    return 0.05 * max(
+        0.0, 1.0 - float(listing_age) / 2.0 / float(MATCH_TIMEOUT_HOURS)
+    )
+
+
+def evaluate_pair(host: HostListing, guest: GuestListing, activity_boosts: ActivityBoosts, rid_pairs):
     """Check whether a `host` could potentially satisfy a `guest`'s needs.
 
     Return 0.0 if match is impossible.
@@ -197,59 +627,205 @@ def evaluate_pair(host: HostListing, guest: GuestListing, recent_matches, rid_pa
     # -> Transport included
     score += 0.01 * int(host.transport_included)
 
-    # -> Boosters for host and guest activity related to response rate for previous offers #FIXME Optimize execution (otherwise function invocations may time out)
-    # Calculate activity score
-    host_activity_boost = 0
-    guest_activity_boost = 0
-
-    for row in recent_matches:
-        if row["fnc_hosts_id"] == host.rid and (
-            row["fnc_host_status"] == MatchesStatus.MATCH_ACCEPTED.value
-            or row["fnc_host_status"] == MatchesStatus.MATCH_REJECTED.value
-        ):
-            if row["fnc_status"] == MatchesStatus.MATCH_TIMEOUT.value:
-                host_activity_boost += 3
-            if row["fnc_status"] == MatchesStatus.MATCH_REJECTED.value:
-                host_activity_boost += 1
-        if row["fnc_guests_id"] == guest.rid and (
-            row["fnc_guest_status"] == MatchesStatus.MATCH_ACCEPTED.value
-            or row["fnc_guest_status"] == MatchesStatus.MATCH_REJECTED.value
-        ):
-            if row["fnc_status"] == MatchesStatus.MATCH_TIMEOUT.value:
-                guest_activity_boost += 3
-            if row["fnc_status"] == MatchesStatus.MATCH_REJECTED.value:
-                guest_activity_boost += 1
-
-    score += 0.05 * float(min(6, host_activity_boost) / 6.0)
-    score += 0.05 * float(min(6, guest_activity_boost) / 6.0)
-
-    # -> Boosters for recency of host registration
-    host_listing_age = age_in_hours(host.registration_date)
-    score += 0.05 * max(
-        0.0, 1.0 - float(host_listing_age) / 2.0 / float(MATCH_TIMEOUT_HOURS)
-    )
-
-    # -> Boosters for recency of guest registration
-    guest_listing_age = age_in_hours(guest.registration_date)
-    score += 0.05 * max(
-        0.0, 1.0 - float(guest_listing_age) / 2.0 / float(MATCH_TIMEOUT_HOURS)
+    # -> Boosters for host and guest activity related to response rate for previous offers
+    score += activity_boosts.for_host(host.rid)
+    score += activity_boosts.for_guest(guest.rid)
+
+    # -> Boosters for recency of host and guest registration
+    score += registration_recency_boost(host.registration_date)
+    score += registration_recency_boost(guest.registration_date)
+
+    return score
+
+
+def encode_categories(values, vocabulary):
+    """Encode categorical `values` as integer codes, extending `vocabulary` with unseen values."""
+    return np.array(
+        [vocabulary.setdefault(value, len(vocabulary)) for value in values],
+        dtype=np.int32,
     )
 
+
+def encode_bitmasks(value_lists, vocabulary):
+    """Encode lists of categorical values as bitmasks of their `vocabulary` codes.
+
+    Values missing from the vocabulary cannot be matched by the other side, so they are skipped.
+    """
+    if len(vocabulary) > 64:
+        raise ValueError(f"Cannot encode {len(vocabulary)} categories as 64-bit masks")
+
+    masks = []
+    for values in value_lists:
+        mask = 0
+        for value in values:
+            if value in vocabulary:
+                mask |= 1 << vocabulary[value]
+        masks.append(mask)
+
+    return np.array(masks, dtype=np.uint64)
+
+
+def has_bit(masks, codes):
+    return ((masks >> codes.astype(np.uint64)) & np.uint64(1)).astype(bool)
+
+
+def encode_listings(hosts, guests, activity_boosts):
+    """Encode `hosts` and `guests` as `HostBatch` and `GuestBatch` consumed by `evaluate_pairs_matrix`."""
+    vocabularies = CategoryVocabularies.from_listings(hosts, guests)
+
+    return (
+        HostBatch.from_listings(hosts, activity_boosts, vocabularies),
+        GuestBatch.from_listings(guests, activity_boosts, vocabularies),
+    )
+
+
+def excluded_pair_indices(hosts, guests, rid_pairs):
+    """Return (host indices, guest indices) of batch pairs which were already matched in the past."""
+    host_indices = {host.rid: hi for hi, host in enumerate(hosts)}
+    guest_indices = {guest.rid: gi for gi, guest in enumerate(guests)}
+
+    excluded = [
+        (host_indices[host_rid], guest_indices[guest_rid])
+        for host_rid, guest_rid in rid_pairs
+        if host_rid in host_indices and guest_rid in guest_indices
+    ]
+
+    return (
+        np.array([hi for hi, gi in excluded], dtype=np.int64),
+        np.array([gi for hi, gi in excluded], dtype=np.int64),
+    )
+
+
+def excluded_pair_indices_by_block(hosts, guests, blocks, rid_pairs):
+    """Return `excluded_pair_indices` of every block of `partition_into_blocks`, indexed within the block.
+
+    `rid_pairs` are scanned only once, however many blocks there are.
+    """
+    host_positions = {
+        hosts[hi].rid: (block_index, position)
+        for block_index, (key, host_indices, guest_indices) in enumerate(blocks)
+        for position, hi in enumerate(host_indices)
+    }
+    guest_positions = {
+        guests[gi].rid: (block_index, position)
+        for block_index, (key, host_indices, guest_indices) in enumerate(blocks)
+        for position, gi in enumerate(guest_indices)
+    }
+
+    excluded = [([], []) for block in blocks]
+    for host_rid, guest_rid in rid_pairs:
+        host_position = host_positions.get(host_rid)
+        guest_position = guest_positions.get(guest_rid)
+        if host_position is None or guest_position is None or host_position[0] != guest_position[0]:
+            continue
+        block_host_indices, block_guest_indices = excluded[host_position[0]]
+        block_host_indices.append(host_position[1])
+        block_guest_indices.append(guest_position[1])
+
+    return [
+        (np.array(host_indices, dtype=np.int64), np.array(guest_indices, dtype=np.int64))
+        for host_indices, guest_indices in excluded
+    ]
+
+
+def evaluate_pairs_matrix(host_batch: HostBatch, guest_batch: GuestBatch, excluded_pairs):
+    """Vectorized `evaluate_pair` - score every host (rows) against every guest (columns) at once.
+
+    Constraints and boosters are applied in the same order as in `evaluate_pair`,
+    so every cell is equal to the score returned by `evaluate_pair` for the same pair.
+    """
+    feasible = evaluate_feasibility_matrix(host_batch, guest_batch)
+    feasible[excluded_pairs] = False
+
+    return np.where(feasible, evaluate_soft_scores_matrix(host_batch, guest_batch), 0.0)
+
+
+def broadcast_batches(host_batch: HostBatch, guest_batch: GuestBatch):
+    """Return columns of `host_batch` as rows and columns of `guest_batch` as columns of a pairs matrix."""
+    return (
+        {name: column[:, np.newaxis] for name, column in vars(host_batch).items()},
+        {name: column[np.newaxis, :] for name, column in vars(guest_batch).items()},
+    )
+
+
+def evaluate_feasibility_matrix(host_batch: HostBatch, guest_batch: GuestBatch):
+    """Evaluate hard constraints of `evaluate_pair` for every pair, except for the pairs matched in the past."""
+    h, g = broadcast_batches(host_batch, guest_batch)
+
+    feasible = g["country"] == h["country"]
+    feasible &= ~g["is_pregnant"] | h["ok_for_pregnant"]
+    feasible &= ~g["is_with_disability"] | h["ok_for_disabilities"]
+    feasible &= ~g["is_with_animal"] | h["ok_for_animals"]
+    feasible &= ~g["is_with_elderly"] | h["ok_for_elderly"]
+    feasible &= g["is_ukrainian_nationality"] | h["ok_for_any_nationality"]
+    feasible &= h["duration_category"] >= g["duration_category"]
+    feasible &= has_bit(h["acceptable_group_relations"], g["group_relation"])
+    feasible &= has_bit(g["acceptable_shelter_types"], h["shelter_type"])
+    feasible &= h["beds"] >= g["beds"]
+    feasible &= (h["closest_city"] == g["city"]) | g["any_city"]
+
+    return feasible
+
+
+def evaluate_soft_scores_matrix(host_batch: HostBatch, guest_batch: GuestBatch):
+    """Evaluate soft constraints of `evaluate_pair` for every pair - see `evaluate_pair` for the score composition."""
+    h, g = broadcast_batches(host_batch, guest_batch)
+
+    score = np.full((len(host_batch.beds), len(guest_batch.beds)), 0.79)
+    score += 0.01 * h["transport_included"]
+    score += h["activity_boost"]
+    score += g["activity_boost"]
+    score += h["recency_boost"]
+    score += g["recency_boost"]
+
     return score
 
 
-def find_matches(hosts, guests, recent_matches, rid_pairs):
-    """Match hosts and guests, maximizing the sum of matching scores.  Return matched pairs."""
+def select_batch_rows(batch, indices):
+    """Return listings at `indices` of a `HostBatch` or `GuestBatch`."""
+    return type(batch)(**{name: column[indices] for name, column in vars(batch).items()})
+
+
+def create_block_payload(hosts, guests, activity_boosts, excluded_pairs):
+    """Encode a matching problem as plain arrays, cheap to ship to worker processes.
+
+    `excluded_pairs` are (host indices, guest indices) of pairs matched in the past, see `excluded_pair_indices`.
+    """
+    host_batch, guest_batch = encode_listings(hosts, guests, activity_boosts)
+
+    return host_batch, guest_batch, excluded_pairs
+
+
+def create_score_matrix(hosts, guests, activity_boosts, rid_pairs):
+    return evaluate_pairs_matrix(
+        *create_block_payload(hosts, guests, activity_boosts, excluded_pair_indices(hosts, guests, rid_pairs))
+    )
+
+
+def solve_block(payload, solver=MatchingSolver.EXACT):
+    """Score and solve a single block created by `create_block_payload`.  Runs in worker processes."""
+    cost_matrix = -evaluate_pairs_matrix(*payload)
+
+    return solve_assignment(cost_matrix, solver)
+
+
+def find_matches(hosts, guests, activity_boosts, rid_pairs, solver=MatchingSolver.EXACT, deadline=None):
+    """Match hosts and guests, maximizing the sum of matching scores.  Return matched pairs.
+
+    The batch is shrunk if solving it is projected to overrun the `deadline`.
+    """
+    deadline = deadline or MatchingDeadline()
+    hosts_count, guests_count = deadline.affordable_block(len(hosts), len(guests))
+    if (hosts_count, guests_count) != (len(hosts), len(guests)):
+        print(f"Shrinking batch to {hosts_count} hosts and {guests_count} guests to meet the deadline")
+        hosts = hosts[:hosts_count]
+        guests = guests[:guests_count]
 
     # Set up the cost matrix.  As the Hungarian algorithm minimizes cost,
     # use negative score as cost in order to maximize score
+    deadline.enter_phase("score")
     print("Creating cost_matrix")
-    cost_matrix = np.array(
-        [
-            [-evaluate_pair(h, g, recent_matches, rid_pairs) for g in guests]
-            for h in hosts
-        ]
-    )
+    cost_matrix = -create_score_matrix(hosts, guests, activity_boosts, rid_pairs)
     print("Finished creating cost_matrix")
 
     if DEBUG:
@@ -259,27 +835,381 @@ def find_matches(hosts, guests, recent_matches, rid_pairs):
         print(hosts)
         print(cost_matrix)
     # Run the Hungarian algorithm
+    deadline.enter_phase("solve")
+    return [
+        (hosts[hi], guests[gi])
+        for hi, gi in solve_assignment(cost_matrix, solver)
+    ]
+
+
+def solve_assignment(cost_matrix, solver=MatchingSolver.EXACT):
+    """Run the Hungarian algorithm on `cost_matrix`.  Return (host index, guest index) pairs.
+
+    With the greedy `solver` the assignment is only approximate, see `solve_assignment_greedy`.
+    """
+    if solver == MatchingSolver.GREEDY:
+        return solve_assignment_greedy(cost_matrix)
+
     host_indices, guest_indices = scipy.optimize.linear_sum_assignment(cost_matrix)
 
     # Collect results, throwing away assignments with zero score, which signify lack of match.
-    matches = [
-        (hosts[hi], guests[gi])
+    return [
+        (hi, gi)
         for hi, gi in zip(host_indices, guest_indices)
         if cost_matrix[hi, gi] < 0.0
     ]
 
+
+def solve_assignment_greedy(cost_matrix):
+    """Approximate `solve_assignment`, see `greedy_assignment`.  Return (host index, guest index) pairs."""
+    host_indices, guest_indices = np.nonzero(cost_matrix < 0.0)
+
+    return greedy_assignment(host_indices, guest_indices, cost_matrix[host_indices, guest_indices])
+
+
+def greedy_assignment(host_indices, guest_indices, costs):
+    """Go through feasible pairs and take every pair whose host and guest are both still free.
+
+    Every feasible pair scores at least 0.79, so the number of matches matters much more than
+    their scores.  Pairs of listings with the fewest alternatives (feasible pairs of the host
+    plus those of the guest) are therefore taken first, the lowest cost first among them.
+    Only sorts the feasible pairs, so it is much cheaper than the Hungarian algorithm on large
+    batches; benchmark.py reports the score gap against the exact solver.
+    Return (host index, guest index) pairs.
+    """
+    alternatives = (
+        np.bincount(host_indices)[host_indices] + np.bincount(guest_indices)[guest_indices]
+        if len(costs) > 0
+        else np.zeros(0, dtype=np.int64)
+    )
+
+    matched_hosts = set()
+    matched_guests = set()
+    assignment = []
+
+    order = np.lexsort((costs, alternatives))
+    for hi, gi in zip(host_indices[order].tolist(), guest_indices[order].tolist()):
+        if hi not in matched_hosts and gi not in matched_guests:
+            matched_hosts.add(hi)
+            matched_guests.add(gi)
+            assignment.append((hi, gi))
+
+    return assignment
+
+
+def partition_into_blocks(hosts, guests):
+    """Split the matching problem into independent blocks keyed by (country, closest_city).
+
+    Hosts and guests from different blocks can never be matched, so every block can be solved
+    separately.  Guests without a city accept hosts from any city of their country, therefore
+    such a country is kept as a single (country, None) block.
+
+    Return (block key, host indices, guest indices) tuples sorted by block key.
+    """
+    countries_with_any_city = {guest.country for guest in guests if guest.city is None}
+
+    def block_key(country, city):
+        return (country, None) if country in countries_with_any_city else (country, city)
+
+    host_blocks = {}
+    for hi, host in enumerate(hosts):
+        host_blocks.setdefault(block_key(host.country, host.closest_city), []).append(hi)
+
+    guest_blocks = {}
+    for gi, guest in enumerate(guests):
+        guest_blocks.setdefault(block_key(guest.country, guest.city), []).append(gi)
+
+    block_keys = sorted(
+        host_blocks.keys() & guest_blocks.keys(),
+        key=lambda key: [str(value) for value in key],
+    )
+
+    return [(key, host_blocks[key], guest_blocks[key]) for key in block_keys]
+
+
+def find_matches_blocked(
+    hosts, guests, activity_boosts, rid_pairs, workers=1, solver=MatchingSolver.EXACT, deadline=None, matches=None
+):
+    """Match hosts and guests block by block, see `partition_into_blocks`.  Return matched pairs.
+
+    Only cost matrices of single blocks are allocated, so memory usage is bounded by the
+    largest block rather than by the size of the whole batch.  With `workers` > 1 blocks are
+    solved in a process pool; results are merged in block order, so they do not depend
+    on the number of workers.  Matches of every block are appended to `matches` (if given)
+    as soon as the block is solved, so they are kept even if a later block fails.
+
+    Blocks projected to overrun the `deadline` are shrunk; in the process pool, blocks not solved
+    before the deadline are dropped and the workers solving them are terminated.
+    Listings left out of the solved blocks stay unmatched.
+    """
+    deadline = deadline or MatchingDeadline()
+    matches = [] if matches is None else matches
+    blocks = partition_into_blocks(hosts, guests)
+    print(f"Matching {len(hosts)} hosts and {len(guests)} guests in {len(blocks)} blocks using {workers} workers")
+
+    block_listings = [
+        ([hosts[hi] for hi in host_indices], [guests[gi] for gi in guest_indices])
+        for key, host_indices, guest_indices in blocks
+    ]
+    block_excluded_pairs = excluded_pair_indices_by_block(hosts, guests, blocks, rid_pairs)
+
+    if DEBUG:
+        for (key, host_indices, guest_indices) in blocks:
+            print(f"Block {key}: {len(host_indices)} hosts, {len(guest_indices)} guests")
+
+    if workers > 1:
+        payloads = (
+            create_block_payload(block_hosts, block_guests, activity_boosts, excluded_pairs)
+            for (block_hosts, block_guests), excluded_pairs in zip(block_listings, block_excluded_pairs)
+        )
+        deadline.enter_phase("solve")
+        with contextlib.closing(solve_blocks_in_pool(payloads, workers, solver, deadline)) as block_assignments:
+            for (block_hosts, block_guests), assignment in zip(block_listings, block_assignments):
+                matches.extend((block_hosts[hi], block_guests[gi]) for hi, gi in assignment)
+
+        return matches
+
+    for (block_hosts, block_guests), (excluded_host_indices, excluded_guest_indices) in zip(
+        block_listings, block_excluded_pairs
+    ):
+        hosts_count, guests_count = deadline.affordable_block(len(block_hosts), len(block_guests))
+        if (hosts_count, guests_count) != (len(block_hosts), len(block_guests)):
+            print(
+                f"Shrinking block of {len(block_hosts)} hosts and {len(block_guests)} guests "
+                f"to {hosts_count} hosts and {guests_count} guests to meet the deadline"
+            )
+            block_hosts = block_hosts[:hosts_count]
+            block_guests = block_guests[:guests_count]
+        if hosts_count == 0 or guests_count == 0:
+            continue
+
+        kept = (excluded_host_indices < hosts_count) & (excluded_guest_indices < guests_count)
+        excluded_pairs = excluded_host_indices[kept], excluded_guest_indices[kept]
+
+        block_started = time.monotonic()
+        deadline.enter_phase("score")
+        cost_matrix = -evaluate_pairs_matrix(
+            *create_block_payload(block_hosts, block_guests, activity_boosts, excluded_pairs)
+        )
+        deadline.enter_phase("solve")
+        assignment = solve_assignment(cost_matrix, solver)
+        deadline.record_block(cost_matrix.size, time.monotonic() - block_started)
+        matches.extend((block_hosts[hi], block_guests[gi]) for hi, gi in assignment)
+
     return matches
 
 
+def solve_blocks_in_pool(payloads, workers, solver, deadline):
+    """Solve blocks with `solve_block` in a process pool.  Yield their assignments in block order.
+
+    Blocks not solved before the `deadline` get no matches.  The pool is terminated once all blocks
+    are yielded or the generator is closed, so workers still solving blocks do not outlive the run.
+    """
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = [pool.apply_async(solve_block, (payload, solver)) for payload in payloads]
+
+        unsolved = 0
+        for result in results:
+            remaining_seconds = deadline.remaining_seconds()
+            result.wait(None if remaining_seconds == math.inf else max(0.0, remaining_seconds))
+            if result.ready():
+                yield result.get()
+            else:
+                unsolved += 1
+                yield []
+        if unsolved > 0:
+            print(f"{unsolved} of {len(results)} blocks were not solved before the deadline")
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# Fields of listings checked by the hard constraints, see `evaluate_feasibility_matrix`
+HOST_FEASIBILITY_FIELDS = (
+    "country",
+    "closest_city",
+    "shelter_type",
+    "beds",
+    "acceptable_group_relations",
+    "ok_for_any_nationality",
+    "ok_for_elderly",
+    "ok_for_pregnant",
+    "ok_for_disabilities",
+    "ok_for_animals",
+    "duration_category",
+)
+GUEST_FEASIBILITY_FIELDS = (
+    "country",
+    "city",
+    "beds",
+    "is_pregnant",
+    "is_with_disability",
+    "is_with_animal",
+    "is_with_elderly",
+    "group_relation",
+    "acceptable_shelter_types",
+    "is_ukrainian_nationality",
+    "duration_category",
+)
+
+
+def listing_cache_key(listing):
+    """Hash the fields of `listing` checked by the hard constraints - equal keys mean equal feasibility.
+
+    The rid is left out, so the key is shared by all listings with the same needs or offer.
+    """
+    fields = HOST_FEASIBILITY_FIELDS if isinstance(listing, HostListing) else GUEST_FEASIBILITY_FIELDS
+    values = [
+        sorted(value) if isinstance(value, list) else value
+        for value in (getattr(listing, field) for field in fields)
+    ]
+    return hashlib.blake2b(json.dumps(values, default=str).encode(), digest_size=16).hexdigest()
+
+
+def update_feasibility_cache(cache: FeasibilityCache, hosts, guests, host_batch, guest_batch):
+    """Evaluate hard constraints of `hosts` x `guests`, only for pairs of listing keys missing from `cache`.
+
+    Return a `FeasibilityCache` of the keys of `hosts` and `guests`, with the cache row of every host
+    and the cache column of every guest.
+    """
+    host_keys = [listing_cache_key(host) for host in hosts]
+    guest_keys = [listing_cache_key(guest) for guest in guests]
+    # Every key is evaluated for the first listing having it
+    unique_host_keys = {}
+    for hi, key in enumerate(host_keys):
+        unique_host_keys.setdefault(key, hi)
+    unique_guest_keys = {}
+    for gi, key in enumerate(guest_keys):
+        unique_guest_keys.setdefault(key, gi)
+    host_representatives = np.array(list(unique_host_keys.values()), dtype=np.int64)
+    guest_representatives = np.array(list(unique_guest_keys.values()), dtype=np.int64)
+
+    cached_rows = np.array([cache.host_keys.get(key, -1) for key in unique_host_keys], dtype=np.int64)
+    cached_columns = np.array([cache.guest_keys.get(key, -1) for key in unique_guest_keys], dtype=np.int64)
+    cached_hosts = np.flatnonzero(cached_rows >= 0)
+    new_hosts = np.flatnonzero(cached_rows < 0)
+    cached_guests = np.flatnonzero(cached_columns >= 0)
+    new_guests = np.flatnonzero(cached_columns < 0)
+
+    feasible = np.zeros((len(unique_host_keys), len(unique_guest_keys)), dtype=bool)
+    feasible[np.ix_(cached_hosts, cached_guests)] = cache.feasible[
+        np.ix_(cached_rows[cached_hosts], cached_columns[cached_guests])
+    ]
+    feasible[new_hosts, :] = evaluate_feasibility_matrix(
+        select_batch_rows(host_batch, host_representatives[new_hosts]),
+        select_batch_rows(guest_batch, guest_representatives),
+    )
+    feasible[np.ix_(cached_hosts, new_guests)] = evaluate_feasibility_matrix(
+        select_batch_rows(host_batch, host_representatives[cached_hosts]),
+        select_batch_rows(guest_batch, guest_representatives[new_guests]),
+    )
+
+    reused_pairs = len(cached_hosts) * len(cached_guests)
+    print(
+        f"Feasibility cache: {len(hosts)} hosts and {len(guests)} guests have {len(unique_host_keys)} and "
+        f"{len(unique_guest_keys)} distinct keys, {len(cached_hosts)} and {len(cached_guests)} of them cached; "
+        f"reused {reused_pairs} of {feasible.size} pairs of keys "
+        f"({reused_pairs / feasible.size if feasible.size > 0 else 0.0:.1%} hit rate), "
+        f"evaluated {feasible.size - reused_pairs} instead of {len(hosts) * len(guests)} pairs of listings"
+    )
+
+    key_rows = {key: row for row, key in enumerate(unique_host_keys)}
+    key_columns = {key: column for column, key in enumerate(unique_guest_keys)}
+    return (
+        FeasibilityCache(host_keys=key_rows, guest_keys=key_columns, feasible=feasible),
+        np.array([key_rows[key] for key in host_keys], dtype=np.int64),
+        np.array([key_columns[key] for key in guest_keys], dtype=np.int64),
+    )
+
+
+def load_feasibility_cache(cache_path):
+    """Return the `FeasibilityCache` stored at `cache_path` (if any), else the one of this process.
+
+    The cache is stored as plain arrays (see `store_feasibility_cache`), so loading it executes no code.
+    """
+    global feasibility_cache
+    if cache_path and feasibility_cache is None and os.path.exists(cache_path):
+        with open(cache_path, "rb") as cache_file:
+            arrays = np.load(cache_file, allow_pickle=False)
+            feasibility_cache = FeasibilityCache(
+                host_keys={key: row for row, key in enumerate(arrays["host_keys"].tolist())},
+                guest_keys={key: column for column, key in enumerate(arrays["guest_keys"].tolist())},
+                feasible=arrays["feasible"],
+            )
+
+    return feasibility_cache or FeasibilityCache.empty()
+
+
+def store_feasibility_cache(cache, cache_path):
+    """Keep `cache` for the next run of this process and store it at `cache_path` (if any) in the .npz format."""
+    global feasibility_cache
+    feasibility_cache = cache
+    if cache_path:
+        with open(cache_path, "wb") as cache_file:
+            np.savez(
+                cache_file,
+                host_keys=np.array(list(cache.host_keys), dtype=str),
+                guest_keys=np.array(list(cache.guest_keys), dtype=str),
+                feasible=cache.feasible,
+            )
+
+
+def find_matches_incremental(
+    hosts, guests, activity_boosts, rid_pairs, cache_path=None, solver=MatchingSolver.EXACT, deadline=None
+):
+    """Match hosts and guests like `find_matches`, reusing hard constraints evaluated by the previous run.
+
+    Hard constraints depend only on a few fields of listings, see `listing_cache_key`, so they are
+    evaluated once per distinct host and guest, and only for those missing from the previous batch.
+    Only feasibility is cached.  Every listing of the batch is hashed on every run, because an updated
+    listing keeps its rid and db_ts_registered.  Soft scores depend on the time and on recent matches,
+    so they are evaluated for every pair of the batch anew, as are past matches.  They are sums of
+    per-listing boosters, cheap next to the hard constraints and solving.
+    The batch is shrunk before scoring if solving it is projected to overrun the `deadline`.
+    """
+    deadline = deadline or MatchingDeadline()
+    hosts_count, guests_count = deadline.affordable_block(len(hosts), len(guests))
+    if (hosts_count, guests_count) != (len(hosts), len(guests)):
+        print(f"Shrinking batch to {hosts_count} hosts and {guests_count} guests to meet the deadline")
+        hosts = hosts[:hosts_count]
+        guests = guests[:guests_count]
+
+    deadline.enter_phase("score")
+    host_batch, guest_batch = encode_listings(hosts, guests, activity_boosts)
+
+    cache, host_rows, guest_columns = update_feasibility_cache(
+        load_feasibility_cache(cache_path), hosts, guests, host_batch, guest_batch
+    )
+    store_feasibility_cache(cache, cache_path)
+
+    feasible = cache.feasible[np.ix_(host_rows, guest_columns)]
+    feasible[excluded_pair_indices(hosts, guests, rid_pairs)] = False
+    cost_matrix = -np.where(feasible, evaluate_soft_scores_matrix(host_batch, guest_batch), 0.0)
+
+    deadline.enter_phase("solve")
+    return [
+        (hosts[hi], guests[gi])
+        for hi, gi in solve_assignment(cost_matrix, solver)
+    ]
+
+
 # endregion
 
 
 # region Database data models
+# Tables reflected so far by (engine, table name), see `create_table_mapping`
+table_mappings = {}
+
+
 def create_table_mapping(db_pool, db_table_name):
-    meta = MetaData(db_pool)
-    tbl = Table(db_table_name, meta, autoload=True, autoload_with=db_pool)
+    """Return table `db_table_name` of `db_pool`.  A table is reflected once per process, then reused."""
+    key = (db_pool, db_table_name)
+    if key not in table_mappings:
+        meta = MetaData(db_pool)
+        table_mappings[key] = Table(db_table_name, meta, autoload=True, autoload_with=db_pool)
 
-    return tbl
+    return table_mappings[key]
 # endregion
 
 
@@ -314,6 +1244,34 @@ def default_value(value: str, default: str):
 
 def query_epoch_with_milliseconds():
     return int(time.time() * 1000)
+
+
+def region_filters(tbl, city_column, pubsub_msg, any_city_allowed=False):
+    """Build filters restricting a batch to the region (`country`, `city`) requested in `pubsub_msg`."""
+    filters = []
+    if pubsub_msg.get("country"):
+        filters.append(func.coalesce(tbl.c.country, "poland") == pubsub_msg["country"])
+    if pubsub_msg.get("city"):
+        if any_city_allowed:
+            filters.append(or_(city_column == pubsub_msg["city"], city_column.is_(None)))
+        else:
+            filters.append(city_column == pubsub_msg["city"])
+
+    return filters
+
+
+def recent_matches_threshold():
+    # day filter equals 3* timeout. If it would be 2*timeout we would almost always cut of the match whose timeout is
+    # approxemetely 2 timeouts ago.
+    return str(
+        int(
+            (
+                datetime.datetime.now()
+                - datetime.timedelta(hours=3 * int(MATCH_TIMEOUT_HOURS))
+            ).timestamp()
+            * 1000
+        )
+    )
 # endregion
 
 
@@ -344,11 +1302,158 @@ def change_guest_status(db_connection, db_guests_id, target_status):
     db_connection.execute(upd)
 
 
-def update_status_bulk(db_connection, tbl, id_col_name, ids, target_status):
+def claim_listings(db_connection, tbl, id_col_name, batch_size, region_filters, order_by=None, columns=None):
+    """Mark up to `batch_size` MOD_ACCEPTED listings as FNC_BEING_PROCESSED in a single statement.
+
+    Return the claimed rows (all columns unless `columns` are given).  Listings locked by another
+    matcher are skipped (FOR UPDATE SKIP LOCKED), so concurrent matchers never claim the same listing.
+    """
+    sel_ids = (
+        sqlalchemy.select(tbl.c[id_col_name])
+        .where(tbl.c.fnc_status == HostsGuestsStatus.MOD_ACCEPTED)
+        .where(*region_filters)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    if order_by is not None:
+        sel_ids = sel_ids.order_by(order_by)
 
     upd = (
         tbl.update()
-        .values(fnc_status=target_status)
+        .where(tbl.c[id_col_name].in_(sel_ids.scalar_subquery()))
+        .values(fnc_status=HostsGuestsStatus.FNC_BEING_PROCESSED, fnc_ts_claimed=str(query_epoch_with_milliseconds()))
+        .returning(*(columns if columns is not None else tbl.c))
+    )
+
+    result = db_connection.execute(upd)
+    target_status = HostsGuestsStatus.FNC_BEING_PROCESSED
+    print(f"Claimed {tbl.name}.{id_col_name}. Status set to {target_status} ({target_status.value}) for {result.rowcount} rows.")
+
+    return result
+
+
+def release_stale_claims(db_connection, tbl, id_col_name, claimed_before, resample=False):
+    """Release FNC_BEING_PROCESSED listings claimed before `claimed_before` (epoch with milliseconds).
+
+    A run stopped by the platform, e.g. on the function timeout, never releases the listings it claimed.
+    Listings claimed before `fnc_ts_claimed` was added have no claim time and are released too.
+    """
+    values = dict(fnc_status=HostsGuestsStatus.MOD_ACCEPTED)
+    if resample:
+        # Released listings get a fresh position in the sampling order, see `claim_sampled_listings`
+        values["sampling_key"] = func.random()
+
+    upd = (
+        tbl.update()
+        .where(tbl.c.fnc_status == HostsGuestsStatus.FNC_BEING_PROCESSED)
+        .where(or_(tbl.c.fnc_ts_claimed.is_(None), tbl.c.fnc_ts_claimed < str(claimed_before)))
+        .values(**values)
+    )
+
+    result = db_connection.execute(upd)
+    if result.rowcount > 0:
+        print(f"Released {result.rowcount} stale claims of {tbl.name}.{id_col_name}")
+
+
+def claim_sampled_listings(db_connection, tbl, id_col_name, batch_size, region_filters, columns=None):
+    """Claim a random sample of listings, see `claim_listings`.  Return the claimed rows.
+
+    Walks the (fnc_status, sampling_key) index from a random starting key and wraps around,
+    so the cost is proportional to `batch_size` instead of sorting the whole table by random().
+
+    The sample is not exactly uniform: a listing is claimed first when the starting key falls into
+    the gap below its sampling_key, so listings after larger gaps are claimed first more often.
+    Keys are independent and uniform, so gaps differ little once there are many listings per batch,
+    and the bias of a listing does not persist - released listings get a new sampling_key, see
+    `update_status_bulk`, and matched ones leave the pool.  A batch covering all listings is unbiased.
+    """
+    start_key = random.random()
+
+    rows = claim_listings(
+        db_connection=db_connection,
+        tbl=tbl,
+        id_col_name=id_col_name,
+        batch_size=batch_size,
+        region_filters=[*region_filters, tbl.c.sampling_key >= start_key],
+        order_by=tbl.c.sampling_key,
+        columns=columns,
+    ).fetchall()
+
+    if len(rows) < batch_size:
+        rows += claim_listings(
+            db_connection=db_connection,
+            tbl=tbl,
+            id_col_name=id_col_name,
+            batch_size=batch_size - len(rows),
+            region_filters=[*region_filters, tbl.c.sampling_key < start_key],
+            order_by=tbl.c.sampling_key,
+            columns=columns,
+        ).fetchall()
+
+    return rows
+
+
+def claim_guests(db_connection, tbl_guests, batch_size, region_filters, guests_sampling, columns=None):
+    """Claim a random batch of guests using the `guests_sampling` strategy."""
+    if guests_sampling == GuestsSampling.INDEXED:
+        return claim_sampled_listings(
+            db_connection=db_connection,
+            tbl=tbl_guests,
+            id_col_name='db_guests_id',
+            batch_size=batch_size,
+            region_filters=region_filters,
+            columns=columns,
+        )
+
+    return claim_listings(
+        db_connection=db_connection,
+        tbl=tbl_guests,
+        id_col_name='db_guests_id',
+        batch_size=batch_size,
+        region_filters=region_filters,
+        order_by=func.random(),
+        columns=columns,
+    )
+
+
+def insert_matches_bulk(db_connection, tbl_matches, matches):
+    """Insert (host rid, guest rid) `matches` with multi-row INSERTs.  Return generated db_matches_ids."""
+    db_matches_ids = []
+
+    for chunk_start in range(0, len(matches), MATCHES_INSERT_CHUNK_SIZE):
+        ins_matches = (
+            tbl_matches.insert()
+            .values(
+                [
+                    dict(
+                        # db_ts_matched=f"{query_epoch_with_milliseconds()}",
+                        fnc_status=MatchesStatus.DEFAULT,
+                        fnc_hosts_id=host_rid,
+                        fnc_guests_id=guest_rid,
+                        fnc_host_status=MatchesStatus.DEFAULT,
+                        fnc_guest_status=MatchesStatus.DEFAULT,
+                    )
+                    for host_rid, guest_rid in matches[chunk_start:chunk_start + MATCHES_INSERT_CHUNK_SIZE]
+                ]
+            )
+            .returning(tbl_matches.c.db_matches_id)
+        )
+
+        db_matches_ids.extend(row["db_matches_id"] for row in db_connection.execute(ins_matches))
+
+    return db_matches_ids
+
+
+def update_status_bulk(db_connection, tbl, id_col_name, ids, target_status, resample=False):
+
+    values = dict(fnc_status=target_status)
+    if resample:
+        # Released listings get a fresh position in the sampling order, see `claim_sampled_listings`
+        values["sampling_key"] = func.random()
+
+    upd = (
+        tbl.update()
+        .values(**values)
         .where(tbl.c[id_col_name].in_(ids))
     )
 
@@ -371,30 +1476,40 @@ def fnc_target(event, context):
 # endregion
 
 
-# region Main function
-def create_matching(pubsub_msg):
-    HOSTS_MATCHING_BATCH_SIZE = configuration_context["HOSTS_MATCHING_BATCH_SIZE"]
-    GUESTS_MATCHING_BATCH_SIZE = configuration_context["GUESTS_MATCHING_BATCH_SIZE"]
-    global MATCH_TIMEOUT_HOURS
-    MATCH_TIMEOUT_HOURS = configuration_context["MATCH_TIMEOUT_HOURS"]
-
-    tbl_matches = create_table_mapping(db_pool=db, db_table_name=os.environ["MATCHES_TABLE_NAME"])
-    tbl_guests = create_table_mapping(db_pool=db, db_table_name=os.environ["GUESTS_TABLE_NAME"])
-    tbl_hosts = create_table_mapping(db_pool=db, db_table_name=os.environ["HOSTS_TABLE_NAME"])
+# region Matching phases
+def match_listings(
+    run,
+    tbl_hosts,
+    tbl_guests,
+    hosts_batch_size,
+    guests_batch_size,
+    hosts_region_filters,
+    guests_region_filters,
+    matching_mode,
+    workers,
+    guests_sampling,
+    cache_path=None,
+    solver=MatchingSolver.EXACT,
+):
+    """Claim a batch of hosts and guests, evaluate all their pairs in Python and match them.
+
+    Claimed hosts rids, claimed guests rids and matched (host rid, guest rid) pairs are stored in `run`.
+    """
+    run.deadline.enter_phase("load")
 
     # region Preparing hosts dataset
     print("Preparing hosts dataset")
     hosts = []
 
-    sel_hosts = (
-        tbl_hosts.select()
-        .limit(HOSTS_MATCHING_BATCH_SIZE)
-        .where(tbl_hosts.c.fnc_status == HostsGuestsStatus.MOD_ACCEPTED)
-    )
-
     with db.connect() as conn:
         with conn.begin():
-            result = conn.execute(sel_hosts)
+            result = claim_listings(
+                db_connection=conn,
+                tbl=tbl_hosts,
+                id_col_name='db_hosts_id',
+                batch_size=hosts_batch_size,
+                region_filters=hosts_region_filters,
+            )
 
             for row in result:
 
@@ -438,14 +1553,7 @@ def create_matching(pubsub_msg):
                 print(hosts)
 
             hosts_rids_set = set(element.rid for element in hosts)
-
-            update_status_bulk(
-                db_connection=conn,
-                tbl=tbl_hosts,
-                target_status=HostsGuestsStatus.FNC_BEING_PROCESSED,
-                id_col_name='db_hosts_id',
-                ids=hosts_rids_set,
-            )
+            run.hosts_rids = hosts_rids_set
 
     # endregion
 
@@ -453,16 +1561,15 @@ def create_matching(pubsub_msg):
     print("Preparing guests dataset")
     guests = []
 
-    sel_guests = (
-        tbl_guests.select()
-        .limit(GUESTS_MATCHING_BATCH_SIZE)
-        .where(tbl_guests.c.fnc_status == HostsGuestsStatus.MOD_ACCEPTED)
-        .order_by(func.random())
-    )
-
     with db.connect() as conn:
         with conn.begin():
-            result = conn.execute(sel_guests)
+            result = claim_guests(
+                db_connection=conn,
+                tbl_guests=tbl_guests,
+                batch_size=guests_batch_size,
+                region_filters=guests_region_filters,
+                guests_sampling=guests_sampling,
+            )
 
             for row in result:
                 guests.append(
@@ -502,14 +1609,7 @@ def create_matching(pubsub_msg):
                 print(guests)
 
             guests_rids_set = set(element.rid for element in guests)
-
-            update_status_bulk(
-                db_connection=conn,
-                tbl=tbl_guests,
-                target_status=HostsGuestsStatus.FNC_BEING_PROCESSED,
-                id_col_name='db_guests_id',
-                ids=guests_rids_set,
-            )
+            run.guests_rids = guests_rids_set
 
     # endregion
 
@@ -520,65 +1620,436 @@ def create_matching(pubsub_msg):
         with conn.begin():
 
             # Create rid_pairs set
-            existing_pairs_stmt = sqlalchemy.text(
-                f"SELECT DISTINCT ma.db_ts_matched, ma.fnc_hosts_id, ma.fnc_guests_id FROM matches ma JOIN hosts ho ON ma.fnc_hosts_id = ho.db_hosts_id JOIN guests gu ON ma.fnc_guests_id = gu.db_guests_id WHERE ho.fnc_status = '075' OR gu.fnc_status = '075';"
-            )
-            existing_pairs_result = conn.execute(existing_pairs_stmt)
+            existing_pairs_result = stream_rows(conn, sqlalchemy.text(EXISTING_PAIRS_QUERY))
             rid_pairs = set()
             for row in existing_pairs_result:
                 rid_pairs.add((row["fnc_hosts_id"], row["fnc_guests_id"]))
                 
-            # Create recent_matches list
-            sel_matches_stmt = tbl_matches.select()
-            sel_matches_result = conn.execute(sel_matches_stmt)
-            recent_matches = []
-            # day filter equals 3* timeout. If it would be 2*timeout we would almost always cut of the match whose timeout is
-            # approxemetely 2 timeouts ago.
-            day_filter = str(
-                int(
-                    (
-                        datetime.datetime.now()
-                        - datetime.timedelta(hours=3 * int(MATCH_TIMEOUT_HOURS))
-                    ).timestamp()
-                    * 1000
-                )
+            # Collect activity of listings in recent matches
+            recent_activity_result = stream_rows(
+                conn, sqlalchemy.text(RECENT_ACTIVITY_QUERY), {"day_filter": recent_matches_threshold()}
             )
-            for row in sel_matches_result:
-                if row["db_ts_matched"] > day_filter:
-                    recent_matches.append(row)
+            activity_boosts = index_activity_boosts(recent_activity_result)
 
     # endregion
 
     # region Looking for matches
     print("Looking for matches")
     matches = []
-    if len(hosts) > 0 and len(guests) > 0:
-        matches = find_matches(hosts, guests, recent_matches, rid_pairs)
-    # print(f"found best matches in iteration {current_iteration}: {len(matches)}")
-    print(f"found best matches in iteration {current_iteration}")
-
+    try:
+        if len(hosts) > 0 and len(guests) > 0:
+            if matching_mode == MatchingMode.BLOCKED:
+                find_matches_blocked(
+                    hosts,
+                    guests,
+                    activity_boosts,
+                    rid_pairs,
+                    workers=workers,
+                    solver=solver,
+                    deadline=run.deadline,
+                    matches=matches,
+                )
+            elif matching_mode == MatchingMode.INCREMENTAL:
+                matches += find_matches_incremental(
+                    hosts,
+                    guests,
+                    activity_boosts,
+                    rid_pairs,
+                    cache_path=cache_path,
+                    solver=solver,
+                    deadline=run.deadline,
+                )
+            else:
+                matches += find_matches(
+                    hosts, guests, activity_boosts, rid_pairs, solver=solver, deadline=run.deadline
+                )
+    finally:
+        # Blocks solved before a failure are committed too
+        run.matches = [(host.rid, guest.rid) for host, guest in matches]
+
+
+# Past matches of listings being processed, they are not matched again
+EXISTING_PAIRS_QUERY = "SELECT DISTINCT ma.db_ts_matched, ma.fnc_hosts_id, ma.fnc_guests_id FROM matches ma JOIN hosts ho ON ma.fnc_hosts_id = ho.db_hosts_id JOIN guests gu ON ma.fnc_guests_id = gu.db_guests_id WHERE ho.fnc_status = '075' OR gu.fnc_status = '075';"
+
+
+# Timeouts and rejections of listings which responded to their matches since :day_filter,
+# uses index on matches.db_ts_matched
+RECENT_ACTIVITY_CTES = f"""
+recent_matches AS (
+    SELECT fnc_hosts_id, fnc_guests_id, fnc_host_status, fnc_guest_status, fnc_status
+    FROM {os.environ['MATCHES_TABLE_NAME']}
+    WHERE db_ts_matched > :day_filter
+    AND fnc_status IN ('{MatchesStatus.MATCH_TIMEOUT.value}', '{MatchesStatus.MATCH_REJECTED.value}')
+), hosts_activity AS (
+    SELECT fnc_hosts_id,
+        count(*) FILTER (WHERE fnc_status = '{MatchesStatus.MATCH_TIMEOUT.value}') AS timeouts,
+        count(*) FILTER (WHERE fnc_status = '{MatchesStatus.MATCH_REJECTED.value}') AS rejections
+    FROM recent_matches
+    WHERE fnc_host_status IN ('{MatchesStatus.MATCH_ACCEPTED.value}', '{MatchesStatus.MATCH_REJECTED.value}')
+    GROUP BY fnc_hosts_id
+), guests_activity AS (
+    SELECT fnc_guests_id,
+        count(*) FILTER (WHERE fnc_status = '{MatchesStatus.MATCH_TIMEOUT.value}') AS timeouts,
+        count(*) FILTER (WHERE fnc_status = '{MatchesStatus.MATCH_REJECTED.value}') AS rejections
+    FROM recent_matches
+    WHERE fnc_guest_status IN ('{MatchesStatus.MATCH_ACCEPTED.value}', '{MatchesStatus.MATCH_REJECTED.value}')
+    GROUP BY fnc_guests_id
+)"""
+
+
+RECENT_ACTIVITY_QUERY = f"""
+WITH {RECENT_ACTIVITY_CTES}
+SELECT 'host' AS listing_type, fnc_hosts_id AS listing_id, timeouts, rejections FROM hosts_activity
+UNION ALL
+SELECT 'guest' AS listing_type, fnc_guests_id AS listing_id, timeouts, rejections FROM guests_activity;
+"""
+
+
+CANDIDATE_PAIRS_QUERY = f"""
+WITH {RECENT_ACTIVITY_CTES}
+SELECT
+    ho.db_hosts_id, ho.db_ts_registered AS host_ts_registered,
+    coalesce(hac.timeouts, 0) AS host_timeouts, coalesce(hac.rejections, 0) AS host_rejections,
+    gu.db_guests_id, gu.db_ts_registered AS guest_ts_registered,
+    coalesce(gac.timeouts, 0) AS guest_timeouts, coalesce(gac.rejections, 0) AS guest_rejections
+FROM {os.environ['HOSTS_TABLE_NAME']} ho
+JOIN {os.environ['GUESTS_TABLE_NAME']} gu ON coalesce(gu.country, 'poland') = coalesce(ho.country, 'poland')
+    AND (gu.is_pregnant IS DISTINCT FROM 'TRUE' OR ho.ok_for_pregnant = 'TRUE')
+    AND (gu.is_with_disability IS DISTINCT FROM 'TRUE' OR ho.ok_for_disabilities = 'TRUE')
+    AND (gu.is_with_animal IS DISTINCT FROM 'TRUE' OR ho.ok_for_animals = 'TRUE')
+    AND (gu.is_with_elderly IS DISTINCT FROM 'TRUE' OR ho.ok_for_elderly = 'TRUE')
+    AND (gu.is_ukrainian_nationality = 'TRUE' OR ho.ok_for_any_nationality = 'TRUE')
+    AND array_position(ARRAY{DURATION_CATEGORIES}::VARCHAR[], btrim(ho.duration_category, '{{ }}'))
+        >= array_position(ARRAY{DURATION_CATEGORIES}::VARCHAR[], btrim(gu.duration_category, '{{ }}'))
+    AND btrim(gu.group_relation, '{{ }}') = ANY(string_to_array(btrim(ho.acceptable_group_relations, '{{ }}'), ','))
+    AND btrim(ho.shelter_type, '{{ }}') = ANY(string_to_array(btrim(gu.acceptable_shelter_types, '{{ }}'), ','))
+    AND ho.beds >= gu.beds
+    AND (gu.city IS NULL OR ho.closest_city = gu.city)
+LEFT JOIN hosts_activity hac ON hac.fnc_hosts_id = ho.db_hosts_id
+LEFT JOIN guests_activity gac ON gac.fnc_guests_id = gu.db_guests_id
+WHERE ho.db_hosts_id = ANY(CAST(:hosts_ids AS VARCHAR[]))
+AND gu.db_guests_id = ANY(CAST(:guests_ids AS VARCHAR[]))
+AND NOT EXISTS (
+    SELECT 1 FROM {os.environ['MATCHES_TABLE_NAME']} ma
+    WHERE ma.fnc_hosts_id = ho.db_hosts_id AND ma.fnc_guests_id = gu.db_guests_id
+);
+"""
+
+
+def claim_listing_ids(tbl, id_col_name, batch_size, region_filters, guests_sampling=None):
+    """Claim a batch of listings, see `claim_listings` and `claim_guests`.  Return the set of their ids."""
     with db.connect() as conn:
         with conn.begin():
-            print(f"Inserting matches and updating statuses")
-            for host, guest in matches:
-                # print(f"match (guest={guest.rid}, host={host.rid})")
-
-                ins_match = tbl_matches.insert().values(
-                    # db_ts_matched=f"{query_epoch_with_milliseconds()}",
-                    fnc_status=MatchesStatus.DEFAULT,
-                    fnc_hosts_id=host.rid,
-                    fnc_guests_id=guest.rid,
-                    fnc_host_status=MatchesStatus.DEFAULT,
-                    fnc_guest_status=MatchesStatus.DEFAULT,
+            if guests_sampling is not None:
+                result = claim_guests(
+                    db_connection=conn,
+                    tbl_guests=tbl,
+                    batch_size=batch_size,
+                    region_filters=region_filters,
+                    guests_sampling=guests_sampling,
+                    columns=[tbl.c[id_col_name]],
+                )
+            else:
+                result = claim_listings(
+                    db_connection=conn,
+                    tbl=tbl,
+                    id_col_name=id_col_name,
+                    batch_size=batch_size,
+                    region_filters=region_filters,
+                    columns=[tbl.c[id_col_name]],
                 )
 
-                conn.execute(ins_match)
-            print('Finished inserting matches')
+            return {row[id_col_name] for row in result}
+
+
+def query_candidate_pairs(hosts_rids_set, guests_rids_set):
+    """Ask the database for all feasible (host, guest) pairs of the batch together with their activity points."""
+    with db.connect() as conn:
+        # Ids are bound as two arrays, any number of them fits in the bind parameters
+        result = conn.execute(
+            sqlalchemy.text(CANDIDATE_PAIRS_QUERY),
+            {
+                "day_filter": recent_matches_threshold(),
+                "hosts_ids": list(hosts_rids_set),
+                "guests_ids": list(guests_rids_set),
+            },
+        )
+
+        return result.fetchall()
+
+
+def evaluate_candidate_pairs(candidate_pairs):
+    """Score feasible pairs returned by `query_candidate_pairs`, in the same way as `evaluate_pair`."""
+    registration_recency_boosts = {}
+
+    def recency_boost(ts_registered):
+        if ts_registered not in registration_recency_boosts:
+            registration_recency_boosts[ts_registered] = registration_recency_boost(
+                epoch_with_milliseconds_to_datetime(ts_registered)
+            )
+        return registration_recency_boosts[ts_registered]
+
+    transport_included = np.zeros(len(candidate_pairs), dtype=np.int64)  # FIXME: placeholder
+    host_activity_boost = np.array(
+        [activity_boost(activity_points(row["host_timeouts"], row["host_rejections"])) for row in candidate_pairs]
+    )
+    guest_activity_boost = np.array(
+        [activity_boost(activity_points(row["guest_timeouts"], row["guest_rejections"])) for row in candidate_pairs]
+    )
+    host_recency_boost = np.array([recency_boost(row["host_ts_registered"]) for row in candidate_pairs])
+    guest_recency_boost = np.array([recency_boost(row["guest_ts_registered"]) for row in candidate_pairs])
+
+    score = np.full(len(candidate_pairs), 0.79)
+    score += 0.01 * transport_included
+    score += host_activity_boost
+    score += guest_activity_boost
+    score += host_recency_boost
+    score += guest_recency_boost
+
+    return score
+
+
+def find_matches_in_candidate_pairs(
+    host_rids, guest_rids, scores, solver=MatchingSolver.EXACT, deadline=None, matches=None
+):
+    """Match hosts and guests given as a sparse list of feasible pairs.  Return matched (host rid, guest rid) pairs.
+
+    Connected components of the pairs graph are independent matching problems,
+    so a dense cost matrix is only allocated per component.  The greedy `solver`
+    works on the pairs directly and needs no cost matrix at all.
+    Components projected to overrun the `deadline` are shrunk or skipped.
+    Matches of every component are appended to `matches` (if given) as soon as it is solved.
+    """
+    deadline = deadline or MatchingDeadline()
+    matches = [] if matches is None else matches
+    deadline.enter_phase("solve")
+
+    host_index = {rid: hi for hi, rid in enumerate(dict.fromkeys(host_rids))}
+    guest_index = {rid: gi for gi, rid in enumerate(dict.fromkeys(guest_rids))}
+    host_indices = np.array([host_index[rid] for rid in host_rids], dtype=np.int64)
+    guest_indices = np.array([guest_index[rid] for rid in guest_rids], dtype=np.int64)
+
+    host_rids_by_index = list(host_index)
+    guest_rids_by_index = list(guest_index)
+
+    if solver == MatchingSolver.GREEDY:
+        print(f"Matching {len(scores)} candidate pairs greedily")
+        matches.extend(
+            (host_rids_by_index[hi], guest_rids_by_index[gi])
+            for hi, gi in greedy_assignment(host_indices, guest_indices, -scores)
+        )
+        return matches
+
+    # Hosts and guests are the nodes of a single bipartite graph: hosts first, guests after them
+    graph = scipy.sparse.coo_matrix(
+        (np.ones(len(scores)), (host_indices, len(host_index) + guest_indices)),
+        shape=(len(host_index) + len(guest_index),) * 2,
+    )
+    components_count, labels = scipy.sparse.csgraph.connected_components(graph, directed=False)
+    print(f"Matching {len(scores)} candidate pairs in {components_count} blocks")
+
+    host_labels = labels[:len(host_index)]
+    guest_labels = labels[len(host_index):]
+
+    # Hosts, guests and pairs grouped by component, in their original order within a component
+    def group_by_component(component_labels):
+        order = np.argsort(component_labels, kind="stable")
+        return order, np.searchsorted(component_labels[order], np.arange(components_count + 1))
+
+    host_order, host_bounds = group_by_component(host_labels)
+    guest_order, guest_bounds = group_by_component(guest_labels)
+    pair_order, pair_bounds = group_by_component(host_labels[host_indices])
+
+    for label in range(components_count):
+        pairs = pair_order[pair_bounds[label]:pair_bounds[label + 1]]
+        if len(pairs) == 0:
+            continue
+
+        block_hosts = host_order[host_bounds[label]:host_bounds[label + 1]]
+        block_guests = guest_order[guest_bounds[label]:guest_bounds[label + 1]]
+        hosts_count, guests_count = deadline.affordable_block(len(block_hosts), len(block_guests))
+        if (hosts_count, guests_count) != (len(block_hosts), len(block_guests)):
+            print(
+                f"Shrinking block of {len(block_hosts)} hosts and {len(block_guests)} guests "
+                f"to {hosts_count} hosts and {guests_count} guests to meet the deadline"
+            )
+            if hosts_count == 0 or guests_count == 0:
+                continue
+            block_hosts = block_hosts[:hosts_count]
+            block_guests = block_guests[:guests_count]
+            pairs = pairs[np.isin(host_indices[pairs], block_hosts) & np.isin(guest_indices[pairs], block_guests)]
+
+        started = time.monotonic()
+        cost_matrix = np.zeros((len(block_hosts), len(block_guests)))
+        cost_matrix[
+            np.searchsorted(block_hosts, host_indices[pairs]),
+            np.searchsorted(block_guests, guest_indices[pairs]),
+        ] = -scores[pairs]
+
+        matches.extend(
+            (host_rids_by_index[block_hosts[hi]], guest_rids_by_index[block_guests[gi]])
+            for hi, gi in solve_assignment(cost_matrix)
+        )
+        deadline.record_block(cost_matrix.size, time.monotonic() - started)
+
+    return matches
+
+
+def match_candidate_pairs(
+    run,
+    tbl_hosts,
+    tbl_guests,
+    hosts_batch_size,
+    guests_batch_size,
+    hosts_region_filters,
+    guests_region_filters,
+    guests_sampling,
+    solver=MatchingSolver.EXACT,
+):
+    """Claim a batch of hosts and guests and match them using feasible pairs generated by the database.
+
+    Claimed hosts rids, claimed guests rids and matched (host rid, guest rid) pairs are stored in `run`.
+    """
+    run.deadline.enter_phase("load")
+
+    print("Claiming hosts and guests")
+    run.hosts_rids = claim_listing_ids(tbl_hosts, "db_hosts_id", hosts_batch_size, hosts_region_filters)
+    run.guests_rids = claim_listing_ids(
+        tbl_guests, "db_guests_id", guests_batch_size, guests_region_filters, guests_sampling=guests_sampling
+    )
+
+    if len(run.hosts_rids) == 0 or len(run.guests_rids) == 0:
+        return
+
+    print("Getting candidate pairs")
+    candidate_pairs = query_candidate_pairs(run.hosts_rids, run.guests_rids)
+
+    print("Looking for matches")
+    if len(candidate_pairs) > 0:
+        run.deadline.enter_phase("score")
+        scores = evaluate_candidate_pairs(candidate_pairs)
+        find_matches_in_candidate_pairs(
+            [row["db_hosts_id"] for row in candidate_pairs],
+            [row["db_guests_id"] for row in candidate_pairs],
+            scores,
+            solver=solver,
+            deadline=run.deadline,
+            matches=run.matches,
+        )
+# endregion
+
+
+# region Main function
+def create_matching(pubsub_msg):
+    # The function timeout counts from the start, so does the matching time budget
+    MATCHING_TIME_BUDGET_SECONDS = float(
+        configuration_context.get("MATCHING_TIME_BUDGET_SECONDS", DEFAULT_MATCHING_TIME_BUDGET_SECONDS)
+    )
+    MATCHING_WRITE_RESERVE_SECONDS = float(configuration_context.get("MATCHING_WRITE_RESERVE_SECONDS", 30))
+    run = MatchingRun(
+        deadline=MatchingDeadline(
+            budget_seconds=MATCHING_TIME_BUDGET_SECONDS,
+            write_reserve_seconds=MATCHING_WRITE_RESERVE_SECONDS,
+        )
+    )
+    MATCHING_STALE_CLAIM_SECONDS = float(
+        configuration_context.get("MATCHING_STALE_CLAIM_SECONDS", DEFAULT_MATCHING_STALE_CLAIM_SECONDS)
+    )
+
+    HOSTS_MATCHING_BATCH_SIZE = configuration_context["HOSTS_MATCHING_BATCH_SIZE"]
+    GUESTS_MATCHING_BATCH_SIZE = configuration_context["GUESTS_MATCHING_BATCH_SIZE"]
+    global MATCH_TIMEOUT_HOURS
+    MATCH_TIMEOUT_HOURS = configuration_context["MATCH_TIMEOUT_HOURS"]
+    MATCHING_MODE = MatchingMode(configuration_context.get("MATCHING_MODE", MatchingMode.DENSE.value))
+    MATCHING_WORKERS = int(configuration_context.get("MATCHING_WORKERS", 1))
+    MATCHING_CANDIDATES = CandidatesSource(
+        configuration_context.get("MATCHING_CANDIDATES", CandidatesSource.PYTHON.value)
+    )
+    GUESTS_SAMPLING = GuestsSampling(configuration_context.get("GUESTS_SAMPLING", GuestsSampling.RANDOM.value))
+    MATCHING_CACHE_PATH = configuration_context.get("MATCHING_CACHE_PATH")
+    MATCHING_SOLVER = MatchingSolver(configuration_context.get("MATCHING_SOLVER", MatchingSolver.EXACT.value))
+
+    tbl_matches = create_table_mapping(db_pool=db, db_table_name=os.environ["MATCHES_TABLE_NAME"])
+    tbl_guests = create_table_mapping(db_pool=db, db_table_name=os.environ["GUESTS_TABLE_NAME"])
+    tbl_hosts = create_table_mapping(db_pool=db, db_table_name=os.environ["HOSTS_TABLE_NAME"])
+
+    # Listings left claimed by runs which never finished are matched again
+    with db.connect() as conn:
+        with conn.begin():
+            claimed_before = query_epoch_with_milliseconds() - int(MATCHING_STALE_CLAIM_SECONDS * 1000)
+            release_stale_claims(conn, tbl_hosts, "db_hosts_id", claimed_before)
+            release_stale_claims(
+                conn, tbl_guests, "db_guests_id", claimed_before, resample=GUESTS_SAMPLING == GuestsSampling.INDEXED
+            )
+
+    # Matchers started for different regions can run concurrently, see `claim_listings`
+    hosts_region_filters = region_filters(tbl_hosts, tbl_hosts.c.closest_city, pubsub_msg)
+    guests_region_filters = region_filters(tbl_guests, tbl_guests.c.city, pubsub_msg, any_city_allowed=True)
+
+    # Whatever happens during matching, matches found so far are committed and claimed listings are released
+    matching_error = None
+    try:
+        if MATCHING_CANDIDATES == CandidatesSource.SQL:
+            match_candidate_pairs(
+                run,
+                tbl_hosts,
+                tbl_guests,
+                HOSTS_MATCHING_BATCH_SIZE,
+                GUESTS_MATCHING_BATCH_SIZE,
+                hosts_region_filters,
+                guests_region_filters,
+                GUESTS_SAMPLING,
+                MATCHING_SOLVER,
+            )
+        else:
+            match_listings(
+                run,
+                tbl_hosts,
+                tbl_guests,
+                HOSTS_MATCHING_BATCH_SIZE,
+                GUESTS_MATCHING_BATCH_SIZE,
+                hosts_region_filters,
+                guests_region_filters,
+                MATCHING_MODE,
+                MATCHING_WORKERS,
+                GUESTS_SAMPLING,
+                MATCHING_CACHE_PATH,
+                MATCHING_SOLVER,
+            )
+        # print(f"found best matches in iteration {current_iteration}: {len(matches)}")
+        print(f"found best matches in iteration {current_iteration}")
+    except Exception as e:
+        matching_error = e
+        raise
+    finally:
+        run.deadline.enter_phase("write")
+        try:
+            write_matching(run, tbl_matches, GUESTS_SAMPLING)
+        except Exception as e:
+            if matching_error is None:
+                raise
+            # Keep raising the error of the matching, which caused this run to fail
+            print(f"Writing matches failed after matching failed with {matching_error!r}: {e!r}")
+        run.deadline.report()
+
+
+def write_matching(run, tbl_matches, guests_sampling):
+    """Insert matches of `run` and update statuses of its claimed listings - matched or released."""
+    hosts_rids_set, guests_rids_set, matches = run.hosts_rids, run.guests_rids, run.matches
+
+    with db.connect() as conn:
+        with conn.begin():
+            print(f"Inserting matches and updating statuses")
+            db_matches_ids = insert_matches_bulk(
+                db_connection=conn,
+                tbl_matches=tbl_matches,
+                matches=matches,
+            )
+            print(f'Finished inserting {len(db_matches_ids)} matches')
 
             # region Update col fnc_status in tbl hosts
 
-            matched_hosts_set = {host.rid for host, guest in matches}
-            hosts_rids_set = set(element.rid for element in hosts)
+            matched_hosts_set = {host_rid for host_rid, guest_rid in matches}
             # Hosts with match 
             hosts_rids_set_matched_hosts_set_intersection = hosts_rids_set & matched_hosts_set #FIXME TBH we could probably use matched_hosts_set without this operation - no time to check, so i'm leaving it as is
             # Hosts without a match
@@ -606,8 +2077,7 @@ def create_matching(pubsub_msg):
 
             # region Update col fnc_status in tbl guests
 
-            matched_guests_set = {guest.rid for host, guest in matches}
-            guests_rids_set = set(element.rid for element in guests)
+            matched_guests_set = {guest_rid for host_rid, guest_rid in matches}
             # Guests with match 
             guests_rids_set_matched_guests_set_intersection = guests_rids_set & matched_guests_set #FIXME TBH we could probably use matched_guests_set without this operation - no time to check, so i'm leaving it as is
             # Guests without a match
@@ -629,6 +2099,7 @@ def create_matching(pubsub_msg):
                 target_status=HostsGuestsStatus.MOD_ACCEPTED,
                 id_col_name='db_guests_id',
                 ids=guests_rids_set_matched_guests_set_difference,
+                resample=guests_sampling == GuestsSampling.INDEXED,
             )
 
             # endregion
@@ -2,12 +2,11 @@ import os
 import sqlalchemy
 import base64
 import json
+import threading
 import time
 
 from enum import Enum
 
-import i18n
-
 from sqlalchemy import create_engine
 from sqlalchemy import Table
 from sqlalchemy import MetaData
@@ -45,16 +44,104 @@ else:
 
 
 # region database connectivity
+# shared: _build/shared/database_connectivity.py, edit it there and run `python _build/sync_shared.py`
+# Database driver: pg8000 (pure Python) or psycopg2 (libpq, faster with large results)
+DB_DRIVER = os.getenv("DB_DRIVER", "pg8000")
+
+# Connection pool of the function instance, kept between invocations of a warm instance.
+# An instance handles one request at a time, which checks out at most 2 connections at once (nested `db.connect()`),
+# the overflow covers deeper nesting.  Pools are small on purpose: every instance of every function keeps its own
+# pool against the connection limit of the Cloud SQL instance, SQLAlchemy defaults would allow 15 per instance.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 2))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 2))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# Disabled with 0
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 0))
+# Checkouts waiting for a connection longer than that are logged
+DB_SLOW_CHECKOUT_MS = float(os.getenv("DB_SLOW_CHECKOUT_MS", 100))
+
+# Connection checkouts of the instance: count, total and longest wait for a connection
+db_pool_metrics = dict(checkouts=0, wait_seconds=0.0, max_wait_seconds=0.0)
+
+
+class TimedQueuePool(sqlalchemy.pool.QueuePool):
+    """Queue pool measuring how long checkouts wait for a free connection, see `db_pool_metrics`.
+
+    Only the wait for the pool is measured: opening a new connection and the pre-ping are not part of it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._checkout_timing = threading.local()
+
+    def _do_get(self):
+        timing = self._checkout_timing
+        if getattr(timing, "started", None) is not None:
+            # QueuePool retries a checkout by calling `_do_get` again, which is part of the same wait
+            return super()._do_get()
+
+        timing.started = time.perf_counter()
+        timing.connect_seconds = 0.0
+        try:
+            connection_record = super()._do_get()
+            wait_seconds = time.perf_counter() - timing.started - timing.connect_seconds
+        finally:
+            timing.started = None
+
+        db_pool_metrics["checkouts"] += 1
+        db_pool_metrics["wait_seconds"] += wait_seconds
+        db_pool_metrics["max_wait_seconds"] = max(db_pool_metrics["max_wait_seconds"], wait_seconds)
+        if wait_seconds * 1000 >= DB_SLOW_CHECKOUT_MS:
+            print(f"Slow DB connection checkout: {wait_seconds * 1000:.0f} ms, {self.status()}, {db_pool_metrics}")
+
+        return connection_record
+
+    def _create_connection(self):
+        started = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            if getattr(self._checkout_timing, "started", None) is not None:
+                self._checkout_timing.connect_seconds += time.perf_counter() - started
+
+
+def set_statement_timeout(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"SET statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+    cursor.close()
+    # Keep the setting when the pool rolls the connection back
+    dbapi_connection.commit()
+
+
+def register_enum_adapters(*enum_classes):
+    """Make psycopg2 send members of `enum_classes` as their values, like pg8000 does.
+
+    Called once on import, with the status enums of the function.
+    """
+    if DB_DRIVER != "psycopg2":
+        return
+
+    import psycopg2.extensions
+
+    for enum_class in enum_classes:
+        psycopg2.extensions.register_adapter(enum_class, lambda member: psycopg2.extensions.adapt(member.value))
+
+
 def create_db_engine():
     db_config = {
-        "drivername": "postgresql+pg8000",
+        "drivername": f"postgresql+{DB_DRIVER}",
     }
     if not running_locally:
         db_connection_name = os.environ["DB_CONNECTION_NAME"]
+        if DB_DRIVER == "psycopg2":
+            # libpq expects the directory of the socket
+            socket_query = {"host": f"/cloudsql/{db_connection_name}"}
+        else:
+            socket_query = {"unix_sock": f"/cloudsql/{db_connection_name}/.s.PGSQL.5432"}
         db_config |= {
-            "query": dict(
-                {"unix_sock": f"/cloudsql/{db_connection_name}/.s.PGSQL.5432"}
-            ),
+            "query": dict(socket_query),
             "database": configuration_context["DB_NAME"],
             "username": configuration_context["DB_USER"],
             "password": configuration_context["DB_PASS"],
@@ -69,24 +156,103 @@ def create_db_engine():
         }
     pool = create_engine(
         sqlalchemy.engine.url.URL.create(**db_config),
+        poolclass=TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
     )
     pool.dialect.description_encoding = None
+    if DB_STATEMENT_TIMEOUT_MS > 0:
+        sqlalchemy.event.listen(pool, "connect", set_statement_timeout)
     return pool
 
 
+# Rows fetched from a server-side cursor per round trip, see `stream_rows`
+DB_FETCH_SIZE = int(os.getenv("DB_FETCH_SIZE", 1000))
+
+
+def stream_rows(db_connection, stmt, params=None, fetch_size=DB_FETCH_SIZE):
+    """Execute `stmt` on a server-side cursor and iterate its rows, fetching `fetch_size` rows at a time.
+
+    The result set is never materialized as a whole, so memory is bounded by `fetch_size`.
+    Must be called within a transaction; other statements may be executed on `db_connection` meanwhile.
+    """
+    result = db_connection.execution_options(stream_results=True).execute(stmt, params or {})
+    return result.yield_per(fetch_size)
+# endshared
+
+
 db = create_db_engine()
+
 # endregion
 
 
 # region i18n initialisation
 TRANSLATIONS_FILE_PATH = './locale'
+TRANSLATIONS_FALLBACK_LOCALE = 'en'
+
+# Keys of all translations of the notifications: SendGrid template ids
+TRANSLATION_KEYS = [
+    "sendgrid.MatchTimeout",
+]
+
+# shared: _build/shared/translations.py, edit it there and run `python _build/sync_shared.py`
+# Translations of TRANSLATION_KEYS by locale, see `query_translations`
+translation_tables = {}
+
+
+def flatten_translations(translations, key_prefix=""):
+    """Return nested `translations` of a locale file by dotted key, e.g. "sendgrid.MatchTimeout"."""
+    flat_translations = {}
+    for key, value in translations.items():
+        if isinstance(value, dict):
+            flat_translations |= flatten_translations(value, f"{key_prefix}{key}.")
+        else:
+            flat_translations[f"{key_prefix}{key}"] = value
+
+    return flat_translations
+
+
+def load_translations(locale):
+    """Return all translations of `locale` by dotted key, or nothing if there is no file of the locale.
+
+    `<locale>.json` precompiled at deployment is read if present, `<locale>.yml` is parsed otherwise.
+    """
+    file_names = os.listdir(TRANSLATIONS_FILE_PATH)
+    if f"{locale}.json" in file_names:
+        with open(os.path.join(TRANSLATIONS_FILE_PATH, f"{locale}.json"), encoding="utf-8") as translations_file:
+            return json.load(translations_file)
+    elif f"{locale}.yml" in file_names:
+        import yaml
+
+        with open(os.path.join(TRANSLATIONS_FILE_PATH, f"{locale}.yml"), encoding="utf-8") as translations_file:
+            return flatten_translations(yaml.safe_load(translations_file))
+    else:
+        return {}
+
 
-i18n.set('fallback', 'en')
-i18n.set('filename_format', '{locale}.{format}')
-i18n.set('skip_locale_root_data', True)
-i18n.load_path.append(TRANSLATIONS_FILE_PATH)
+def query_translations(locale):
+    """Return translations of `TRANSLATION_KEYS` to `locale` by key.
 
-print(f'i18n initialised - configuration={i18n.load_path}')
+    A locale is loaded on its first use, only its translations of `TRANSLATION_KEYS` are kept for the process.
+    Keys missing in the locale are translated to TRANSLATIONS_FALLBACK_LOCALE, or left as they are.
+    """
+    if locale not in translation_tables:
+        if locale != TRANSLATIONS_FALLBACK_LOCALE:
+            fallback_translations = query_translations(TRANSLATIONS_FALLBACK_LOCALE)
+        else:
+            fallback_translations = {}
+
+        translations = load_translations(locale)
+        translation_tables[locale] = {
+            key: translations.get(key, fallback_translations.get(key, key)) for key in TRANSLATION_KEYS
+        }
+        print(f"Translations of locale={locale} loaded")
+
+    return translation_tables[locale]
+# endshared
 # endregion
 
 
@@ -109,15 +275,23 @@ class HostsGuestsStatus(Enum):
     MATCH_ACCEPTED = "095"
 
 
+register_enum_adapters(MatchesStatus, HostsGuestsStatus)
 # endregion
 
 
 # region Database data models
+# Tables reflected so far by (engine, table name), see `create_table_mapping`
+table_mappings = {}
+
+
 def create_table_mapping(db_pool, db_table_name):
-    meta = MetaData(db_pool)
-    tbl = Table(db_table_name, meta, autoload=True, autoload_with=db_pool)
+    """Return table `db_table_name` of `db_pool`.  A table is reflected once per process, then reused."""
+    key = (db_pool, db_table_name)
+    if key not in table_mappings:
+        meta = MetaData(db_pool)
+        table_mappings[key] = Table(db_table_name, meta, autoload=True, autoload_with=db_pool)
 
-    return tbl
+    return table_mappings[key]
 # endregion
 
 
@@ -151,7 +325,7 @@ def create_payload_for_match_timeout_template(
     )
 
     # template_id = "d-4b189c34ff584451a1dc1f83421a7d21"
-    template_id = i18n.t("sendgrid.MatchTimeout", locale=preferred_lang)
+    template_id = query_translations(preferred_lang)["sendgrid.MatchTimeout"]
 
     context = {
         "name": row["name"],
@@ -166,24 +340,18 @@ def create_payload_for_match_timeout_template(
 
 
 # region utility functions
-def check_expired_in_hours(str_epoch, timeout_hours):
-    now = int(time.time() * 1000)
-
-    int_epoch = int(str_epoch)
+def query_expiry_epoch(timeout_hours):
+    """Return epoch (in milliseconds, as in `db_ts_matched`) of the newest match expired after `timeout_hours`.
 
-    delta = now - int_epoch
-    delta_in_hours = int(delta / 1000 / 3600)
+    A match is expired once `timeout_hours` full hours have passed since it was created.
+    """
+    now = int(time.time() * 1000)
 
-    return delta_in_hours > int(timeout_hours)
+    return str(now - (int(timeout_hours) + 1) * 3600 * 1000)
 # endregion
 
 
 # region integration utilities
-
-# Instantiates a Pub/Sub client
-publisher = pubsub_v1.PublisherClient()
-
-
 def fnc_target(event, context):
     if not running_locally:
         pubsub_msg = json.loads(base64.b64decode(event["data"]).decode("utf-8"))
@@ -195,79 +363,137 @@ def fnc_target(event, context):
 
 
 # region integration utilities
-def fnc_publish_message(message):
-    topic_name = os.environ["SEND_EMAIL_TOPIC"]
-    topic_path = publisher.topic_path(os.environ["PROJECT_ID"], topic_name)
+# shared: _build/shared/pubsub_publishing.py, edit it there and run `python _build/sync_shared.py`
+# Messages are batched by the client, up to PUBSUB_MAX_IN_FLIGHT_MESSAGES are published without waiting
+PUBSUB_MAX_BATCH_MESSAGES = int(os.getenv("PUBSUB_MAX_BATCH_MESSAGES", 100))
+PUBSUB_MAX_BATCH_LATENCY_SECONDS = float(os.getenv("PUBSUB_MAX_BATCH_LATENCY_SECONDS", 0.05))
+PUBSUB_MAX_IN_FLIGHT_MESSAGES = int(os.getenv("PUBSUB_MAX_IN_FLIGHT_MESSAGES", 1000))
+
+# Instantiates a Pub/Sub client
+publisher = pubsub_v1.PublisherClient(
+    batch_settings=pubsub_v1.types.BatchSettings(
+        max_messages=PUBSUB_MAX_BATCH_MESSAGES,
+        max_latency=PUBSUB_MAX_BATCH_LATENCY_SECONDS,
+    )
+)
+
+# (future, topic name, message) of messages published and not confirmed yet
+in_flight_messages = []
+
+# Messages are written to the outbox table in the transaction changing the statuses they notify about,
+# instead of being published from within the transaction.  Only for functions calling `flush_messages`.
+NOTIFICATIONS_OUTBOX = os.getenv("NOTIFICATIONS_OUTBOX", "false").lower() == "true"
+OUTBOX_INSERT_CHUNK_SIZE = 1000
+# Messages of the current transaction to be written to the outbox table, see `flush_messages`
+outbox_messages = []
+
 
+def publish_message(topic_name, message):
+    """Publish `message` to `topic_name` without waiting for it, or keep it for the outbox.  See `flush_messages`."""
     message_json = json.dumps(message)
+    if NOTIFICATIONS_OUTBOX:
+        outbox_messages.append(dict(topic=topic_name, message=message_json))
+        return "Message stored."
+
+    if len(in_flight_messages) >= PUBSUB_MAX_IN_FLIGHT_MESSAGES:
+        wait_for_published_messages()
+
+    topic_path = publisher.topic_path(os.environ["PROJECT_ID"], topic_name)
     message_bytes = message_json.encode("utf-8")
 
     try:
         publish_future = publisher.publish(topic_path, data=message_bytes)
-        publish_future.result()  # Verify the publish succeeded
+        in_flight_messages.append((publish_future, topic_name, message_json))
         return "Message published."
     except Exception as e:
-        print(e)
+        print(f"Publishing to {topic_name} failed: {e}, message={message_json}")
         return (e, 500)
-# endregion
 
 
-# region data mutation services
-def change_guests_status(db_guests_id, target_status, db_conn):
-    tbl_guests_name = os.environ["GUESTS_TABLE_NAME"]
-    # tbl_guests_name = "guests"
-    tbl_guests = create_table_mapping(db_pool=db, db_table_name=tbl_guests_name)
-
-    change_guests_status = (
-        tbl_guests.update()
-            .where(tbl_guests.c.db_guests_id == db_guests_id)
-            .values(fnc_status=target_status)
-    )
+def wait_for_published_messages():
+    """Wait until all messages in flight are published.  Return the number of messages which failed."""
+    failed = 0
+    for publish_future, topic_name, message_json in in_flight_messages:
+        try:
+            publish_future.result()  # Verify the publish succeeded
+        except Exception as e:
+            print(f"Publishing to {topic_name} failed: {e}, message={message_json}")
+            failed += 1
 
-    result = db_conn.execute(change_guests_status)
+    print(f"Published {len(in_flight_messages) - failed} messages, {failed} failed")
+    in_flight_messages.clear()
+    return failed
 
-    print(f"changed status of db_guests_id={db_guests_id} to fnc_status={target_status} with result={result}")
 
+def flush_messages(db_connection):
+    """Send messages of the current transaction of `db_connection`, before it commits.
 
-def change_hosts_status(db_hosts_id, target_status, db_conn):
-    tbl_hosts_name = os.environ["HOSTS_TABLE_NAME"]
-    # tbl_hosts_name = "hosts"
-    tbl_hosts = create_table_mapping(db_pool=db, db_table_name=tbl_hosts_name)
+    Messages kept for the outbox are written to the outbox table in that transaction and published
+    later by the outbox-relay function.  Otherwise, messages published directly are waited for.
+    """
+    if len(outbox_messages) > 0:
+        tbl_outbox = sqlalchemy.table(
+            os.environ["OUTBOX_TABLE_NAME"], sqlalchemy.column("topic"), sqlalchemy.column("message")
+        )
+        for chunk_start in range(0, len(outbox_messages), OUTBOX_INSERT_CHUNK_SIZE):
+            db_connection.execute(
+                tbl_outbox.insert().values(outbox_messages[chunk_start:chunk_start + OUTBOX_INSERT_CHUNK_SIZE])
+            )
+        print(f"Stored {len(outbox_messages)} messages in {os.environ['OUTBOX_TABLE_NAME']}")
+        outbox_messages.clear()
 
-    change_hosts_status = (
-        tbl_hosts.update()
-            .where(tbl_hosts.c.db_hosts_id == db_hosts_id)
-            .values(fnc_status=target_status)
-    )
+    wait_for_published_messages()
+# endshared
 
-    result = db_conn.execute(change_hosts_status)
 
-    print(f"changed status of db_hosts_id={db_hosts_id} to fnc_status={target_status} with result={result}")
+def fnc_publish_message(message):
+    return publish_message(os.environ["SEND_EMAIL_TOPIC"], message)
+# endregion
 
 
-def change_matches_status(db_matches_id, target_status, db_conn):
-    tbl_matches_name = os.environ["MATCHES_TABLE_NAME"]
-    # tbl_matches_name = "matches"
-    tbl_matches = create_table_mapping(db_pool=db, db_table_name=tbl_matches_name)
+# region data mutation services
+# Listings which did not respond to their expired matches are made inactive, returning data for the notifications
+INACTIVATE_HOSTS_QUERY = sqlalchemy.text(
+    f"WITH inactive_hosts AS (UPDATE hosts SET fnc_status = '{HostsGuestsStatus.FNC_INACTIVE.value}' WHERE db_hosts_id IN :ids RETURNING *) SELECT hos.db_hosts_id, hos.db_ts_registered, hos.fnc_accounts_id, hos.fnc_status, hos.country, hos.city, hos.closest_city, hos.zipcode, hos.street, hos.building_no, hos.appartment_no, hos.shelter_type, hos.beds, hos.acceptable_group_relations, hos.ok_for_pregnant, hos.ok_for_disabilities, hos.ok_for_animals, hos.ok_for_elderly, hos.ok_for_any_nationality, hos.duration_category, hos.transport_included, hos.can_be_verified, coalesce(acc.phone_num, hos.phone_num) as phone_num, coalesce(acc.email, hos.email) as email, coalesce(acc.name, hos.name) as name, coalesce(acc.preferred_lang, 'pl') as preferred_lang, coalesce(acc.sms_notification, 'FALSE') as sms_notification FROM inactive_hosts hos LEFT JOIN accounts acc ON hos.fnc_accounts_id = acc.db_accounts_id;"
+).bindparams(sqlalchemy.bindparam("ids", expanding=True))
 
-    change_matches_status = (
-        tbl_matches.update()
-            .where(tbl_matches.c.db_matches_id == db_matches_id)
+INACTIVATE_GUESTS_QUERY = sqlalchemy.text(
+    f"WITH inactive_guests AS (UPDATE guests SET fnc_status = '{HostsGuestsStatus.FNC_INACTIVE.value}' WHERE db_guests_id IN :ids RETURNING *) SELECT gue.db_guests_id, gue.db_ts_registered, gue.fnc_accounts_id, gue.fnc_status, gue.country, gue.city, gue.acceptable_shelter_types, gue.beds, gue.group_relation, gue.is_pregnant, gue.is_with_disability, gue.is_with_animal, gue.is_with_elderly, gue.is_ukrainian_nationality, gue.duration_category, coalesce(acc.phone_num, gue.phone_num) as phone_num, coalesce(acc.email, gue.email) as email, coalesce(acc.name, gue.name) as name, coalesce(acc.preferred_lang, 'uk') as preferred_lang, coalesce(acc.sms_notification, 'FALSE') as sms_notification FROM inactive_guests gue LEFT JOIN accounts acc ON gue.fnc_accounts_id = acc.db_accounts_id;"
+).bindparams(sqlalchemy.bindparam("ids", expanding=True))
+
+
+def change_listings_status(tbl, id_col_name, ids, target_status, db_conn):
+    if len(ids) == 0:
+        return
+
+    change_listings_status = (
+        tbl.update()
+            .where(tbl.c[id_col_name].in_(ids))
             .values(fnc_status=target_status)
     )
 
-    result = db_conn.execute(change_matches_status)
+    result = db_conn.execute(change_listings_status)
 
-    print(f"changed status of db_matches_id={db_matches_id} to fnc_status={target_status} with result={result}")
+    print(f"changed status of {result.rowcount} rows of {tbl.name} to fnc_status={target_status}")
 
 
-def postgres_process_timeout(pubsub_msg):
-    tbl_matches = create_table_mapping(db_pool=db, db_table_name=os.environ["MATCHES_TABLE_NAME"])
-    tbl_guests = create_table_mapping(db_pool=db, db_table_name=os.environ["GUESTS_TABLE_NAME"])
-    tbl_hosts = create_table_mapping(db_pool=db, db_table_name=os.environ["HOSTS_TABLE_NAME"])
+def inactivate_listings(query, id_col_name, ids, db_conn):
+    """Make listings `ids` inactive.  Return their rows for the notifications, by id."""
+    if len(ids) == 0:
+        return {}
+
+    result = db_conn.execute(query, dict(ids=list(ids)))
+    inactive_rows = {row[id_col_name]: row for row in result}
+
+    print(f"changed status of {len(inactive_rows)} rows to fnc_status={HostsGuestsStatus.FNC_INACTIVE}")
+    return inactive_rows
+
 
-    sel_matches = (
-        tbl_matches.select()
+def expire_matches(tbl_matches, timeout_hours, db_conn):
+    """Reject awaiting matches created more than `timeout_hours` ago.  Return the rejected matches."""
+    # Epochs in db_ts_matched have 13 digits, so they compare as strings
+    expire_matches = (
+        tbl_matches.update()
         .where(
             or_(
                 tbl_matches.c.fnc_host_status == MatchesStatus.FNC_AWAITING_RESPONSE,
@@ -275,75 +501,83 @@ def postgres_process_timeout(pubsub_msg):
             )
         )
         .where(tbl_matches.c.fnc_status == MatchesStatus.FNC_AWAITING_RESPONSE)
+        .where(tbl_matches.c.db_ts_matched <= query_expiry_epoch(timeout_hours))
+        .values(fnc_status=MatchesStatus.MATCH_REJECTED)
+        .returning(
+            tbl_matches.c.db_matches_id,
+            tbl_matches.c.fnc_hosts_id,
+            tbl_matches.c.fnc_guests_id,
+            tbl_matches.c.fnc_host_status,
+            tbl_matches.c.fnc_guest_status,
+        )
     )
 
+    expired_matches = db_conn.execute(expire_matches).fetchall()
+
+    print(f"changed status of {len(expired_matches)} matches to fnc_status={MatchesStatus.MATCH_REJECTED}")
+    return expired_matches
+
+
+def postgres_process_timeout(pubsub_msg):
+    tbl_matches = create_table_mapping(db_pool=db, db_table_name=os.environ["MATCHES_TABLE_NAME"])
+    tbl_guests = create_table_mapping(db_pool=db, db_table_name=os.environ["GUESTS_TABLE_NAME"])
+    tbl_hosts = create_table_mapping(db_pool=db, db_table_name=os.environ["HOSTS_TABLE_NAME"])
+
     print("Timeout value: ", int(configuration_context["MATCH_TIMEOUT_HOURS"]))
     with db.connect() as conn:
         with conn.begin():
-            result = conn.execute(sel_matches)
+            # Messages left by a transaction which failed in a previous invocation were never sent
+            outbox_messages.clear()
+            expired_matches = expire_matches(tbl_matches, configuration_context["MATCH_TIMEOUT_HOURS"], conn)
 
-            for row in result:
+            awaiting = MatchesStatus.FNC_AWAITING_RESPONSE.value
+
+            # Listings which did not respond to any of their expired matches become inactive,
+            # the other ones are available for matching again
+            silent_hosts = {row["fnc_hosts_id"] for row in expired_matches if row["fnc_host_status"] == awaiting}
+            silent_guests = {row["fnc_guests_id"] for row in expired_matches if row["fnc_guest_status"] == awaiting}
+            responsive_hosts = {row["fnc_hosts_id"] for row in expired_matches} - silent_hosts
+            responsive_guests = {row["fnc_guests_id"] for row in expired_matches} - silent_guests
+
+            change_listings_status(tbl_hosts, "db_hosts_id", responsive_hosts, HostsGuestsStatus.MOD_ACCEPTED, conn)
+            change_listings_status(tbl_guests, "db_guests_id", responsive_guests, HostsGuestsStatus.MOD_ACCEPTED, conn)
+            inactive_hosts = inactivate_listings(INACTIVATE_HOSTS_QUERY, "db_hosts_id", silent_hosts, conn)
+            inactive_guests = inactivate_listings(INACTIVATE_GUESTS_QUERY, "db_guests_id", silent_guests, conn)
+
+            for row in expired_matches:
                 print(f"processing MATCH {row}")
 
-                if check_expired_in_hours(
-                    row["db_ts_matched"], configuration_context["MATCH_TIMEOUT_HOURS"]
-                ):
-                    change_matches_status(db_matches_id=row["db_matches_id"],
-                                          target_status=MatchesStatus.MATCH_REJECTED,
-                                          db_conn=conn)
-
-                    if row['fnc_host_status'] != MatchesStatus.FNC_AWAITING_RESPONSE.value:
-                        change_hosts_status(db_hosts_id=row["fnc_hosts_id"],
-                                            target_status=HostsGuestsStatus.MOD_ACCEPTED,
-                                            db_conn=conn)
-                    else:
-                        sel_hosts = sqlalchemy.text(
-                            f"SELECT hos.db_hosts_id, hos.db_ts_registered, hos.fnc_accounts_id, hos.fnc_status, hos.country, hos.city, hos.closest_city, hos.zipcode, hos.street, hos.building_no, hos.appartment_no, hos.shelter_type, hos.beds, hos.acceptable_group_relations, hos.ok_for_pregnant, hos.ok_for_disabilities, hos.ok_for_animals, hos.ok_for_elderly, hos.ok_for_any_nationality, hos.duration_category, hos.transport_included, can_be_verified, coalesce(acc.phone_num, hos.phone_num) as phone_num, coalesce(acc.email, hos.email) as email, coalesce(acc.name, hos.name) as name, coalesce(acc.preferred_lang, 'pl') as preferred_lang, coalesce(acc.sms_notification, 'FALSE') as sms_notification FROM hosts hos LEFT JOIN accounts acc ON hos.fnc_accounts_id = acc.db_accounts_id WHERE hos.db_hosts_id = '{row['fnc_hosts_id']}';"
+                if row["fnc_host_status"] == awaiting and row["fnc_hosts_id"] in inactive_hosts:
+                    host_row = inactive_hosts[row["fnc_hosts_id"]]
+                    message_for_host = (
+                        create_payload_for_match_timeout_template(
+                            row=host_row, # FIXME clean up
+                            to_emails=create_to_email_element(
+                                host_row["name"], host_row["email"]
+                            ),
+                            preferred_lang=host_row['preferred_lang']
                         )
-                        result = conn.execute(sel_hosts)
-                        for host_row in result:
-                            message_for_host = (
-                                create_payload_for_match_timeout_template(
-                                    row=host_row, # FIXME clean up
-                                    to_emails=create_to_email_element(
-                                        host_row["name"], host_row["email"]
-                                    ),
-                                    preferred_lang=host_row['preferred_lang']
-                                )
-                            )
-                            print(message_for_host)
-                            fnc_publish_message(message_for_host)
-                            change_hosts_status(db_hosts_id=row["fnc_hosts_id"],
-                                                target_status=HostsGuestsStatus.FNC_INACTIVE,
-                                                db_conn=conn)
-
-                    if row['fnc_guest_status'] != MatchesStatus.FNC_AWAITING_RESPONSE.value:
-                        change_guests_status(db_guests_id=row["fnc_guests_id"],
-                                             target_status=HostsGuestsStatus.MOD_ACCEPTED,
-                                             db_conn=conn)
-                    else:
-                        sel_guests = sqlalchemy.text(
-                            f"SELECT gue.db_guests_id, gue.db_ts_registered, gue.fnc_accounts_id, gue.fnc_status, gue.country, gue.city, gue.acceptable_shelter_types, gue.beds, gue.group_relation, gue.is_pregnant, gue.is_with_disability, gue.is_with_animal, gue.is_with_elderly, gue.is_ukrainian_nationality, duration_category, coalesce(acc.phone_num, gue.phone_num) as phone_num, coalesce(acc.email, gue.email) as email, coalesce(acc.name, gue.name) as name, coalesce(acc.preferred_lang, 'uk') as preferred_lang, coalesce(acc.sms_notification, 'FALSE') as sms_notification FROM guests gue LEFT JOIN accounts acc ON gue.fnc_accounts_id = acc.db_accounts_id WHERE gue.db_guests_id = '{row['fnc_guests_id']}';"
+                    )
+                    print(message_for_host)
+                    fnc_publish_message(message_for_host)
+
+                if row["fnc_guest_status"] == awaiting and row["fnc_guests_id"] in inactive_guests:
+                    guest_row = inactive_guests[row["fnc_guests_id"]]
+                    message_for_guest = (
+                        create_payload_for_match_timeout_template(
+                            row=guest_row,
+                            to_emails=create_to_email_element(
+                                guest_row["name"], guest_row["email"]
+                            ),
+                            preferred_lang=guest_row['preferred_lang']
                         )
-                        result = conn.execute(sel_guests)
-
-                        for guest_row in result:
-                            message_for_guest = (
-                                create_payload_for_match_timeout_template(
-                                    row=guest_row,
-                                    to_emails=create_to_email_element(
-                                        guest_row["name"], guest_row["email"]
-                                    ),
-                                    preferred_lang=guest_row['preferred_lang']
-                                )
-                            )
-
-                            print(message_for_guest)
-                            fnc_publish_message(message_for_guest)
-                            change_guests_status(db_guests_id=row["fnc_guests_id"],
-                                                 target_status=HostsGuestsStatus.FNC_INACTIVE,
-                                                 db_conn=conn)
+                    )
+
+                    print(message_for_guest)
+                    fnc_publish_message(message_for_guest)
+
+            flush_messages(conn)
 
 # endregion
 
-# This is end of file. Testing (3)
\ No newline at end of file
+# This is end of file. Testing (3)
@@ -0,0 +1,93 @@
+"""Database connectivity shared by the functions: copies of the shared code and the connection pool metrics."""
+import enum
+import glob
+import importlib.util
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from conftest import REPOSITORY_PATH, load_function
+
+CONNECT_SECONDS = 0.2
+
+
+def load_sync_shared():
+    spec = importlib.util.spec_from_file_location("sync_shared", os.path.join(REPOSITORY_PATH, "_build", "sync_shared.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.mark.parametrize(
+    "definition, shared_file",
+    [
+        ("def create_db_engine", "database_connectivity.py"),
+        ("def publish_message", "pubsub_publishing.py"),
+        ("def flatten_translations", "translations.py"),
+    ],
+)
+def test_main_files_are_in_sync_with_shared_code(definition, shared_file):
+    sync_shared = load_sync_shared()
+    defining_files = [
+        path for path in glob.glob(os.path.join(REPOSITORY_PATH, "*", "main.py"))
+        if definition in sync_shared.read_file(path)
+    ]
+
+    assert len(defining_files) > 0
+    for path in defining_files:
+        assert f"# shared: _build/shared/{shared_file}" in sync_shared.read_file(path), path
+    assert sync_shared.out_of_sync_files() == []
+
+
+@pytest.fixture
+def function_pool(monkeypatch):
+    module = load_function("outbox-relay")
+    monkeypatch.setattr(module, "db_pool_metrics", dict(checkouts=0, wait_seconds=0.0, max_wait_seconds=0.0))
+
+    def slow_connect():
+        time.sleep(CONNECT_SECONDS)
+        return sqlite3.connect(":memory:", check_same_thread=False)
+
+    def create_pool(**kwargs):
+        return module.TimedQueuePool(slow_connect, **kwargs)
+
+    return module, create_pool
+
+
+def test_pool_wait_excludes_opening_connections(function_pool):
+    module, create_pool = function_pool
+    pool = create_pool(pool_size=1, max_overflow=0)
+
+    pool.connect().close()
+    pool.connect().close()
+
+    assert module.db_pool_metrics["checkouts"] == 2
+    assert module.db_pool_metrics["max_wait_seconds"] < CONNECT_SECONDS / 2
+
+
+def test_pool_wait_measures_waiting_for_a_checked_out_connection(function_pool):
+    module, create_pool = function_pool
+    pool = create_pool(pool_size=1, max_overflow=0, timeout=5)
+    connection = pool.connect()
+    threading.Timer(CONNECT_SECONDS, connection.close).start()
+
+    pool.connect().close()
+
+    assert module.db_pool_metrics["checkouts"] == 2
+    assert module.db_pool_metrics["max_wait_seconds"] >= CONNECT_SECONDS * 0.9
+
+
+def test_psycopg2_sends_values_of_registered_enums_only(monkeypatch):
+    psycopg2 = pytest.importorskip("psycopg2")
+    import psycopg2.extensions
+    module = load_function("hosts-insert")
+    monkeypatch.setattr(module, "DB_DRIVER", "psycopg2")
+
+    module.register_enum_adapters(module.HostsGuestsStatus)
+
+    assert psycopg2.extensions.adapt(module.HostsGuestsStatus.MOD_ACCEPTED).getquoted() == b"'065'"
+    with pytest.raises(psycopg2.ProgrammingError, match="can't adapt"):
+        psycopg2.extensions.adapt(enum.Enum("Other", "VALUE").VALUE)
@@ -0,0 +1,81 @@
+"""Sweeps of guests-inactivity-timeout: expired guests are made inactive page by page."""
+import pytest
+import sqlalchemy
+
+EXPIRED_TS_REGISTERED = "1640995200000"
+
+
+@pytest.fixture
+def guests_inactivity_timeout(function_database, monkeypatch):
+    module = function_database("guests-inactivity-timeout")
+    monkeypatch.chdir(module.__file__.rsplit("/", 1)[0])
+    monkeypatch.setattr(module, "NOTIFICATIONS_OUTBOX", True)
+    monkeypatch.setitem(module.configuration_context, "GUESTS_INACTIVITY_PAGE_SIZE", 2)
+    return module
+
+
+def insert_guest(conn, rid, ts_registered=None):
+    conn.execute(
+        sqlalchemy.text(
+            "INSERT INTO guests (db_guests_id, db_ts_registered, fnc_status, name, email) "
+            "VALUES (:rid, coalesce(:ts_registered, FLOOR(EXTRACT(epoch FROM NOW())*1000)::VARCHAR), '065', :rid, "
+            ":email)"
+        ),
+        dict(rid=rid, ts_registered=ts_registered, email=f"{rid}@example.com"),
+    )
+
+
+def test_sweep_skips_locked_guests_and_continues_past_them(guests_inactivity_timeout):
+    module = guests_inactivity_timeout
+    with module.db.begin() as conn:
+        for rid in ["guest-1", "guest-2", "guest-3", "guest-4", "guest-5"]:
+            insert_guest(conn, rid, EXPIRED_TS_REGISTERED)
+        insert_guest(conn, "guest-6")
+
+    # Another transaction, e.g. of matches-create, holds a lock on an expired guest during the sweep
+    with module.db.connect() as locking_conn:
+        with locking_conn.begin():
+            locking_conn.execute(sqlalchemy.text("SELECT 1 FROM guests WHERE db_guests_id = 'guest-2' FOR UPDATE"))
+            module.postgres_process_timeout()
+
+    with module.db.connect() as conn:
+        statuses = dict(conn.execute(sqlalchemy.text("SELECT db_guests_id, fnc_status FROM guests")).all())
+        outbox_messages = conn.execute(sqlalchemy.text("SELECT count(*) FROM outbox")).scalar()
+
+    inactive = module.HostsGuestsStatus.FNC_INACTIVE.value
+    assert statuses == {
+        "guest-1": inactive,
+        "guest-2": "065",
+        "guest-3": inactive,
+        "guest-4": inactive,
+        "guest-5": inactive,
+        "guest-6": "065",
+    }
+    assert outbox_messages == 4
+
+
+def test_sweep_continues_past_a_page_of_locked_guests(guests_inactivity_timeout):
+    module = guests_inactivity_timeout
+    with module.db.begin() as conn:
+        for rid in ["guest-1", "guest-2", "guest-3", "guest-4", "guest-5"]:
+            insert_guest(conn, rid, EXPIRED_TS_REGISTERED)
+
+    # The whole first page is locked, no guest of it is made inactive
+    with module.db.connect() as locking_conn:
+        with locking_conn.begin():
+            locking_conn.execute(
+                sqlalchemy.text("SELECT 1 FROM guests WHERE db_guests_id IN ('guest-1', 'guest-2') FOR UPDATE")
+            )
+            module.postgres_process_timeout()
+
+    with module.db.connect() as conn:
+        statuses = dict(conn.execute(sqlalchemy.text("SELECT db_guests_id, fnc_status FROM guests")).all())
+
+    inactive = module.HostsGuestsStatus.FNC_INACTIVE.value
+    assert statuses == {
+        "guest-1": "065",
+        "guest-2": "065",
+        "guest-3": inactive,
+        "guest-4": inactive,
+        "guest-5": inactive,
+    }
@@ -0,0 +1,43 @@
+"""Inserts of accounts-insert, hosts-insert and guests-insert."""
+import pytest
+import sqlalchemy
+
+
+@pytest.mark.parametrize(
+    "function_name, table_name, id_column",
+    [
+        ("accounts-insert", "accounts", "db_accounts_id"),
+        ("hosts-insert", "hosts", "db_hosts_id"),
+        ("guests-insert", "guests", "db_guests_id"),
+    ],
+)
+def test_insert_leaves_the_cached_table_intact(function_database, function_name, table_name, id_column):
+    module = function_database(function_name)
+
+    for i in range(2):
+        module.postgres_insert(module.db, dict(name=f"name-{i}", email=f" Name-{i}@Example.com "))
+
+    # Every invocation of the process reuses the table reflected by the first one
+    tbl = module.table_mappings[(module.db, table_name)]
+    assert id_column in tbl.c and "db_ts_registered" in tbl.c
+
+    with module.db.connect() as conn:
+        rows = conn.execute(
+            sqlalchemy.text(f"SELECT {id_column}, db_ts_registered, name, email FROM {table_name} ORDER BY name")
+        ).all()
+    assert [(row["name"], row["email"]) for row in rows] == [
+        ("name-0", "name-0@example.com"),
+        ("name-1", "name-1@example.com"),
+    ]
+    assert all(row[id_column] is not None and row["db_ts_registered"] is not None for row in rows)
+
+
+def test_guests_insert_lets_the_database_draw_sampling_keys(function_database):
+    module = function_database("guests-insert")
+
+    for i in range(2):
+        module.postgres_insert(module.db, dict(name=f"name-{i}", email=f"name-{i}@example.com"))
+
+    with module.db.connect() as conn:
+        sampling_keys = conn.execute(sqlalchemy.text("SELECT sampling_key FROM guests")).scalars().all()
+    assert len(set(sampling_keys)) == 2 and all(0.0 <= key < 1.0 for key in sampling_keys)
@@ -0,0 +1,129 @@
+"""Matching runs of matches-create against the database: partial results are committed when matching fails."""
+import pytest
+import sqlalchemy
+
+CITIES = ["warszawa", "krakow"]
+
+
+@pytest.fixture
+def matches_create(function_database, monkeypatch):
+    module = function_database("matches-create")
+    for key, value in dict(
+        MATCH_TIMEOUT_HOURS=12,
+        HOSTS_MATCHING_BATCH_SIZE=100,
+        GUESTS_MATCHING_BATCH_SIZE=100,
+        MATCHING_MODE="blocked",
+    ).items():
+        monkeypatch.setitem(module.configuration_context, key, value)
+
+    # A host and a guest fitting each other in every city, each city is a block of its own
+    with module.db.begin() as conn:
+        for city in CITIES:
+            conn.execute(
+                sqlalchemy.text(
+                    "INSERT INTO hosts (db_hosts_id, fnc_status, country, closest_city, shelter_type, beds, "
+                    "acceptable_group_relations, ok_for_any_nationality, ok_for_elderly, ok_for_pregnant, "
+                    "ok_for_disabilities, ok_for_animals, duration_category) VALUES (:rid, '065', 'poland', :city, "
+                    "'{room}', 2, '{single_man}', 'TRUE', 'TRUE', 'TRUE', 'TRUE', 'TRUE', '{month}')"
+                ),
+                dict(rid=f"host-{city}", city=city),
+            )
+            conn.execute(
+                sqlalchemy.text(
+                    "INSERT INTO guests (db_guests_id, fnc_status, country, city, beds, is_pregnant, "
+                    "is_with_disability, is_with_animal, is_with_elderly, group_relation, acceptable_shelter_types, "
+                    "is_ukrainian_nationality, duration_category) VALUES (:rid, '065', 'poland', :city, 1, 'FALSE', "
+                    "'FALSE', 'FALSE', 'FALSE', '{single_man}', '{room}', 'TRUE', '{month}')"
+                ),
+                dict(rid=f"guest-{city}", city=city),
+            )
+
+    return module
+
+
+def listing_statuses(module, table_name, id_column):
+    with module.db.connect() as conn:
+        return dict(conn.execute(sqlalchemy.text(f"SELECT {id_column}, fnc_status FROM {table_name}")).all())
+
+
+def test_matches_of_solved_blocks_are_committed_when_a_block_fails(matches_create, monkeypatch):
+    solve_assignment = matches_create.solve_assignment
+    solved_blocks = []
+
+    def fail_second_block(cost_matrix, solver=matches_create.MatchingSolver.EXACT):
+        solved_blocks.append(cost_matrix.shape)
+        if len(solved_blocks) == 2:
+            raise RuntimeError("Solving failed")
+        return solve_assignment(cost_matrix, solver)
+
+    monkeypatch.setattr(matches_create, "solve_assignment", fail_second_block)
+
+    with pytest.raises(RuntimeError, match="Solving failed"):
+        matches_create.create_matching({})
+
+    with matches_create.db.connect() as conn:
+        matches = conn.execute(sqlalchemy.text("SELECT fnc_hosts_id, fnc_guests_id, fnc_status FROM matches")).all()
+    # Blocks are solved in the order of their keys
+    assert [tuple(row) for row in matches] == [("host-krakow", "guest-krakow", "055")]
+    assert listing_statuses(matches_create, "hosts", "db_hosts_id") == {"host-krakow": "085", "host-warszawa": "065"}
+    assert listing_statuses(matches_create, "guests", "db_guests_id") == {"guest-krakow": "085", "guest-warszawa": "065"}
+
+
+def test_matching_error_is_raised_when_writing_fails_too(matches_create, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError("Matching failed")
+
+    def fail_writing(*args, **kwargs):
+        raise ValueError("Writing failed")
+
+    monkeypatch.setattr(matches_create, "find_matches_blocked", fail)
+    monkeypatch.setattr(matches_create, "write_matching", fail_writing)
+
+    with pytest.raises(RuntimeError, match="Matching failed"):
+        matches_create.create_matching({})
+
+
+def test_writing_error_is_raised_when_matching_succeeds(matches_create, monkeypatch):
+    def fail_writing(*args, **kwargs):
+        raise ValueError("Writing failed")
+
+    monkeypatch.setattr(matches_create, "write_matching", fail_writing)
+
+    with pytest.raises(ValueError, match="Writing failed"):
+        matches_create.create_matching({})
+
+
+def test_candidate_pairs_of_more_listings_than_bind_parameters(matches_create):
+    # pg8000 binds at most 32767 parameters per statement
+    unknown_ids = [f"unknown-{i}" for i in range(20000)]
+    hosts_rids = {f"host-{city}" for city in CITIES} | set(unknown_ids)
+    guests_rids = {f"guest-{city}" for city in CITIES} | set(unknown_ids)
+
+    candidate_pairs = matches_create.query_candidate_pairs(hosts_rids, guests_rids)
+
+    assert sorted((row["db_hosts_id"], row["db_guests_id"]) for row in candidate_pairs) == [
+        ("host-krakow", "guest-krakow"),
+        ("host-warszawa", "guest-warszawa"),
+    ]
+
+
+def test_stale_claims_are_released_before_matching(matches_create):
+    with matches_create.db.begin() as conn:
+        # Claimed by a run stopped long ago, and by a run still going on
+        conn.execute(
+            sqlalchemy.text(
+                "UPDATE hosts SET fnc_status = '075', fnc_ts_claimed = '1640995200000' "
+                "WHERE db_hosts_id = 'host-warszawa'"
+            )
+        )
+        conn.execute(
+            sqlalchemy.text(
+                "UPDATE guests SET fnc_status = '075', fnc_ts_claimed = FLOOR(EXTRACT(epoch FROM NOW())*1000)::VARCHAR "
+                "WHERE db_guests_id = 'guest-warszawa'"
+            )
+        )
+
+    matches_create.create_matching({})
+
+    assert listing_statuses(matches_create, "hosts", "db_hosts_id") == {"host-krakow": "085", "host-warszawa": "065"}
+    assert listing_statuses(matches_create, "guests", "db_guests_id") == {"guest-krakow": "085", "guest-warszawa": "075"}
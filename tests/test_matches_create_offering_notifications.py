@@ -0,0 +1,72 @@
+"""Offering notifications of matches-create-offering-notifications: pending matches notify their listings."""
+import json
+
+import pytest
+import sqlalchemy
+
+
+@pytest.fixture
+def offering_notifications(function_database, monkeypatch):
+    module = function_database("matches-create-offering-notifications")
+    monkeypatch.chdir(module.__file__.rsplit("/", 1)[0])
+    monkeypatch.setattr(module, "NOTIFICATIONS_OUTBOX", True)
+    return module
+
+
+def insert_host(conn, rid):
+    conn.execute(
+        sqlalchemy.text(
+            "INSERT INTO hosts (db_hosts_id, fnc_status, name, email, city, shelter_type, beds, duration_category, "
+            "transport_included, ok_for_pregnant, ok_for_elderly, ok_for_disabilities, ok_for_animals) "
+            "VALUES (:rid, '085', :rid, :email, 'warszawa', '{room}', 2, '{month}', 'TRUE', 'TRUE', 'TRUE', 'TRUE', "
+            "'TRUE')"
+        ),
+        dict(rid=rid, email=f"{rid}@example.com"),
+    )
+
+
+def insert_guest(conn, rid):
+    conn.execute(
+        sqlalchemy.text(
+            "INSERT INTO guests (db_guests_id, fnc_status, name, email, beds, group_relation, "
+            "is_ukrainian_nationality, is_pregnant, is_with_disability, is_with_elderly, is_with_animal) "
+            "VALUES (:rid, '085', :rid, :email, 1, '{single_man}', 'TRUE', 'FALSE', 'FALSE', 'FALSE', 'FALSE')"
+        ),
+        dict(rid=rid, email=f"{rid}@example.com"),
+    )
+
+
+def insert_match(conn, rid, host_rid, guest_rid):
+    conn.execute(
+        sqlalchemy.text(
+            "INSERT INTO matches (db_matches_id, fnc_hosts_id, fnc_guests_id, fnc_status, fnc_host_status, "
+            "fnc_guest_status) VALUES (:rid, :host_rid, :guest_rid, '055', '055', '055')"
+        ),
+        dict(rid=rid, host_rid=host_rid, guest_rid=guest_rid),
+    )
+
+
+def outbox_recipients(conn):
+    messages = conn.execute(sqlalchemy.text("SELECT message FROM outbox")).scalars()
+    return sorted(json.loads(message)["to_emails"]["email"] for message in messages)
+
+
+def test_matches_with_a_missing_listing_are_not_notified(offering_notifications):
+    module = offering_notifications
+    with module.db.begin() as conn:
+        insert_host(conn, "host-1")
+        insert_guest(conn, "guest-1")
+        insert_match(conn, "match-1", "host-1", "guest-1")
+        # The listings were deleted after matching, the LEFT JOIN gives NULL columns of them
+        insert_match(conn, "match-2", "host-deleted", "guest-1")
+        insert_match(conn, "match-3", "host-1", "guest-deleted")
+
+    module.create_offering_notifications()
+
+    with module.db.connect() as conn:
+        statuses = dict(conn.execute(sqlalchemy.text("SELECT db_matches_id, fnc_status FROM matches")).all())
+        recipients = outbox_recipients(conn)
+
+    awaiting_response = module.MatchesStatus.FNC_AWAITING_RESPONSE.value
+    assert statuses == {"match-1": awaiting_response, "match-2": awaiting_response, "match-3": awaiting_response}
+    assert recipients == ["guest-1@example.com", "host-1@example.com"]
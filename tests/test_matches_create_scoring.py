@@ -0,0 +1,251 @@
+"""Scoring of matches-create: vectorized, indexed and cached evaluation against the per-pair scoring."""
+import datetime
+import random
+
+import numpy as np
+import pytest
+import sqlalchemy
+
+from conftest import load_function
+
+MATCH_TIMEOUT_HOURS = 12
+NOW = datetime.datetime(2022, 4, 1, 12, 0)
+COUNTRIES = ["poland", "germany"]
+CITIES = ["warszawa", "krakow", "gdansk", None]
+SHELTER_TYPES = ["bed", "room", "flat", "house"]
+GROUP_RELATIONS = ["single_man", "single_woman", "spouses", "mother_with_children"]
+
+
+@pytest.fixture
+def matches_create(monkeypatch):
+    module = load_function("matches-create")
+    monkeypatch.setattr(module, "MATCH_TIMEOUT_HOURS", MATCH_TIMEOUT_HOURS)
+    # Boosters of both paths must see the same clock
+    monkeypatch.setattr(module, "age_in_hours", lambda t: (NOW - t).days * 24 + int((NOW - t).seconds / 3600))
+    return module
+
+
+# region Reference implementation: boosters computed per scored pair, as before indexing
+def host_activity_boost(module, host_rid, recent_matches):
+    activity_points = 0
+    for row in recent_matches:
+        if row["fnc_hosts_id"] == host_rid and (
+            row["fnc_host_status"] == module.MatchesStatus.MATCH_ACCEPTED.value
+            or row["fnc_host_status"] == module.MatchesStatus.MATCH_REJECTED.value
+        ):
+            if row["fnc_status"] == module.MatchesStatus.MATCH_TIMEOUT.value:
+                activity_points += 3
+            if row["fnc_status"] == module.MatchesStatus.MATCH_REJECTED.value:
+                activity_points += 1
+
+    return module.activity_boost(activity_points)
+
+
+def guest_activity_boost(module, guest_rid, recent_matches):
+    activity_points = 0
+    for row in recent_matches:
+        if row["fnc_guests_id"] == guest_rid and (
+            row["fnc_guest_status"] == module.MatchesStatus.MATCH_ACCEPTED.value
+            or row["fnc_guest_status"] == module.MatchesStatus.MATCH_REJECTED.value
+        ):
+            if row["fnc_status"] == module.MatchesStatus.MATCH_TIMEOUT.value:
+                activity_points += 3
+            if row["fnc_status"] == module.MatchesStatus.MATCH_REJECTED.value:
+                activity_points += 1
+
+    return module.activity_boost(activity_points)
+
+
+class PerPairActivityBoosts:
+    """`ActivityBoosts` walking all `recent_matches` on every lookup."""
+
+    def __init__(self, module, recent_matches):
+        self.module = module
+        self.recent_matches = recent_matches
+
+    def for_host(self, rid):
+        return host_activity_boost(self.module, rid, self.recent_matches)
+
+    def for_guest(self, rid):
+        return guest_activity_boost(self.module, rid, self.recent_matches)
+# endregion
+
+
+# region Random listings
+def random_registration_date(rng):
+    return NOW - datetime.timedelta(minutes=rng.randrange(0, 2 * 60 * MATCH_TIMEOUT_HOURS + 120))
+
+
+def random_hosts(module, rng, count):
+    return [
+        module.HostListing(
+            rid=f"host-{i}",
+            registration_date=random_registration_date(rng),
+            country=rng.choice(COUNTRIES),
+            closest_city=rng.choice(CITIES[:-1]),
+            shelter_type=rng.choice(SHELTER_TYPES),
+            beds=rng.randint(1, 6),
+            acceptable_group_relations=rng.sample(GROUP_RELATIONS, rng.randint(1, len(GROUP_RELATIONS))),
+            ok_for_any_nationality=rng.random() < 0.8,
+            ok_for_elderly=rng.random() < 0.8,
+            ok_for_pregnant=rng.random() < 0.8,
+            ok_for_disabilities=rng.random() < 0.8,
+            ok_for_animals=rng.random() < 0.8,
+            duration_category=rng.randrange(len(module.DURATION_CATEGORIES)),
+            transport_included=rng.random() < 0.5,
+        )
+        for i in range(count)
+    ]
+
+
+def random_guests(module, rng, count):
+    return [
+        module.GuestListing(
+            rid=f"guest-{i}",
+            registration_date=random_registration_date(rng),
+            country=rng.choice(COUNTRIES),
+            city=rng.choice(CITIES),
+            beds=rng.randint(1, 4),
+            is_pregnant=rng.random() < 0.1,
+            is_with_disability=rng.random() < 0.1,
+            is_with_animal=rng.random() < 0.1,
+            is_with_elderly=rng.random() < 0.1,
+            group_relation=rng.choice(GROUP_RELATIONS),
+            acceptable_shelter_types=rng.sample(SHELTER_TYPES, rng.randint(1, len(SHELTER_TYPES))),
+            is_ukrainian_nationality=rng.random() < 0.9,
+            duration_category=rng.randrange(len(module.DURATION_CATEGORIES)),
+        )
+        for i in range(count)
+    ]
+
+
+def random_recent_matches(module, rng, hosts, guests, count):
+    statuses = [status.value for status in module.MatchesStatus]
+    return [
+        dict(
+            fnc_hosts_id=rng.choice(hosts).rid,
+            fnc_guests_id=rng.choice(guests).rid,
+            fnc_status=rng.choice(statuses),
+            fnc_host_status=rng.choice(statuses),
+            fnc_guest_status=rng.choice(statuses),
+        )
+        for i in range(count)
+    ]
+
+
+def recent_activity(module, recent_matches):
+    """Rows of `RECENT_ACTIVITY_QUERY` for `recent_matches`."""
+    responded = (module.MatchesStatus.MATCH_ACCEPTED.value, module.MatchesStatus.MATCH_REJECTED.value)
+    activity = {}
+    for row in recent_matches:
+        for listing_type, id_column, status_column in (
+            ("host", "fnc_hosts_id", "fnc_host_status"),
+            ("guest", "fnc_guests_id", "fnc_guest_status"),
+        ):
+            if row[status_column] not in responded:
+                continue
+            counts = activity.setdefault((listing_type, row[id_column]), dict(timeouts=0, rejections=0))
+            counts["timeouts"] += row["fnc_status"] == module.MatchesStatus.MATCH_TIMEOUT.value
+            counts["rejections"] += row["fnc_status"] == module.MatchesStatus.MATCH_REJECTED.value
+
+    return [
+        dict(listing_type=listing_type, listing_id=listing_id, **counts)
+        for (listing_type, listing_id), counts in activity.items()
+    ]
+# endregion
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_score_matrix_equals_per_pair_scores(matches_create, seed):
+    rng = random.Random(seed)
+    hosts = random_hosts(matches_create, rng, 40)
+    guests = random_guests(matches_create, rng, 50)
+    recent_matches = random_recent_matches(matches_create, rng, hosts, guests, 200)
+    rid_pairs = {(rng.choice(hosts).rid, rng.choice(guests).rid) for i in range(30)}
+
+    per_pair_boosts = PerPairActivityBoosts(matches_create, recent_matches)
+    activity_boosts = matches_create.index_activity_boosts(recent_activity(matches_create, recent_matches))
+    expected = np.array(
+        [[matches_create.evaluate_pair(host, guest, per_pair_boosts, rid_pairs) for guest in guests] for host in hosts]
+    )
+    indexed = np.array(
+        [[matches_create.evaluate_pair(host, guest, activity_boosts, rid_pairs) for guest in guests] for host in hosts]
+    )
+
+    assert np.count_nonzero(expected) > 0
+    np.testing.assert_array_equal(indexed, expected)
+    np.testing.assert_array_equal(
+        matches_create.create_score_matrix(hosts, guests, activity_boosts, rid_pairs), expected
+    )
+
+
+def test_recent_activity_query_equals_per_pair_boosts(matches_create, function_database):
+    matches_create = function_database("matches-create")
+    rng = random.Random(0)
+    hosts = random_hosts(matches_create, rng, 20)
+    guests = random_guests(matches_create, rng, 20)
+    recent_matches = random_recent_matches(matches_create, rng, hosts, guests, 200)
+    day_filter = matches_create.recent_matches_threshold()
+
+    with matches_create.db.begin() as conn:
+        conn.execute(
+            sqlalchemy.text(
+                "INSERT INTO matches (db_ts_matched, fnc_hosts_id, fnc_guests_id, fnc_status, fnc_host_status, "
+                "fnc_guest_status) VALUES (:db_ts_matched, :fnc_hosts_id, :fnc_guests_id, :fnc_status, "
+                ":fnc_host_status, :fnc_guest_status)"
+            ),
+            [dict(row, db_ts_matched=str(int(day_filter) + 1000)) for row in recent_matches],
+        )
+        activity_boosts = matches_create.index_activity_boosts(
+            conn.execute(sqlalchemy.text(matches_create.RECENT_ACTIVITY_QUERY), {"day_filter": day_filter})
+        )
+
+    for host in hosts:
+        assert activity_boosts.for_host(host.rid) == host_activity_boost(matches_create, host.rid, recent_matches)
+    for guest in guests:
+        assert activity_boosts.for_guest(guest.rid) == guest_activity_boost(matches_create, guest.rid, recent_matches)
+
+
+def test_incremental_matching_reuses_cached_feasibility(matches_create, monkeypatch, tmp_path):
+    monkeypatch.setattr(matches_create, "feasibility_cache", None)
+    cache_path = str(tmp_path / "feasibility.npz")
+    rng = random.Random(0)
+    hosts = random_hosts(matches_create, rng, 60)
+    guests = random_guests(matches_create, rng, 80)
+    activity_boosts = matches_create.ActivityBoosts(hosts={}, guests={})
+    rid_pairs = {(rng.choice(hosts).rid, rng.choice(guests).rid) for i in range(10)}
+
+    for run in range(3):
+        batch_hosts = rng.sample(hosts, 40)
+        batch_guests = rng.sample(guests, 50)
+        batch_hosts[0].beds += 1
+        if run == 2:
+            # A new process starts from the cache file
+            monkeypatch.setattr(matches_create, "feasibility_cache", None)
+
+        matches = matches_create.find_matches_incremental(
+            batch_hosts, batch_guests, activity_boosts, rid_pairs, cache_path=cache_path
+        )
+        expected = matches_create.find_matches(batch_hosts, batch_guests, activity_boosts, rid_pairs)
+
+        assert [(host.rid, guest.rid) for host, guest in matches] == [
+            (host.rid, guest.rid) for host, guest in expected
+        ]
+    assert len(matches_create.feasibility_cache.host_keys) > 0
+
+
+def test_incremental_matching_shrinks_batch_before_scoring(matches_create, monkeypatch):
+    monkeypatch.setattr(matches_create, "feasibility_cache", None)
+    rng = random.Random(1)
+    hosts = random_hosts(matches_create, rng, 40)
+    guests = random_guests(matches_create, rng, 50)
+    activity_boosts = matches_create.ActivityBoosts(hosts={}, guests={})
+    deadline = matches_create.MatchingDeadline()
+    monkeypatch.setattr(deadline, "affordable_block", lambda hosts_count, guests_count: (10, 12))
+
+    matches = matches_create.find_matches_incremental(hosts, guests, activity_boosts, set(), deadline=deadline)
+    expected = matches_create.find_matches(hosts[:10], guests[:12], activity_boosts, set())
+
+    assert [(host.rid, guest.rid) for host, guest in matches] == [(host.rid, guest.rid) for host, guest in expected]
+    assert len(matches_create.feasibility_cache.host_keys) <= 10
+    assert len(matches_create.feasibility_cache.guest_keys) <= 12
@@ -0,0 +1,31 @@
+"""Notifications kept for the outbox by the functions sending them, see `flush_messages`."""
+import pytest
+import sqlalchemy
+
+MESSAGES_COUNT = 2500
+
+
+@pytest.mark.parametrize(
+    "function_name",
+    [
+        "guests-inactivity-timeout",
+        "matches-create-match-sealed-notifications",
+        "matches-create-offering-notifications",
+        "matches-process-timeout",
+    ],
+)
+def test_flush_stores_messages_in_chunks(function_database, monkeypatch, function_name):
+    module = function_database(function_name)
+    monkeypatch.setattr(module, "NOTIFICATIONS_OUTBOX", True)
+    assert MESSAGES_COUNT > 2 * module.OUTBOX_INSERT_CHUNK_SIZE
+
+    with module.db.begin() as conn:
+        for i in range(MESSAGES_COUNT):
+            module.publish_message("send-email", dict(index=i))
+        module.flush_messages(conn)
+
+    with module.db.connect() as conn:
+        stored = conn.execute(sqlalchemy.text("SELECT count(*), count(DISTINCT message) FROM outbox")).one()
+
+    assert tuple(stored) == (MESSAGES_COUNT, MESSAGES_COUNT)
+    assert module.outbox_messages == []
@@ -0,0 +1,34 @@
+"""Relay of the outbox table by outbox-relay: messages which failed to be published stay in the outbox."""
+import concurrent.futures
+
+from conftest import load_function
+
+
+class FailingPublisher:
+    """Publisher failing to publish to `failing_topic`, synchronously as with an invalid topic."""
+
+    def __init__(self, failing_topic):
+        self.failing_topic = failing_topic
+
+    def topic_path(self, project_id, topic_name):
+        return f"projects/{project_id}/topics/{topic_name}"
+
+    def publish(self, topic_path, data):
+        if topic_path.endswith(f"/{self.failing_topic}"):
+            raise ValueError("publishing failed")
+
+        publish_future = concurrent.futures.Future()
+        publish_future.set_result("message-id")
+        return publish_future
+
+
+def test_failing_publish_skips_only_its_message(monkeypatch):
+    module = load_function("outbox-relay")
+    monkeypatch.setattr(module, "publisher", FailingPublisher(failing_topic="send-sms"))
+    outbox_rows = [
+        dict(db_outbox_id="outbox-1", topic="send-email", message="{}"),
+        dict(db_outbox_id="outbox-2", topic="send-sms", message="{}"),
+        dict(db_outbox_id="outbox-3", topic="send-email", message="{}"),
+    ]
+
+    assert module.publish_outbox_messages(outbox_rows) == ["outbox-1", "outbox-3"]